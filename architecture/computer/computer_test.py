@@ -16,11 +16,13 @@ def get_instructions(instructions, bitstring):
     for i, _ in enumerate(instructions):
         instructions[i].value = 0
 
-    for i, instr in enumerate(bitstring.split('\n')):
-        # Skip blank lines
-        if not instr.strip():
-            continue
-        instructions[i].value = int(instr.split()[0], 2)
+    for i, instr in enumerate(parse_instructions(bitstring)):
+        instructions[i].value = instr
+
+
+def parse_instructions(bitstring):
+    # Skip blank lines
+    return [int(instr.split()[0], 2) for instr in bitstring.split('\n') if instr.strip()]
 
 
 @cocotb.test()
@@ -153,9 +155,8 @@ async def can_increment_a_memory_address(dut):
 
     assert dut.memory_unit.ram.reg_array[69].value.signed_integer == 7
 
-@cocotb.test()
-async def runs_rect_program(dut):
-    get_instructions(dut.instructions, '''\
+
+RECT_PROGRAM = '''\
 0000000000000000  @0
 1111110000010000  D = M
 0000000000010111  @INFINITE_LOOP
@@ -181,7 +182,11 @@ async def runs_rect_program(dut):
 1110001100000001  D; jgt
 0000000000010111  @INFINITE_LOOP (INFINITE_LOOP)
 1110101010000111  0; jmp
-''')
+'''
+
+@cocotb.test()
+async def runs_rect_program(dut):
+    get_instructions(dut.instructions, RECT_PROGRAM)
     cocotb.start_soon(Clock(dut.clk, 10, units="ns").start())
     # Reset the CPU.
     dut.reset.value = 1
@@ -200,3 +205,40 @@ async def runs_rect_program(dut):
 
     for i in range(9):
         assert dut.memory_unit.ram.reg_array[2048 + 32*i].value.integer == 0xFFFF
+
+@cocotb.test()
+async def runs_rect_program_from_the_emulator(dut):
+    # Imported here so the other tests don't need the emulator's numpy.
+    import hybrid
+    from hybrid import emulator
+
+    # Draws most rows in the emulator and the rest in the simulator.
+    computer = emulator.Computer(parse_instructions(RECT_PROGRAM))
+    computer.d = computer.ram[0] = 9
+    cocotb.start_soon(Clock(dut.clk, 10, units="ns").start())
+    await hybrid.hand_over(dut, computer, cycles=100)
+
+    for i in range(100):
+        await FallingEdge(dut.clk)
+    await Timer(time=2, units="ns")
+
+    for i in range(9):
+        assert dut.memory_unit.ram.reg_array[2048 + 32*i].value.integer == 0xFFFF
+    computer.run(100)
+    assert dut.cpu_unit.reg_a_value.value.integer == computer.a
+    assert dut.cpu_unit.reg_d_value.value.integer == computer.d
+    assert dut.cpu_unit.newPC.value.integer == computer.pc
+
+
+@cocotb.test()
+async def runs_rect_program_in_lock_step_with_the_emulator(dut):
+    # The co-simulation also needs lark, for the assembler's disassembler.
+    import cosim
+    import hybrid
+    from hybrid import emulator
+
+    computer = emulator.Computer(parse_instructions(RECT_PROGRAM))
+    computer.d = computer.ram[0] = 9
+    cocotb.start_soon(Clock(dut.clk, 10, units="ns").start())
+    await hybrid.hand_over(dut, computer, cycles=0)
+    await cosim.CoSimulation(dut, computer).run(400)
@@ -0,0 +1,110 @@
+'''Runs the Python emulator in lock step with the simulated computer and
+stops at the first cycle where they disagree:
+
+    computer = emulator.Computer(rom)
+    await hybrid.hand_over(dut, computer, cycles=0)
+    await cosim.CoSimulation(dut, computer).run(10_000)
+
+After each falling edge the monitor samples the program counter, A, D, the
+instruction register and the CPU's writeM, addressM and outM. Reading the
+signals is the part that has to happen every cycle; the emulator's side is
+traced and compared with numpy once per batch of cycles, so the emulator
+adds little to the time cocotb already spends in the simulator.
+
+A mismatch raises `Divergence`, whose message lists the signals that
+differ and the instructions around the one being run.
+'''
+import sys
+from pathlib import Path
+
+import numpy as np
+from cocotb.triggers import FallingEdge, Timer
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / 'assembler'))
+import disassembler  # noqa: E402
+
+
+# The sampled signals, in the order of the fields of `emulator.TRACE`.
+SIGNALS = ('pc', 'a', 'd', 'instruction', 'write', 'address', 'out')
+
+# Stands in for signals that aren't 0 or 1, such as X or Z. It doesn't fit
+# in 16 bits, so it never matches the emulator.
+UNRESOLVED = -1
+
+
+class Divergence(AssertionError):
+    pass
+
+
+def resolve(handle):
+    try:
+        return handle.value.integer
+    except ValueError:
+        return UNRESOLVED
+
+
+def instruction_window(rom, address, before=4, after=4):
+    '''Disassembly of the instructions around `address`, with it marked.'''
+    lines = []
+    for line_address in range(max(0, address - before), min(len(rom), address + after + 1)):
+        word = rom[line_address]
+        text = disassembler.disassemble_word(word)
+        lines.append('{} {:04X}  {:04X}  {}'.format(
+            '>' if line_address == address else ' ', line_address, word,
+            text if text is not None else '(no assembly)'))
+    return '\n'.join(lines)
+
+
+class CoSimulation:
+    '''Compares `dut`, the `computer` module, with `computer`, an
+    `emulator.Computer` in the same state, such as after
+    `hybrid.hand_over`.'''
+
+    def __init__(self, dut, computer, batch=256):
+        self.dut = dut
+        self.computer = computer
+        self.batch = batch
+        cpu = dut.cpu_unit
+        self.handles = (cpu.newPC, cpu.reg_a_value, cpu.reg_d_value, dut.instruction,
+                        cpu.writeM, cpu.addressM, cpu.outM)
+
+    def sample(self):
+        return tuple(resolve(handle) for handle in self.handles)
+
+    async def run(self, cycles):
+        '''Runs `cycles` cycles in both, raising `Divergence` at the first
+        one that differs.'''
+        samples = []
+        for _ in range(cycles):
+            await FallingEdge(self.dut.clk)
+            await Timer(time=2, units="ns")
+            samples.append(self.sample())
+            if len(samples) == self.batch:
+                self.compare(samples)
+                samples = []
+        self.compare(samples)
+
+    def compare(self, samples):
+        start = self.computer.cycles
+        fetched = [self.computer.pc]
+        expected = self.computer.trace(len(samples))
+        expected = np.stack([expected[signal].astype(np.int32) for signal in SIGNALS], axis=-1)
+        actual = np.array(samples, dtype=np.int32).reshape(expected.shape)
+        mismatches = (actual != expected).any(axis=1)
+        if mismatches.any():
+            index = int(mismatches.argmax())
+            # The instruction register holds the word fetched from where
+            # the program counter was a cycle before.
+            fetched += expected[:, SIGNALS.index('pc')].tolist()
+            raise Divergence(self.report(
+                start + index + 1, fetched[index], expected[index], actual[index]))
+
+    def report(self, cycle, fetched, expected, actual):
+        lines = ['The simulator and the emulator diverge after cycle {}:'.format(cycle)]
+        for signal, expected_value, actual_value in zip(SIGNALS, expected, actual):
+            if expected_value != actual_value:
+                lines.append('  {}: simulator {}, emulator {:04X}'.format(
+                    signal, 'X' if actual_value == UNRESOLVED else '{:04X}'.format(actual_value),
+                    expected_value))
+        lines.append(instruction_window(self.computer.rom, fetched))
+        return '\n'.join(lines)
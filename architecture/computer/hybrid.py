@@ -0,0 +1,75 @@
+'''Runs the start of a program in the Python emulator and the rest in the
+simulated computer, so a test only simulates the cycles it needs to check.
+
+The emulator's state between cycles is the computer's right after a falling
+edge of the clock, so the state is written into the simulator through its
+registers a moment after one:
+
+    computer = emulator.Computer(rom)
+    computer.ram[0] = 9
+    await hybrid.hand_over(dut, computer, pc=10)
+    for i in range(100):
+        await FallingEdge(dut.clk)
+
+The clock has to be running already. Each falling edge after `hand_over`
+returns is one cycle of `computer.run(1)`.
+'''
+import sys
+from pathlib import Path
+
+from cocotb.triggers import FallingEdge, Timer
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / 'emulator'))
+import emulator  # noqa: E402
+
+
+def fast_forward(computer, cycles=None, pc=None, max_cycles=10_000_000):
+    '''Runs `computer` in the emulator for `cycles` cycles, then until its
+    program counter is `pc`, which is the `newPC` output of the CPU.'''
+    if cycles is not None:
+        computer.run(cycles)
+    if pc is not None:
+        start = computer.cycles
+        while computer.pc != pc:
+            if computer.cycles - start >= max_cycles:
+                raise emulator.EmulatorError(
+                    "Program counter didn't get to {:04X} in {} cycles".format(pc, max_cycles))
+            computer.step()
+    return computer
+
+
+def load_rom(dut, computer):
+    for address, instruction in enumerate(computer.rom):
+        dut.instructions[address].value = instruction
+
+
+def inject(dut, computer):
+    '''Puts the simulated computer in the same state as `computer` through
+    backdoor writes. Has to be called while the clock is low, after the
+    registers have loaded on a falling edge.'''
+    cpu = dut.cpu_unit
+    cpu.register_a.data.value = computer.a
+    cpu.register_d.data.value = computer.d
+    cpu.pc.counter.value = computer.pc
+    cpu.pc_load.value = int(computer.pc_load)
+    cpu.pc_increment.value = 1
+    dut.instruction.value = computer.instruction
+
+    ram = dut.memory_unit.ram
+    ram.data.value = computer.memory_out
+    for address, word in enumerate(computer.ram.tolist()):
+        ram.reg_array[address].value = word
+
+
+async def hand_over(dut, computer, cycles=None, pc=None):
+    '''Loads the program of `computer` into the simulated computer, runs it
+    in the emulator as far as `fast_forward` does, and continues from there
+    in the simulator starting with the next falling edge.'''
+    load_rom(dut, computer)
+    fast_forward(computer, cycles, pc)
+    dut.reset.value = 0
+    await FallingEdge(dut.clk)
+    # Wait for the registers to load on the edge, so they aren't
+    # overwritten.
+    await Timer(time=1, units="ns")
+    inject(dut, computer)
@@ -2,43 +2,72 @@ import lark
 from lark import Lark, Transformer
 from lark.exceptions import VisitError
 from dataclasses import dataclass
+import array
+import collections
+import functools
+import itertools
+import re
 import sys
-from pathlib import Path
 
+from output_formats import to_bitstring, write_output_files
+from timings import phase
 
-parser = Lark(r"""
-%import common.DIGIT -> DIGIT
+
+# The grammar is written to be parseable by Lark's LALR(1) parser with its
+# contextual lexer, which is much faster than Earley on large programs. Because
+# LALR can't resolve ambiguities after the fact, the few spots where a token
+# could be read in multiple ways are disambiguated in the lexer instead, using
+# terminal priorities and lookaheads.
+GRAMMAR = r"""
 %import common.HEXDIGIT -> HEXDIGIT
 %import common.INT -> INT
-%import common.NEWLINE -> NEWLINE
 %import common.CPP_COMMENT -> COMMENT
 %import common.CNAME -> NAME
 
-%import common.WS
-%ignore WS
+// Only newlines that end an instruction or label are significant, these take
+// priority over the blank lines that get ignored below.
+NEWLINE.2: /\r?\n/
+BLANK_LINE: /\r?\n/
+WS_INLINE: /[ \t\f\r]+/
+
+%ignore WS_INLINE
+%ignore BLANK_LINE
 %ignore COMMENT
 
 // A type instructions
-HEX_NUMBER: "0" "x" HEXDIGIT+
-number: HEX_NUMBER -> hex_number
-      | INT        -> decimal_number
-
-// We use a := here to disambiguate between A=0 etc C-type instructions.
-a_type_instruction: "A" ":=" number     -> a_const
-                  | "A" ":=" ("@" NAME) -> a_label
-                  | "A" ":=" ("$" NAME) -> a_symbol
+HEX_NUMBER.2: "0" "x" HEXDIGIT+
+NEGATIVE: "-"
+number: [NEGATIVE] HEX_NUMBER -> hex_number
+      | [NEGATIVE] INT        -> decimal_number
+
+// We use a := here to disambiguate between A=0 etc C-type instructions. The
+// A and := are lexed together so they aren't confused with the A register.
+_LOAD_A.3: /A[ \t]*:=/
+a_type_instruction: _LOAD_A number     -> a_const
+                  | _LOAD_A ("@" NAME) -> a_label
+                  | _LOAD_A ("$" NAME) -> a_symbol
+
+// Pseudo-instruction loading a constant into D, assembled into however many
+// instructions it takes like `A :=` with constants that don't fit in 15 bits.
+_LOAD_D.3: /D[ \t]*:=/
+load_d: _LOAD_D number -> d_const
 
 // C type instructions
 
-LOCATION: "A" | "D" | "*A"
+// A register is only a location if it isn't the start of a longer name or a
+// label definition like `D:`.
+LOCATION.2: /(A|D|\*A)(?!\w)(?![ \t\f\r]*:)/
 BINARY_OPERATOR: "+" | "-" | "&" | "|"
 UNARY_OPERATOR: "~" | "-"
+// Lexed as single tokens so they don't collide with BINARY_OPERATOR.
+_PLUS_ONE.2: /\+[ \t]*1/
+_MINUS_ONE.2: /-[ \t]*1/
 
 computed_value: LOCATION                          -> single_register
               | LOCATION BINARY_OPERATOR LOCATION -> register_operation
               | UNARY_OPERATOR LOCATION           -> single_register_operation
-              | LOCATION "+" "1"                  -> plus_one
-              | LOCATION "-" "1"                  -> minus_one
+              | LOCATION _PLUS_ONE                -> plus_one
+              | LOCATION _MINUS_ONE               -> minus_one
               | "0"                               -> zero_const
               | "1"                               -> one_const
               | "-1"                              -> minus_one_const
@@ -52,6 +81,7 @@ c_type_instruction: [assignment] computed_value [";" JUMP]
 
 instruction: a_type_instruction
            | c_type_instruction
+           | load_d
 
 label: NAME ":"
 
@@ -59,54 +89,68 @@ label: NAME ":"
 line: instruction
     | label
 
-start: [line NEWLINE]*
-""", propagate_positions=True, maybe_placeholders=True)
+start: (line NEWLINE)*
+"""
 
 
-class ASTValidator(Transformer):
-    def __init__(self):
-        # Used to make sure every instruction label used in `A :=` is defined.
-        self.instruction_labels = set()
-        self.used_instruction_labels = []
+_parser = None
 
-    def validate_number(self, n):
-        """Check if the number, as a short can be represented in 14 bits. """
-        # Check the length of the binary representation of n.
-        bitstring = bin(n)[2:]
 
-        if len(bitstring) > 15:
-            raise ValueError(
-                "Constant ({}) cannot fit in 15-bit immediate".format(bitstring))
+def get_parser():
+    """Returns the Lark parser for the grammar, building it the first time it's
+    needed so importing the assembler stays cheap.
 
-    def decimal_number(self, n):
-        (n, ) = n
-        n = int(n)
-        self.validate_number(n)
+    Lark caches the result of analysing the grammar on disk, keyed by a hash
+    of the grammar, the parser options and the Lark version, so later
+    processes load it instead of rebuilding it.
+    """
+    global _parser
+    if _parser is None:
+        options = dict(parser='lalr', lexer='contextual',
+                       propagate_positions=True, maybe_placeholders=True)
+        with phase('grammar'):
+            try:
+                _parser = Lark(GRAMMAR, cache=True, **options)
+            except OSError:
+                # The cache couldn't be written, it's only an optimization.
+                _parser = Lark(GRAMMAR, **options)
+    return _parser
 
-    def hex_number(self, n):
-        (n, ) = n
-        n = int(n, 16)
-        self.validate_number(n)
 
-    def register_operation(self, items):
-        (location_a, _, location_b) = items
-        if 'A' in (location_a, location_b) and '*A' in (location_a, location_b):
-            raise ValueError("Can't use both A and *A in ALU operation")
+def __getattr__(name):
+    # Keep `assembler.parser` working now that the parser is built lazily.
+    if name == 'parser':
+        return get_parser()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
-    def assignment(self, items):
-        used_locations = set()
-        for item in items:
-            if item in used_locations:
-                raise ValueError("Duplicate assignment target, {} already used".format(item))
-            used_locations.add(item)
 
-    def a_label(self, items):
-        (label, ) = items
-        self.used_instruction_labels.append(label)
+def validate_number(n):
+    """Check if the number can be represented in 16 bits, as either a signed
+    or an unsigned short. Numbers that don't fit in the 15-bit immediate of an
+    A-instruction are synthesized from several instructions."""
+    if not -0x8000 <= n <= 0xFFFF:
+        raise ValueError("Constant ({}) cannot fit in 16 bits".format(n))
 
-    def label(self, items):
-        (label_name, ) = items
-        self.instruction_labels.add(label_name)
+
+def validate_address(kind, name, address):
+    """Check that the address of a label or symbol can be loaded into A."""
+    if address > 0x7FFF:
+        raise ValueError(
+            "{} {} is at address {}, which cannot fit in 15-bit immediate".format(
+                kind, name, address))
+
+
+def validate_register_operation(location_a, location_b):
+    if 'A' in (location_a, location_b) and '*A' in (location_a, location_b):
+        raise ValueError("Can't use both A and *A in ALU operation")
+
+
+def validate_assignment(locations):
+    used_locations = set()
+    for location in locations:
+        if location in used_locations:
+            raise ValueError("Duplicate assignment target, {} already used".format(location))
+        used_locations.add(location)
 
 
 class ValidationError(Exception):
@@ -126,32 +170,23 @@ class ValidationError(Exception):
         return message
 
 
-def parse_and_validate_ast(assembly):
-    # Add a newline at the end if the input doesn't end in one.
-    if not assembly.endswith('\n'):
-        assembly += '\n'
+def missing_label_error(label):
+    """Error for an `A := @label` whose label is never defined, raised the same
+    way the transformers raise errors so its position gets reported."""
+    error = ValueError("Label {} used but never defined".format(label))
+    return VisitError('a_label', label, error)
 
-    # Create a raw parse tree.
-    parsed = parser.parse(assembly)
-    # Run the validator on it.
-    try:
-        validator = ASTValidator()
-        validator.transform(parsed)
 
-        # Check for any missing labels.
-        for label in validator.used_instruction_labels:
-            if label in validator.instruction_labels:
-                continue
-            error = ValueError("Label {} used but never defined".format(label))
-            raise VisitError('a_label', label, error)
-    except VisitError as e:
-        # Grab the line the error occured on.
-        line = assembly.split('\n')[e.obj.line - 1]
-        error = ValidationError(
-            str(e.orig_exc), line, e.obj.line, e.obj.column, e.obj.end_column)
-        # Raise from None so we avoid chaining the real error.
-        raise error from None
-    return parsed
+def make_validation_error(visit_error, assembly, first_lineno=1):
+    """Converts an error raised while transforming the tree of `assembly` into
+    a ValidationError pointing at the offending line. `first_lineno` is the
+    line number of the first line of `assembly` in its source file."""
+    # Grab the line the error occured on.
+    obj = visit_error.obj
+    line = assembly.split('\n')[obj.line - 1]
+    lineno = obj.line + first_lineno - 1
+    return ValidationError(
+        str(visit_error.orig_exc), line, lineno, obj.column, obj.end_column)
 
 
 @dataclass
@@ -195,105 +230,11 @@ class TypeAInstructionPlaceholder:
     label_name: str
 
 
-DEFAULT_SYMBOLS = {
-    'SP': 0, 'LCL': 1, 'ARG': 2, 'THIS': 3, 'THAT': 4,
-    'R0': 0, 'R1': 1, 'R2': 2, 'R3': 3, 'R4': 4, 'R5': 5, 'R6': 6, 'R7': 7,
-    'R8': 8, 'R9': 9, 'R10': 10, 'R11': 11, 'R12': 12, 'R13': 13, 'R14': 14,
-    'R15': 15, 'SCREEN': 0x200, 'KBD': 0x4000
-}
-
-
-class Assembler(Transformer):
-    def __init__(self):
-        super().__init__(self)
-        self.instruction_labels = {}
-        self.instruction_index = 0
-
-        self.symbol_map = DEFAULT_SYMBOLS.copy()
-        self.next_symbol_address = 16
-
-    def NEWLINE(self, _):
-        # Ignore new lines.
-        raise lark.visitors.Discard()
-
-    # Take the integer value of numbers.
-    def decimal_number(self, items):
-        (n, ) = items
-        return int(n)
-    def hex_number(self, items):
-        (n, ) = items
-        return int(n, 16)
-
-    def instruction(self, items):
-        # Increment the instruction index used to keep track of label values.
-        self.instruction_index += 1
-        (instr, ) = items
-        return instr
-
-    def label(self, items):
-        (label_name, ) = items
-        self.instruction_labels[label_name] = self.instruction_index
-        return None
-
-    def line(self, items):
-        (line, ) = items
-        # Discard because we don't actually want labels in the final transformation.
-        # Instead, label information should be retrieved from
-        # `assembler.instruction_labels`.
-        if line is None:
-            raise lark.visitors.Discard()
-        return line
-
-    def start(self, items):
-        # Collect all instructions into a list.
-        return list(items)
-
-    def a_const(self, items):
-        (constant, ) = items
-        return '0' + format(constant, '015b')
-
-    def a_label(self, items):
-        (label, ) = items
-        if label in self.instruction_labels:
-            return self.a_const((self.instruction_labels[label], ))
-        return TypeAInstructionPlaceholder(label_name=label)
-
-    def a_symbol(self, items):
-        (symbol_name, ) = items
-        if symbol_name in self.symbol_map:
-            symbol_address = self.symbol_map[symbol_name]
-        else:
-            symbol_address = self.next_symbol_address
-            self.symbol_map[symbol_name] = symbol_address
-            self.next_symbol_address += 1
-        return self.a_const((symbol_address, ))
-
-    def a_type_instruction(self, items):
-        (instr, ) = items
-        return instr
-
-    JUMP_TYPES = {
-        'no_jump': '000',
-        'jgt': '001',
-        'jeq': '010',
-        'jge': '011',
-        'jlt': '100',
-        'jne': '101',
-        'jle': '110',
-        'jmp': '111',
-    }
-
-    def JUMP(self, items):
-        return Assembler.JUMP_TYPES[items]
-
-    def assignment(self, items):
-        load_a = 'A' in items
-        load_d = 'D' in items
-        load_a_star = '*A' in items
-
-        load_bits = (load_a, load_d, load_a_star)
-        return ''.join(str(int(x)) for x in load_bits)
-
+class ALUComputations:
+    """Works out the load bit and ALU control bits for each value the ALU can
+    compute. The methods mirror the `computed_value` rules in the grammar and
+    take the same items, they're only run once to build `COMPUTATIONS`.
+    """
     def single_register(self, items):
         (register, ) = items
 
@@ -507,59 +448,875 @@ class Assembler(Transformer):
 
         return instr
 
+
+# Bits 15 to 13 are always set on C-type instructions.
+C_INSTRUCTION = 0b111 << 13
+
+LOCATIONS = ('A', 'D', '*A')
+
+
+def _build_computation_table():
+    """Encodes every computation the grammar accepts into bits 15 to 6 of a
+    C-type instruction, keyed by its text without whitespace such as 'D+*A'.
+    """
+    computations = ALUComputations()
+    table = {
+        '0': computations.zero_const(()),
+        '1': computations.one_const(()),
+        '-1': computations.minus_one_const(()),
+    }
+    for register in LOCATIONS:
+        table[register] = computations.single_register((register, ))
+        table[register + '+1'] = computations.plus_one((register, ))
+        table[register + '-1'] = computations.minus_one((register, ))
+        for operator in ('~', '-'):
+            table[operator + register] = computations.single_register_operation(
+                (operator, register))
+        for operator in ('+', '-', '&', '|'):
+            for other_register in LOCATIONS:
+                table[register + operator + other_register] = \
+                    computations.register_operation((register, operator, other_register))
+
+    return {text: C_INSTRUCTION | (int(instr.get_bits(), 2) << 6)
+            for text, instr in table.items()}
+
+
+COMPUTATIONS = _build_computation_table()
+
+# Bits 5 to 3, which locations to store the ALU output in.
+DESTINATIONS = {
+    'A': 0b100 << 3,
+    'D': 0b010 << 3,
+    '*A': 0b001 << 3,
+}
+
+# Bits 2 to 0, the jump condition.
+JUMPS = {
+    'jgt': 0b001,
+    'jeq': 0b010,
+    'jge': 0b011,
+    'jlt': 0b100,
+    'jne': 0b101,
+    'jle': 0b110,
+    'jmp': 0b111,
+}
+
+
+# Bits 12 to 6 of a C-instruction, whether y is *A rather than A and the
+# ALU's control bits.
+COMPUTATION_MASK = 0b1111111 << 6
+DESTINATION_MASK = 0b111 << 3
+JUMP_MASK = 0b111
+
+
+def alu(instruction, x, y):
+    """Output of the ALU for the computation in the C-instruction
+    `instruction`, where x is D and y is A or *A."""
+    if instruction & (1 << 11):
+        x = 0
+    if instruction & (1 << 10):
+        x = ~x & 0xFFFF
+    if instruction & (1 << 9):
+        y = 0
+    if instruction & (1 << 8):
+        y = ~y & 0xFFFF
+    if instruction & (1 << 7):
+        output = (x + y) & 0xFFFF
+    else:
+        output = x & y
+    if instruction & (1 << 6):
+        output = ~output & 0xFFFF
+    return output
+
+
+def reads_d(instruction):
+    # D is only used if the ALU doesn't zero it.
+    return not instruction & (1 << 11)
+
+
+# Every computation that just copies a register.
+COPY_COMPUTATIONS = {
+    COMPUTATIONS[register] & COMPUTATION_MASK: register for register in LOCATIONS}
+
+
+def evaluate(instruction, a, d):
+    """Value a C-instruction computes given the values of A and D, or None if
+    it can't be known. Values are constants or the (kind, name) of a label or
+    symbol reference, whose address isn't known yet."""
+    computation = instruction & COMPUTATION_MASK
+    register = COPY_COMPUTATIONS.get(computation)
+    if register == 'A':
+        return a
+    if register == 'D':
+        return d
+    # Anything else can only be computed from constants, and memory is never
+    # known.
+    if instruction & (1 << 12):
+        return None
+    if reads_d(instruction) and type(d) is not int:
+        return None
+    if not instruction & (1 << 9) and type(a) is not int:
+        return None
+    return alu(instruction, d if reads_d(instruction) else 0,
+               a if type(a) is int else 0)
+
+
+# Computations of A that can turn a constant which fits in an A-instruction
+# into any other, with how they're written and the constant A needs to hold
+# for them to compute `value`.
+A_TRANSFORMS = [
+    ('A', 'A', lambda value: value),
+    ('-A', '-A', lambda value: -value),
+    ('~A', '~A', lambda value: ~value),
+    ('A + 1', 'A+1', lambda value: value - 1),
+    ('A - 1', 'A-1', lambda value: value + 1),
+]
+
+
+@functools.lru_cache(maxsize=None)
+def constant_expansion(register, value):
+    """The shortest sequence of instructions loading the 16-bit `value`, signed
+    or not, into `register`, A or D. Returns (text, instruction) pairs.
+
+    All instructions take a cycle, so shortest is fastest too. A fits in one
+    A-instruction if it's in 15 bits and 0, 1 and -1 are computed by the ALU
+    directly. Anything else takes an A-instruction followed by a computation,
+    which is enough for every value: if it doesn't fit in 15 bits then its
+    complement does. Loading D this way overwrites A.
+    """
+    value &= 0xFFFF
+    if register == 'A' and value <= 0x7FFF:
+        return (('A := {}'.format(value), value), )
+    for constant in ('0', '1', '-1'):
+        instruction = COMPUTATIONS[constant] | DESTINATIONS[register]
+        if alu(instruction, 0, 0) == value:
+            return (('{} = {}'.format(register, constant), instruction), )
+    for text, computation, inverse in A_TRANSFORMS:
+        a = inverse(value) & 0xFFFF
+        instruction = COMPUTATIONS[computation] | DESTINATIONS[register]
+        if a <= 0x7FFF and alu(instruction, 0, a) == value:
+            return (('A := {}'.format(a), a),
+                    ('{} = {}'.format(register, text), instruction))
+    raise AssertionError("No expansion for {}".format(value))
+
+
+def synthesize_constant(register, value):
+    """Instructions loading `value` into `register`, see `constant_expansion`."""
+    return [instruction for (_, instruction) in constant_expansion(register, value)]
+
+
+DEFAULT_SYMBOLS = {
+    'SP': 0, 'LCL': 1, 'ARG': 2, 'THIS': 3, 'THAT': 4,
+    'R0': 0, 'R1': 1, 'R2': 2, 'R3': 3, 'R4': 4, 'R5': 5, 'R6': 6, 'R7': 7,
+    'R8': 8, 'R9': 9, 'R10': 10, 'R11': 11, 'R12': 12, 'R13': 13, 'R14': 14,
+    'R15': 15, 'SCREEN': 0x200, 'KBD': 0x4000
+}
+
+
+# Regexes for the fast path that assembles common, well-formed lines without
+# going through Lark. Anything these match must be accepted by the grammar
+# with the same meaning, lines they don't match fall back to the parser.
+#
+# Lines that contain nothing but a label definition or nothing at all.
+LABEL_LINE = re.compile(r'[ \t\f\r]*([_a-zA-Z][_a-zA-Z0-9]*)[ \t\f\r]*:[ \t\f\r]*(//.*)?\n?')
+BLANK_LINE = re.compile(r'[ \t\f\r]*(//.*)?\n?')
+A_INSTRUCTION_LINE = re.compile(
+    r'[ \t\f\r]*A[ \t]*:=[ \t\f\r]*'
+    r'(?:0x([0-9a-fA-F]+)|([0-9]+)|@[ \t\f\r]*([_a-zA-Z][_a-zA-Z0-9]*)|\$[ \t\f\r]*([_a-zA-Z][_a-zA-Z0-9]*))'
+    r'[ \t\f\r]*(//.*)?\n?')
+# `A := constant` or `D := constant`, including negative constants.
+LOAD_CONSTANT_LINE = re.compile(
+    r'[ \t\f\r]*([AD])[ \t]*:=[ \t\f\r]*(-?)[ \t\f\r]*(?:0x([0-9a-fA-F]+)|([0-9]+))'
+    r'[ \t\f\r]*(//.*)?\n?')
+INLINE_WHITESPACE = ' \t\f\r'
+SPACES_AND_TABS = re.compile(r'[ \t]+')
+
+
+def _build_fast_computation_table():
+    """Maps the ways each valid computation is commonly written, with a single
+    space or nothing between its tokens, to its encoding."""
+    spellings = {'0': ['0'], '1': ['1'], '-1': ['-1']}
+    for register in LOCATIONS:
+        spellings[register] = [register]
+        spellings[register + '+1'] = [register, '+', '1']
+        spellings[register + '-1'] = [register, '-', '1']
+        for operator in ('~', '-'):
+            spellings[operator + register] = [operator, register]
+        for operator in ('+', '-', '&', '|'):
+            for other_register in LOCATIONS:
+                try:
+                    validate_register_operation(register, other_register)
+                except ValueError:
+                    continue
+                spellings[register + operator + other_register] = \
+                    [register, operator, other_register]
+
+    table = {}
+    for text, tokens in spellings.items():
+        for gaps in itertools.product(('', ' '), repeat=len(tokens) - 1):
+            spelling = tokens[0] + ''.join(gap + token for gap, token in zip(gaps, tokens[1:]))
+            table[spelling] = COMPUTATIONS[text]
+    return table
+
+
+FAST_COMPUTATIONS = _build_fast_computation_table()
+
+def match_constant_load(line):
+    """Returns the register and constant if `line` loads a constant, written
+    in the usual way, otherwise None."""
+    match = LOAD_CONSTANT_LINE.fullmatch(line)
+    if not match:
+        return None
+    register, negative, hex_number, decimal_number = match.group(1, 2, 3, 4)
+    if hex_number is not None:
+        constant = int(hex_number, 16)
+    else:
+        constant = int(decimal_number)
+    return (register, -constant if negative else constant)
+
+
+# Returned by `Assembler.assemble_line_fast` for lines it can't handle.
+FALLBACK_TO_PARSER = object()
+
+
+class Assembler(Transformer):
+    """Validates and encodes a parse tree in a single walk over it.
+
+    Uses of labels that aren't defined yet are recorded in `label_fixups` as
+    (instruction index, label) pairs and get patched by `resolve_label_fixups`
+    once the walk is done and all labels are known.
+    """
+    def __init__(self):
+        super().__init__(self)
+        self.instruction_labels = {}
+        self.instruction_index = 0
+        self.label_fixups = []
+
+        self.symbol_map = DEFAULT_SYMBOLS.copy()
+        self.next_symbol_address = 16
+
+    def NEWLINE(self, _):
+        # Ignore new lines.
+        raise lark.visitors.Discard()
+
+    # Take the integer value of numbers.
+    def decimal_number(self, items):
+        (sign, n) = items
+        n = -int(n) if sign else int(n)
+        validate_number(n)
+        return n
+    def hex_number(self, items):
+        (sign, n) = items
+        n = -int(n, 16) if sign else int(n, 16)
+        validate_number(n)
+        return n
+
+    def instruction(self, items):
+        # Increment the instruction index used to keep track of label values.
+        # Pseudo-instructions are assembled into a list of instructions.
+        (instr, ) = items
+        self.instruction_index += len(instr) if type(instr) is list else 1
+        return instr
+
+    def label(self, items):
+        (label_name, ) = items
+        self.instruction_labels[label_name] = self.instruction_index
+        return None
+
+    def line(self, items):
+        (line, ) = items
+        # Discard because we don't actually want labels in the final transformation.
+        # Instead, label information should be retrieved from
+        # `assembler.instruction_labels`.
+        if line is None:
+            raise lark.visitors.Discard()
+        return line
+
+    def start(self, items):
+        # Collect the instructions of each line into a list.
+        return list(items)
+
+    def a_const(self, items):
+        # A-type instructions are just the constant with the top bit unset.
+        (constant, ) = items
+        if 0 <= constant <= 0x7FFF:
+            return constant
+        return synthesize_constant('A', constant)
+
+    def d_const(self, items):
+        (constant, ) = items
+        return synthesize_constant('D', constant)
+
+    def a_label(self, items):
+        (label, ) = items
+        if label in self.instruction_labels:
+            address = self.instruction_labels[label]
+            validate_address('Label', label, address)
+            return address
+        # `instruction` hasn't been called for this instruction yet, so the
+        # current index is its own.
+        self.label_fixups.append((self.instruction_index, label))
+        return TypeAInstructionPlaceholder(label_name=label)
+
+    def resolve_label_fixups(self, machine_code):
+        """Substitutes the instruction labels that weren't defined yet when
+        they were used into `machine_code`."""
+        for i, label in self.label_fixups:
+            if label not in self.instruction_labels:
+                raise missing_label_error(label)
+            address = self.instruction_labels[label]
+            try:
+                validate_address('Label', label, address)
+            except ValueError as e:
+                raise VisitError('a_label', label, e) from None
+            machine_code[i] = address
+
+    def a_symbol(self, items):
+        (symbol_name, ) = items
+        if symbol_name in self.symbol_map:
+            symbol_address = self.symbol_map[symbol_name]
+        else:
+            symbol_address = self.next_symbol_address
+            validate_address('Symbol', symbol_name, symbol_address)
+            self.symbol_map[symbol_name] = symbol_address
+            self.next_symbol_address += 1
+        return symbol_address
+
+    def a_type_instruction(self, items):
+        (instr, ) = items
+        return instr
+
+    def JUMP(self, items):
+        return JUMPS[items]
+
+    def assignment(self, items):
+        validate_assignment(items)
+        destination = 0
+        for location in items:
+            destination |= DESTINATIONS[location]
+        return destination
+
+    # Every computation is looked up in the precomputed table using its text
+    # with the whitespace removed.
+    def single_register(self, items):
+        (register, ) = items
+        return COMPUTATIONS[register]
+
+    def zero_const(self, _):
+        return COMPUTATIONS['0']
+
+    def one_const(self, _):
+        return COMPUTATIONS['1']
+
+    def minus_one_const(self, _):
+        return COMPUTATIONS['-1']
+
+    def minus_one(self, items):
+        (register, ) = items
+        return COMPUTATIONS[register + '-1']
+
+    def plus_one(self, items):
+        (register, ) = items
+        return COMPUTATIONS[register + '+1']
+
+    def single_register_operation(self, items):
+        (operator, register, ) = items
+        return COMPUTATIONS[operator + register]
+
+    def register_operation(self, items):
+        (reg1, operator, reg2) = items
+        validate_register_operation(reg1, reg2)
+        return COMPUTATIONS[reg1 + operator + reg2]
+
     def c_type_instruction(self, items):
-        if items[0] is not None:
-            assignment = items[0]
+        (destination, computation, jump) = items
+        # No assignment or jump leaves their bits as zero.
+        if destination is not None:
+            computation |= destination
+        if jump is not None:
+            computation |= jump
+        return computation
+
+    def assemble_line_with_parser(self, line):
+        """Assembles a single newline terminated line by parsing it with Lark.
+        Returns its instruction, a list of instructions for
+        pseudo-instructions, or None if it doesn't have any."""
+        parser = get_parser()
+        with phase('parse'):
+            parsed = parser.parse(line)
+        with phase('transform'):
+            instructions = self.transform(parsed)
+        return instructions[0] if instructions else None
+
+    def load_constant(self, register, constant):
+        # Let the parser report constants that are too large.
+        if not -0x8000 <= constant <= 0xFFFF:
+            return FALLBACK_TO_PARSER
+        instructions = synthesize_constant(register, constant)
+        self.instruction_index += len(instructions)
+        return instructions
+
+    def assemble_line_fast(self, line):
+        """Assembles a single line without parsing it, if it's written in one
+        of the common ways. Returns the same as `assemble_line_with_parser`,
+        or FALLBACK_TO_PARSER if the line needs the full parser, either
+        because it's written unusually or because it's invalid."""
+        match = A_INSTRUCTION_LINE.fullmatch(line)
+        if match:
+            hex_number, decimal_number, label, symbol = match.group(1, 2, 3, 4)
+            if label is not None:
+                instruction = self.a_label((label, ))
+            elif symbol is not None:
+                instruction = self.a_symbol((symbol, ))
+            else:
+                if hex_number is not None:
+                    instruction = int(hex_number, 16)
+                else:
+                    instruction = int(decimal_number)
+                if instruction > 0x7FFF:
+                    return self.load_constant('A', instruction)
+            self.instruction_index += 1
+            return instruction
+
+        load = match_constant_load(line)
+        if load:
+            return self.load_constant(*load)
+
+        match = LABEL_LINE.fullmatch(line)
+        if match:
+            self.instruction_labels[match.group(1)] = self.instruction_index
+            return None
+        if BLANK_LINE.fullmatch(line):
+            return None
+
+        # Otherwise this is a `destination = computation; jump` C-instruction.
+        code = line.split('//', 1)[0]
+        destinations, equals, computation = code.partition('=')
+        if not equals:
+            computation = destinations
+            destinations = None
+        computation, semicolon, jump = computation.partition(';')
+
+        computation = computation.strip(INLINE_WHITESPACE)
+        instruction = FAST_COMPUTATIONS.get(computation)
+        if instruction is None:
+            computation = SPACES_AND_TABS.sub(' ', computation)
+            instruction = FAST_COMPUTATIONS.get(computation)
+            if instruction is None:
+                return FALLBACK_TO_PARSER
+
+        if destinations is not None:
+            destination = 0
+            for location in destinations.split(','):
+                location_bit = DESTINATIONS.get(location.strip(INLINE_WHITESPACE))
+                # Missing or duplicated destinations are reported by the parser.
+                if location_bit is None or destination & location_bit:
+                    return FALLBACK_TO_PARSER
+                destination |= location_bit
+            instruction |= destination
+
+        if semicolon:
+            jump = JUMPS.get(jump.strip(INLINE_WHITESPACE))
+            if jump is None:
+                return FALLBACK_TO_PARSER
+            instruction |= jump
+
+        self.instruction_index += 1
+        return instruction
+
+
+def listed_expansion(line, instructions):
+    """How `instructions` are written, if they're the expansion of a
+    pseudo-instruction on `line`, otherwise None."""
+    constant_load = match_constant_load(line)
+    if constant_load is None:
+        return None
+    (register, constant) = constant_load
+    if register == 'A' and 0 <= constant <= 0x7FFF:
+        return None
+    expansion = constant_expansion(register, constant)
+    if [instruction for (_, instruction) in expansion] != instructions:
+        return None
+    return [text for (text, _) in expansion]
+
+
+def listing_row(address, instruction, lineno, line, cycles=None):
+    """A row of `Program.listing`, leaving out whatever is None. The cycles
+    column is only there if `cycles` isn't None, '' leaves it blank."""
+    row = '{:4}  {:4}  '.format(
+        '' if address is None else '{:04X}'.format(address),
+        '' if instruction is None else '{:04X}'.format(instruction))
+    if cycles is not None:
+        row += '{:>7}  '.format(cycles)
+    return (row + '{:>5}  {}'.format('' if lineno is None else lineno, line)).rstrip()
+
+
+@dataclass
+class Program:
+    """An assembled program.
+
+    `code` holds one 16-bit word per instruction, it supports the buffer
+    protocol so it can be handed to a loader or emulator without copying.
+    `source_map[i]` is the line number in the source that instruction `i` was
+    assembled from.
+    """
+    code: array.array
+    # Instruction address of every label.
+    labels: dict
+    # RAM address of every symbol, including the predefined ones.
+    symbols: dict
+    source_map: array.array
+    # For programs linked from several modules, the path and first
+    # instruction address of each module in the order they're laid out.
+    modules: list = None
+
+    @classmethod
+    def from_assembler(cls, assembler, machine_code, source_map):
+        return cls(array.array('H', machine_code), assembler.instruction_labels,
+                   assembler.symbol_map, array.array('I', source_map))
+
+    def __len__(self):
+        return len(self.code)
+
+    def memoryview(self):
+        return memoryview(self.code)
+
+    def to_bitstrings(self):
+        return [to_bitstring(instruction) for instruction in self.code]
+
+    def sections(self, source):
+        """Splits up the source of the program into (path, source lines,
+        first instruction address, last instruction address + 1) for each
+        module, path is None unless the program was linked. `source` is as
+        for `listing`."""
+        if self.modules is None:
+            modules = [(None, source, 0)]
         else:
-            # Assign nothing by default.
-            assignment = '000'
+            modules = [(path, source[path], start) for (path, start) in self.modules]
+        ends = [start for (_, _, start) in modules[1:]] + [len(self.code)]
+        for (path, module_source, start), end in zip(modules, ends):
+            lines = module_source.split('\n')
+            if module_source.endswith('\n'):
+                lines.pop()
+            yield path, lines, start, end
+
+    def listing(self, source, cycles=None):
+        """Lists every line of `source` next to the address and encoding of
+        the instructions assembled from it, with the instructions each
+        pseudo-instruction was expanded to on lines of their own. For linked
+        programs `source` maps the path of each module to its source.
+
+        `cycles` adds a column with a number of cycles for each instruction,
+        see `CycleAnalysis`."""
+        def cycles_column(address):
+            if cycles is None:
+                return None
+            if address is None or cycles[address] is None:
+                return ''
+            return cycles[address]
+
+        rows = []
+        for path, lines, start, end in self.sections(source):
+            if path is not None:
+                rows.append('// {}'.format(path))
+            line_addresses = {}
+            for address in range(start, end):
+                line_addresses.setdefault(self.source_map[address], []).append(address)
+            for lineno, line in enumerate(lines, start=1):
+                addresses = line_addresses.get(lineno, [])
+                expansion = listed_expansion(line, [self.code[a] for a in addresses])
+                if expansion is None:
+                    rows.extend(listing_row(a, self.code[a], lineno if i == 0 else None,
+                                            line if i == 0 else '', cycles_column(a))
+                                for i, a in enumerate(addresses))
+                    if not addresses:
+                        rows.append(listing_row(None, None, lineno, line, cycles_column(None)))
+                    continue
+                rows.append(listing_row(None, None, lineno, line, cycles_column(None)))
+                indent = line[:len(line) - len(line.lstrip())] + '    '
+                rows.extend(listing_row(a, self.code[a], None, indent + text, cycles_column(a))
+                            for a, text in zip(addresses, expansion))
+        return '\n'.join(rows) + '\n'
+
+    def write(self, output_path, formats=('hack', )):
+        """Writes the program to `output_path` in each of `formats`, see
+        `write_output_files`."""
+        return write_output_files(output_path, self.code, formats)
+
+
+def parse(assembly):
+    """Parses `assembly` with Lark, without validating it."""
+    # Add a newline at the end if the input doesn't end in one.
+    if not assembly.endswith('\n'):
+        assembly += '\n'
+    parser = get_parser()
+    with phase('parse'):
+        return parser.parse(assembly)
 
-        # Memory input and ALU bits given by middle part.
-        instr = items[1]
 
-        if items[2] is not None:
-            jump = items[2]
+def assemble_tree(parsed):
+    """Validates and assembles a parse tree from `parse`. Raises VisitError
+    on invalid programs, use `make_validation_error` to report them."""
+    assembler = Assembler()
+    instruction_lines = [
+        line.meta.line for line in parsed.children
+        if isinstance(line, lark.Tree) and line.children[0].data == 'instruction'
+    ]
+    machine_code = []
+    source_map = []
+    with phase('transform'):
+        instructions = assembler.transform(parsed)
+    for lineno, instruction in zip(instruction_lines, instructions):
+        if type(instruction) is list:
+            machine_code.extend(instruction)
+            source_map.extend([lineno] * len(instruction))
         else:
-            # Do not perform any jump by default.
-            jump = Assembler.JUMP_TYPES['no_jump']
+            machine_code.append(instruction)
+            source_map.append(lineno)
+    with phase('resolve labels'):
+        assembler.resolve_label_fixups(machine_code)
+    return Program.from_assembler(assembler, machine_code, source_map)
 
-        return '111' + instr.get_bits() + assignment + jump
 
+def assemble(assembly):
+    """Validates and assembles `assembly` into a Program.
 
-def assemble_ast(ast):
+    Lines are assembled through `Assembler.assemble_line_fast` where possible,
+    only falling back to Lark for the others.
+    """
     assembler = Assembler()
-    machine_code = assembler.transform(ast)
+    machine_code = []
+    source_map = []
+    try:
+        with phase('fast path'):
+            for lineno, line in enumerate(assembly.split('\n'), start=1):
+                instruction = assembler.assemble_line_fast(line)
+                if instruction is FALLBACK_TO_PARSER:
+                    instruction = assembler.assemble_line_with_parser(line + '\n')
+                if instruction is None:
+                    continue
+                if type(instruction) is list:
+                    machine_code.extend(instruction)
+                    source_map.extend([lineno] * len(instruction))
+                else:
+                    machine_code.append(instruction)
+                    source_map.append(lineno)
+        with phase('resolve labels'):
+            assembler.resolve_label_fixups(machine_code)
+    except (VisitError, lark.exceptions.UnexpectedInput, ValueError):
+        # Errors are rare, so report them by assembling the whole source with
+        # the parser. That way they come out exactly as they always have.
+        return assemble_with_parser(assembly)
+    return Program.from_assembler(assembler, machine_code, source_map)
+
+
+def assemble_with_parser(assembly):
+    """Like `assemble`, but parses the whole source with Lark and then
+    validates and assembles it with a single walk over the parse tree.
+    """
+    if not assembly.endswith('\n'):
+        assembly += '\n'
+    parsed = parse(assembly)
+    try:
+        return assemble_tree(parsed)
+    except VisitError as e:
+        # Raise from None so we avoid chaining the real error.
+        raise make_validation_error(e, assembly) from None
 
-    # Perform a second pass over the list of machine code, substituting in any
-    # undefined instruction labels for their real values.
-    for i, instruction in enumerate(machine_code):
-        if not isinstance(instruction, TypeAInstructionPlaceholder):
-            continue
-        symbol = assembler.instruction_labels[instruction.label_name]
-        machine_code[i] = assembler.a_const((symbol, ))
 
-    return machine_code
+# The original interface, which the rest of the repo uses. Kept as wrappers
+# around the functions above.
 
+def parse_and_validate_ast(assembly):
+    if not assembly.endswith('\n'):
+        assembly += '\n'
+    parsed = parse(assembly)
+    try:
+        assemble_tree(parsed)
+    except VisitError as e:
+        raise make_validation_error(e, assembly) from None
+    return parsed
 
-if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print("Usage: assembler <file.asm>")
-        sys.exit(1)
 
-    source_file = Path(sys.argv[1])
-    if not source_file.exists():
-        print("Source file {} not found".format(source_file))
-        sys.exit(1)
+def assemble_ast(ast):
+    return assemble_tree(ast).to_bitstrings()
+
+
+def assemble_source(assembly):
+    """Validates and assembles `assembly`, returning a list of instructions
+    as integers."""
+    return assemble(assembly).code.tolist()
+
+
+def collect_labels(lines):
+    """First pass of the streaming assembler, finds the instruction index of
+    every label in `lines` without parsing them."""
+    instruction_labels = {}
+    instruction_index = 0
+    for line in lines:
+        label = LABEL_LINE.fullmatch(line)
+        if label:
+            instruction_labels[label.group(1)] = instruction_index
+        elif not BLANK_LINE.fullmatch(line):
+            instruction_index += instruction_count(line)
+    return instruction_labels
+
+
+def instruction_count(line):
+    """How many instructions a line with an instruction assembles to, which
+    is more than one for pseudo-instructions."""
+    load = match_constant_load(line)
+    if load is None:
+        return 1
+    (register, constant) = load
+    # Constants that are out of range are reported in the second pass.
+    if register == 'A' and 0 <= constant <= 0x7FFF or not -0x8000 <= constant <= 0xFFFF:
+        return 1
+    return len(constant_expansion(register, constant))
+
+
+def assemble_lines(lines, instruction_labels):
+    """Second pass of the streaming assembler, parses and encodes `lines` one
+    at a time yielding each instruction. Only one line is held in memory at a
+    time so this works on sources of any size, as long as every instruction
+    is on a single line.
+
+    `instruction_labels` should come from running `collect_labels` over the
+    same lines.
+    """
+    assembler = Assembler()
+    # Like in `assemble`, a label defined more than once refers to its latest
+    # definition so far, or its last one if it's used before any of them.
+    assembler.instruction_labels = collections.ChainMap({}, instruction_labels)
+
+    for lineno, line in enumerate(lines, start=1):
+        label = LABEL_LINE.fullmatch(line)
+        if label:
+            assembler.instruction_labels[label.group(1)] = assembler.instruction_index
+            continue
 
-    assembled_file = source_file.with_suffix('.hack')
+        try:
+            instruction = assembler.assemble_line_fast(line)
+        except ValueError:
+            # Let the parser report labels and symbols that are out of range.
+            instruction = FALLBACK_TO_PARSER
+        # Every label is known up front, so any fixup is a missing label. Those
+        # go through the parser too, to find the label's position in the line.
+        if instruction is not FALLBACK_TO_PARSER and not assembler.label_fixups:
+            if type(instruction) is list:
+                yield from instruction
+            elif instruction is not None:
+                yield instruction
+            continue
 
-    with source_file.open() as f:
-        source = f.read()
+        if not line.endswith('\n'):
+            line += '\n'
+        try:
+            instruction = assembler.assemble_line_with_parser(line)
+            if assembler.label_fixups:
+                (_, label) = assembler.label_fixups[-1]
+                raise missing_label_error(label)
+        except lark.exceptions.UnexpectedInput as e:
+            # Point the syntax error at the line in the whole source.
+            e.line = lineno
+            raise
+        except VisitError as e:
+            raise make_validation_error(e, line, first_lineno=lineno) from None
+        if type(instruction) is list:
+            yield from instruction
+        elif instruction is not None:
+            yield instruction
+
+
+def decode_line(line):
+    """Assembles a single line on its own, for `IncrementalAssembler`.
+
+    Returns None for lines without an instruction and the encoded instruction
+    for ones that don't depend on the rest of the program, or a list of them
+    for pseudo-instructions. Lines that do depend on it are returned as a
+    (kind, name) pair, where kind is 'label' for a label definition, '@' for
+    `A := @label` and '$' for `A := $symbol`.
+    """
+    assembler = Assembler()
+    instruction = assembler.assemble_line_fast(line)
+    if instruction is FALLBACK_TO_PARSER:
+        instruction = assembler.assemble_line_with_parser(line + '\n')
+
+    if assembler.instruction_labels:
+        (label, ) = assembler.instruction_labels
+        return ('label', label)
+    if assembler.label_fixups:
+        (_, label) = assembler.label_fixups[0]
+        return ('@', label)
+    # Symbols are only allocated the first time they're used, so anything
+    # that isn't predefined has to be looked up when laying out the program.
+    if len(assembler.symbol_map) > len(DEFAULT_SYMBOLS):
+        return ('$', next(reversed(assembler.symbol_map)))
+    return instruction
+
+
+def layout_decoded_lines(decoded_lines, linenos=None):
+    """Assigns label and symbol addresses for the lines returned by
+    `decode_line`, returning the Program. Returns None if a label is used
+    but never defined or an address doesn't fit in an A-instruction.
+
+    `linenos` is the line number of each of `decoded_lines`, by default they
+    are every line of the source in order."""
+    instruction_labels = {}
+    instruction_index = 0
+    for decoded in decoded_lines:
+        if type(decoded) is tuple and decoded[0] == 'label':
+            instruction_labels[decoded[1]] = instruction_index
+        elif type(decoded) is list:
+            instruction_index += len(decoded)
+        elif decoded is not None:
+            instruction_index += 1
+
+    code = array.array('H')
+    source_map = array.array('I')
+    symbol_map = DEFAULT_SYMBOLS.copy()
+    next_symbol_address = 16
+    # Like `Assembler`, a label defined more than once refers to its latest
+    # definition so far, or its last one if it's used before any of them.
+    defined_labels = {}
+    if linenos is None:
+        linenos = itertools.count(1)
+    for lineno, decoded in zip(linenos, decoded_lines):
+        if decoded is None:
+            continue
+        if type(decoded) is list:
+            code.extend(decoded)
+            source_map.extend([lineno] * len(decoded))
+            continue
+        if type(decoded) is tuple:
+            (kind, name) = decoded
+            if kind == 'label':
+                defined_labels[name] = len(code)
+                continue
+            if kind == '@':
+                if name in defined_labels:
+                    decoded = defined_labels[name]
+                elif name in instruction_labels:
+                    decoded = instruction_labels[name]
+                else:
+                    return None
+            elif name in symbol_map:
+                decoded = symbol_map[name]
+            else:
+                decoded = symbol_map[name] = next_symbol_address
+                next_symbol_address += 1
+            # Leave addresses that don't fit for the parser to report.
+            if decoded > 0x7FFF:
+                return None
+        code.append(decoded)
+        source_map.append(lineno)
+    return Program(code, instruction_labels, symbol_map, source_map)
 
-    ast = parse_and_validate_ast(source)
-    assembled = assemble_ast(ast)
 
-    with assembled_file.open('w') as f:
-        for bitstring in assembled:
-            f.write(bitstring)
-            f.write("\n")
+if __name__ == '__main__':
+    # The command line is in cli.py, `python3 assembler.py` still runs it.
+    # It imports this module as `assembler`, which would otherwise run all
+    # of it again.
+    sys.modules['assembler'] = sys.modules[__name__]
+    import cli
+    sys.exit(cli.main())
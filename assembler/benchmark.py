@@ -0,0 +1,368 @@
+"""Measures how fast the assembler is.
+
+With a number of lines, compares the LALR parser used by the assembler
+against the Earley parser and grammar it replaced, and assembling with the
+fast path against assembling everything through the parser:
+
+    python3 benchmark.py [number of lines]
+
+With `--suite`, assembles generated programs of each of `--sizes` lines in
+fresh processes through the Python API and the command line, measuring
+throughput, peak memory and startup time. Results are saved as JSON and
+compared against a baseline to catch regressions:
+
+    python3 benchmark.py --suite [--sizes 1000 10000] [--output results.json]
+                         [--baseline baseline.json] [--save-baseline]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+from lark import Lark
+
+import assembler
+
+
+# The grammar as it was when parsed with Earley, kept around so we can measure
+# the speedup of the LALR parser against it.
+EARLEY_GRAMMAR = r"""
+%import common.DIGIT -> DIGIT
+%import common.HEXDIGIT -> HEXDIGIT
+%import common.INT -> INT
+%import common.NEWLINE -> NEWLINE
+%import common.CPP_COMMENT -> COMMENT
+%import common.CNAME -> NAME
+
+%import common.WS
+%ignore WS
+%ignore COMMENT
+
+HEX_NUMBER: "0" "x" HEXDIGIT+
+number: HEX_NUMBER -> hex_number
+      | INT        -> decimal_number
+
+a_type_instruction: "A" ":=" number     -> a_const
+                  | "A" ":=" ("@" NAME) -> a_label
+                  | "A" ":=" ("$" NAME) -> a_symbol
+
+LOCATION: "A" | "D" | "*A"
+BINARY_OPERATOR: "+" | "-" | "&" | "|"
+UNARY_OPERATOR: "~" | "-"
+
+computed_value: LOCATION                          -> single_register
+              | LOCATION BINARY_OPERATOR LOCATION -> register_operation
+              | UNARY_OPERATOR LOCATION           -> single_register_operation
+              | LOCATION "+" "1"                  -> plus_one
+              | LOCATION "-" "1"                  -> minus_one
+              | "0"                               -> zero_const
+              | "1"                               -> one_const
+              | "-1"                              -> minus_one_const
+
+assignment: LOCATION ("," LOCATION)* "="
+
+JUMP: "jgt" | "jeq" | "jge" | "jlt" | "jne" | "jle" | "jmp"
+
+c_type_instruction: [assignment] computed_value [";" JUMP]
+
+instruction: a_type_instruction
+           | c_type_instruction
+
+label: NAME ":"
+
+line: instruction
+    | label
+
+start: [line NEWLINE]*
+"""
+
+
+C_INSTRUCTIONS = [
+    'D = A', 'D = *A', 'A = *A', '*A = D', 'D = D + A', 'D = D - *A',
+    '*A, D = *A - 1', 'A = A + 1', '*A = -1', 'D = ~D', 'D; jgt', '0; jmp',
+    'D, A = D | *A', 'A = D & A; jne',
+]
+
+
+@dataclass
+class Mix:
+    """How often each kind of line comes up in a generated program, relative
+    to each other."""
+    a_constant: float = 0.2
+    a_label: float = 0.1
+    a_symbol: float = 0.1
+    c_instruction: float = 0.55
+    label: float = 0.05
+    # Fraction of label references to labels that are only defined later.
+    forward_references: float = 0.5
+    # How many different $symbols are used.
+    symbols: int = 50
+
+    @classmethod
+    def parse(cls, text):
+        """Reads a mix written like 'a_constant=0.3,label=0.1'."""
+        mix = cls()
+        for item in filter(None, text.split(',')):
+            name, _, value = item.partition('=')
+            if name not in cls.__dataclass_fields__:
+                raise ValueError("Unknown kind of line {}".format(name))
+            setattr(mix, name, type(getattr(mix, name))(value))
+        return mix
+
+
+# Labels are only defined while their address still fits in an
+# A-instruction, past that the program only refers back to earlier ones.
+LAST_LABEL_ADDRESS = 0x7FFF - 1
+
+
+def generate_program(num_lines, seed=0, mix=None):
+    """Generates a valid program of roughly `num_lines` lines made up of
+    labels, A-type and C-type instructions in proportions given by `mix`."""
+    mix = mix or Mix()
+    rng = random.Random(seed)
+    kinds = ['a_constant', 'a_label', 'a_symbol', 'c_instruction', 'label']
+    weights = [getattr(mix, kind) for kind in kinds]
+    lines = ['start:']
+    instruction_count = 0
+    defined = []
+    # Labels referred to before they're defined.
+    pending = []
+    for kind in rng.choices(kinds, weights, k=num_lines):
+        can_define = instruction_count < LAST_LABEL_ADDRESS
+        if kind == 'label' or (pending and not can_define):
+            if not can_define:
+                # Define everything that's still pending while it fits.
+                if pending:
+                    lines.extend('{}:'.format(label) for label in pending)
+                    defined.extend(pending)
+                    pending = []
+                continue
+            label = pending.pop(0) if pending else 'label_{}'.format(len(defined) + len(pending))
+            lines.append('{}:'.format(label))
+            defined.append(label)
+            continue
+        if kind == 'a_label':
+            if (not defined or rng.random() < mix.forward_references) and can_define:
+                label = 'label_{}'.format(len(defined) + len(pending))
+                pending.append(label)
+            elif defined:
+                label = rng.choice(defined)
+            else:
+                continue
+            lines.append('   A := @{}'.format(label))
+        elif kind == 'a_symbol':
+            lines.append('   A := $var_{}'.format(rng.randrange(mix.symbols)))
+        elif kind == 'a_constant':
+            lines.append('   A := {}'.format(rng.randint(0, 0x7FFF)))
+        else:
+            lines.append('   ' + rng.choice(C_INSTRUCTIONS))
+        instruction_count += 1
+    # Make sure every label that's been referenced exists.
+    lines.extend('{}:'.format(label) for label in pending)
+    lines.append('   A := @start')
+    lines.append('   0; jmp')
+    return '\n'.join(lines) + '\n'
+
+
+def lines_per_second(parse, source, num_lines):
+    start = time.perf_counter()
+    parse(source)
+    elapsed = time.perf_counter() - start
+    return num_lines / elapsed
+
+
+def compare_parsers(num_lines):
+    source = generate_program(num_lines)
+
+    earley_parser = Lark(EARLEY_GRAMMAR, propagate_positions=True,
+                         maybe_placeholders=True)
+
+    earley = lines_per_second(earley_parser.parse, source, num_lines)
+    lalr = lines_per_second(assembler.get_parser().parse, source, num_lines)
+    print("Parsing {} lines".format(num_lines))
+    print("  earley:    {:>10.0f} lines/s".format(earley))
+    print("  lalr:      {:>10.0f} lines/s ({:.1f}x)".format(lalr, lalr / earley))
+
+    with_parser = lines_per_second(
+        assembler.assemble_with_parser, source, num_lines)
+    fast_path = lines_per_second(assembler.assemble_source, source, num_lines)
+    print("Assembling {} lines".format(num_lines))
+    print("  parser:    {:>10.0f} lines/s".format(with_parser))
+    print("  fast path: {:>10.0f} lines/s ({:.1f}x)".format(
+        fast_path, fast_path / with_parser))
+
+
+# Ways of assembling a source file that the suite measures in a process of
+# their own, so peak memory is only theirs.
+API_CASES = {
+    # The interface the rest of the repo uses, all through Lark.
+    'api': lambda source: assembler.assemble_ast(assembler.parse_and_validate_ast(source)),
+    'fast path': assembler.assemble,
+}
+
+ASSEMBLER = Path(__file__).resolve().parent / 'assembler.py'
+STARTUP = "import assembler; assembler.get_parser()"
+
+
+def run_case(case, source_file):
+    """Runs one of API_CASES in this process, printing how long it took as
+    JSON for `measure` to read."""
+    source = Path(source_file).read_text()
+    # Build the parser first, that's measured as startup.
+    assembler.get_parser()
+    start = time.perf_counter()
+    API_CASES[case](source)
+    print(json.dumps({'seconds': time.perf_counter() - start}))
+
+
+def measure(args):
+    """Runs `args` in a new process, returning the seconds it took, the
+    seconds it reported if it prints them, and its peak RSS in kilobytes."""
+    start = time.perf_counter()
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, cwd=ASSEMBLER.parent)
+    output = process.stdout.read()
+    process.stdout.close()
+    # wait4 gives the resource usage of just this process.
+    (_, status, usage) = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError("{} exited with {}".format(' '.join(args), process.returncode))
+    reported = json.loads(output)['seconds'] if output.startswith(b'{') else elapsed
+    # ru_maxrss is in kilobytes on Linux but bytes on macOS.
+    peak_rss = usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+    return reported, peak_rss
+
+
+@dataclass
+class Result:
+    case: str
+    lines: int
+    seconds: float
+    peak_rss_kb: int
+
+    @property
+    def lines_per_second(self):
+        return self.lines / self.seconds if self.lines else None
+
+
+def run_suite(sizes, mix, repeat=1):
+    """Measures every case on generated programs of each of `sizes` lines.
+    Each is run `repeat` times, keeping the fastest."""
+    def best(case, lines, args):
+        runs = [measure(args) for _ in range(repeat)]
+        (seconds, peak_rss) = min(runs)
+        result = Result(case, lines, seconds, peak_rss)
+        print_result(result)
+        return result
+
+    results = [best('startup', 0, [sys.executable, '-c', STARTUP])]
+    with tempfile.TemporaryDirectory() as directory:
+        for lines in sizes:
+            source_file = Path(directory) / 'Generated{}.asm'.format(lines)
+            source_file.write_text(generate_program(lines, mix=mix))
+            for case in API_CASES:
+                results.append(best(case, lines, [
+                    sys.executable, __file__, '--run-case', case, str(source_file)]))
+            results.append(best('cli', lines, [sys.executable, str(ASSEMBLER), str(source_file)]))
+    return results
+
+
+def print_result(result):
+    throughput = ''
+    if result.lines:
+        throughput = '{:>10.0f} lines/s'.format(result.lines_per_second)
+    print('{:<10} {:>8} {:>9.3f} s {:>16} {:>9} KB'.format(
+        result.case, result.lines or '', result.seconds, throughput, result.peak_rss_kb))
+
+
+def find_regressions(results, baseline, tolerance):
+    """Describes every result that's more than `tolerance` worse than the
+    same one in `baseline`: slower, or using more memory."""
+    previous = {(result['case'], result['lines']): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get((result.case, result.lines))
+        if before is None:
+            continue
+        name = '{} {}'.format(result.case, result.lines) if result.lines else result.case
+        if result.seconds > before['seconds'] * (1 + tolerance):
+            regressions.append('{}: {:.3f} s, was {:.3f} s'.format(
+                name, result.seconds, before['seconds']))
+        if result.peak_rss_kb > before['peak_rss_kb'] * (1 + tolerance):
+            regressions.append('{}: {} KB peak RSS, was {} KB'.format(
+                name, result.peak_rss_kb, before['peak_rss_kb']))
+    return regressions
+
+
+def results_json(results, mix):
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'mix': asdict(mix),
+        'results': [dict(asdict(result), lines_per_second=result.lines_per_second)
+                    for result in results],
+    }
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(prog='benchmark')
+    arg_parser.add_argument(
+        'lines', type=int, nargs='?', default=10_000,
+        help="lines to compare the parsers on, without --suite")
+    arg_parser.add_argument('--suite', action='store_true', help="run the benchmark suite")
+    arg_parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000],
+        help="lines in each generated program, up to 1000000 or so")
+    arg_parser.add_argument(
+        '--mix', type=Mix.parse, default=Mix(),
+        help="proportions of each kind of line, like 'a_label=0.2,label=0.1'")
+    arg_parser.add_argument(
+        '--repeat', type=int, default=1, help="runs of each case, the fastest is kept")
+    arg_parser.add_argument(
+        '--output', type=Path, default=Path('benchmark_results.json'),
+        help="where to save the results")
+    arg_parser.add_argument(
+        '--baseline', type=Path, default=Path('benchmark_baseline.json'),
+        help="results to compare against")
+    arg_parser.add_argument(
+        '--save-baseline', action='store_true', help="save the results as the baseline")
+    arg_parser.add_argument(
+        '--tolerance', type=float, default=0.2,
+        help="how much worse than the baseline a result can be (default: 0.2)")
+    arg_parser.add_argument('--run-case', nargs=2, help=argparse.SUPPRESS)
+    args = arg_parser.parse_args(argv)
+
+    if args.run_case:
+        run_case(*args.run_case)
+        return 0
+    if not args.suite:
+        compare_parsers(args.lines)
+        return 0
+
+    results = run_suite(args.sizes, args.mix, args.repeat)
+    with args.output.open('w') as f:
+        json.dump(results_json(results, args.mix), f, indent=2)
+    if args.save_baseline:
+        with args.baseline.open('w') as f:
+            json.dump(results_json(results, args.mix), f, indent=2)
+        return 0
+    if not args.baseline.exists():
+        print("No baseline at {}, save one with --save-baseline".format(args.baseline))
+        return 0
+    with args.baseline.open() as f:
+        regressions = find_regressions(results, json.load(f), args.tolerance)
+    for regression in regressions:
+        print("REGRESSION " + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
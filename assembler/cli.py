@@ -0,0 +1,349 @@
+"""The assembler's command line, which assembles files into the output
+formats, in batches over several processes or as they change. Usage:
+
+    python3 assembler.py [options] files or directories...
+
+Run with `--help` for the options.
+"""
+import argparse
+import cProfile
+import concurrent.futures
+import contextlib
+import itertools
+import sys
+import textwrap
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+import lark
+
+from assembler import ValidationError, assemble, assemble_lines, collect_labels, get_parser
+from cycles import CycleAnalysis
+from incremental import IncrementalAssembler
+from linker import Linker, ModuleError, has_includes
+from optimizer import assemble_optimized, load_rewrite_rules
+from output_formats import (OUTPUT_FORMATS, open_atomically, update_output_files,
+                            write_output_files)
+from timings import PhaseTimings, phase, record_timings
+
+
+# Shared by every program assembled in this process, so modules included by
+# several of them are only compiled once.
+_linker = Linker()
+
+
+def assemble_program(source_file, source=None):
+    """Assembles the .asm `source_file`, or `source` if it's already been
+    read, into a Program. Programs with `#include` are linked."""
+    if source is None:
+        with source_file.open() as f:
+            source = f.read()
+    if has_includes(source):
+        return _linker.link(source_file, source)
+    return assemble(source)
+
+
+def assemble_file(source_file, output_path=None, formats=('hack', ), stream=False):
+    """Assembles the .asm `source_file` into a file for each of `formats`,
+    named like `output_path` (by default, the source file) with the format's
+    suffix. Returns the number of instructions."""
+    if output_path is None:
+        output_path = source_file
+    if stream:
+        return assemble_file_streaming(source_file, output_path, formats)
+    return assemble_program(source_file).write(output_path, formats)
+
+
+def assemble_file_streaming(source_file, output_path, formats=('hack', )):
+    """Like `assemble_file` but in two passes over the source, writing
+    instructions out as they're encoded."""
+    with source_file.open() as source:
+        with phase('collect labels'):
+            instruction_labels = collect_labels(source)
+        source.seek(0)
+        # Lines are assembled as they're written, so that's timed as writing.
+        return write_output_files(
+            output_path, assemble_lines(source, instruction_labels), formats)
+
+
+@dataclass
+class AssemblyResult:
+    source_file: Path
+    instruction_count: int
+    seconds: float
+    # Why assembling the file failed, None if it succeeded.
+    error: str = None
+    # In watch mode, how many instructions changed since the last version.
+    changed_instructions: int = None
+    # How many instructions the optimizer removed, if it was used.
+    saved_instructions: int = None
+    # Where the time went, if timings were recorded.
+    timings: PhaseTimings = None
+
+
+@dataclass
+class AssemblyOptions:
+    """How `assemble_batch` assembles each file."""
+    formats: tuple = ('hack', )
+    stream: bool = False
+    optimize: bool = False
+    # Rewrite rules to apply when optimizing.
+    rules: dict = None
+    # Write a .lst listing, with the cycle analysis if `cycles` is set.
+    listing: bool = False
+    cycles: bool = False
+    # Record the PhaseTimings of each file.
+    timings: bool = False
+
+
+# Seconds between checks for changed files in watch mode.
+WATCH_INTERVAL = 0.25
+
+
+def write_listing(source_file, program, source, cycles=False):
+    """Writes the listing of `program`, assembled from `source_file`, next to
+    it with the .lst suffix. With `cycles` it's the listing from
+    `CycleAnalysis`."""
+    if program.modules is not None:
+        source = {path: source if path == source_file else path.read_text()
+                  for (path, _) in program.modules}
+    with phase('listing'), open_atomically(source_file.with_suffix('.lst')) as f:
+        if cycles:
+            f.write(CycleAnalysis(program).listing(source))
+        else:
+            f.write(program.listing(source))
+
+
+def _assemble_job(source_file, options):
+    start = time.perf_counter()
+    timings = record_timings() if options.timings else contextlib.nullcontext()
+    with timings as timings:
+        result = _assemble_file_with_options(source_file, options)
+    result.seconds = time.perf_counter() - start
+    result.timings = timings
+    return result
+
+
+def _assemble_file_with_options(source_file, options):
+    saved_instructions = None
+    try:
+        if options.optimize or options.listing or options.cycles:
+            source = source_file.read_text()
+            if options.optimize:
+                if has_includes(source):
+                    raise ValueError("Programs with #include can't be optimized")
+                program, report = assemble_optimized(source, options.rules)
+                saved_instructions = report.saved
+            else:
+                program = assemble_program(source_file, source)
+            instruction_count = program.write(source_file, options.formats)
+            if options.listing or options.cycles:
+                write_listing(source_file, program, source, options.cycles)
+        else:
+            instruction_count = assemble_file(
+                source_file, formats=options.formats, stream=options.stream)
+    except (ValidationError, ModuleError, lark.exceptions.LarkError, OSError,
+            ValueError) as e:
+        return AssemblyResult(source_file, 0, None, str(e))
+    return AssemblyResult(source_file, instruction_count, None,
+                          saved_instructions=saved_instructions)
+
+
+def find_sources(paths):
+    """Expands any directories in `paths` into the .asm files under them."""
+    source_files = []
+    for path in paths:
+        if path.is_dir():
+            source_files.extend(sorted(path.rglob('*.asm')))
+        else:
+            source_files.append(path)
+    return source_files
+
+
+def assemble_batch(source_files, jobs=1, **options):
+    """Assembles each of `source_files` into files next to it, spread over
+    `jobs` worker processes. `options` are the fields of AssemblyOptions.
+    Yields an AssemblyResult for each file, in the same order as
+    `source_files`."""
+    options = AssemblyOptions(**options)
+    if jobs == 1:
+        for source_file in source_files:
+            yield _assemble_job(source_file, options)
+        return
+
+    # Every worker builds the parser once up front and reuses it for all of
+    # the files it gets.
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=get_parser) as executor:
+        yield from executor.map(_assemble_job, source_files, itertools.repeat(options))
+
+
+class Watcher:
+    """Reassembles source files whenever they change, with an
+    IncrementalAssembler per file, and updates only the parts of their
+    output files that changed."""
+    def __init__(self, source_files, formats=('hack', )):
+        self.source_files = source_files
+        self.formats = formats
+        self.assemblers = {path: IncrementalAssembler() for path in source_files}
+        self.last_modified = {}
+        # The code that's currently in each file's output files.
+        self.written_code = {}
+
+    def poll(self):
+        """Reassembles every file that changed since the last poll, or every
+        file on the first poll, yielding an AssemblyResult for each."""
+        for source_file in self.source_files:
+            try:
+                stat = source_file.stat()
+                last_modified = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                last_modified = None
+            if self.last_modified.get(source_file, ()) == last_modified:
+                continue
+            self.last_modified[source_file] = last_modified
+            yield self.reassemble(source_file)
+
+    def reassemble(self, source_file):
+        start = time.perf_counter()
+        try:
+            program = self.assemblers[source_file].update(source_file.read_text())
+            written_code = self.written_code.pop(source_file, None)
+            if written_code is None:
+                changed = program.write(source_file, self.formats)
+            else:
+                changed = update_output_files(
+                    source_file, written_code, program.code, self.formats)
+            self.written_code[source_file] = program.code
+        except (ValidationError, lark.exceptions.LarkError, OSError, ValueError) as e:
+            return AssemblyResult(source_file, 0, time.perf_counter() - start, str(e))
+        return AssemblyResult(source_file, len(program),
+                              time.perf_counter() - start,
+                              changed_instructions=changed)
+
+
+def print_result(result):
+    milliseconds = result.seconds * 1000
+    if result.error is not None:
+        print("FAILED {} ({:.1f} ms)".format(result.source_file, milliseconds))
+        print(textwrap.indent(result.error, '    '))
+        return
+
+    details = ["{} instructions".format(result.instruction_count)]
+    if result.changed_instructions is not None:
+        details.append("{} changed".format(result.changed_instructions))
+    if result.saved_instructions is not None:
+        details.append("{} saved".format(result.saved_instructions))
+    details.append("{:.1f} ms".format(milliseconds))
+    print("ok     {} ({})".format(result.source_file, ', '.join(details)))
+
+
+def watch(source_files, formats=('hack', )):
+    """Assembles `source_files` and then keeps reassembling them as they
+    change, until interrupted."""
+    watcher = Watcher(source_files, formats)
+    try:
+        while True:
+            for result in watcher.poll():
+                print_result(result)
+            time.sleep(WATCH_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(prog='assembler')
+    arg_parser.add_argument(
+        'sources', type=Path, nargs='+',
+        help=".asm files, or directories to assemble all .asm files under")
+    arg_parser.add_argument(
+        '--stream', action='store_true',
+        help="assemble line by line to keep memory use flat on huge sources")
+    arg_parser.add_argument(
+        '--jobs', '-j', type=int, default=1,
+        help="number of files to assemble in parallel")
+    arg_parser.add_argument(
+        '--format', '-f', dest='formats', action='append',
+        choices=OUTPUT_FORMATS,
+        help="output format, can be given multiple times (default: hack)")
+    arg_parser.add_argument(
+        '--watch', action='store_true',
+        help="keep running and reassemble files whenever they change")
+    arg_parser.add_argument(
+        '--optimize', '-O', action='store_true',
+        help="remove redundant and unreachable instructions")
+    arg_parser.add_argument(
+        '--listing', action='store_true',
+        help="also write a .lst file listing every instruction's address and "
+             "encoding next to its source")
+    arg_parser.add_argument(
+        '--cycles', action='store_true',
+        help="write a .lst listing with how many cycles it takes to get through "
+             "each instruction, and the cycles taken by loops and paths")
+    arg_parser.add_argument(
+        '--rules', type=Path,
+        help="rewrite rules found by superoptimizer.py to apply when optimizing")
+    arg_parser.add_argument(
+        '--timings', action='store_true',
+        help="print the time and memory blocks allocated in each phase")
+    arg_parser.add_argument(
+        '--profile', type=Path, metavar='FILE',
+        help="profile assembling with cProfile and save the stats to FILE")
+    args = arg_parser.parse_args(argv)
+    formats = args.formats or ['hack']
+    if args.watch and args.stream:
+        arg_parser.error("--watch can't be used with --stream")
+    if args.optimize and (args.watch or args.stream):
+        arg_parser.error("--optimize can't be used with --watch or --stream")
+    if (args.listing or args.cycles) and (args.watch or args.stream):
+        arg_parser.error("--listing and --cycles can't be used with --watch or --stream")
+    if args.rules and not args.optimize:
+        arg_parser.error("--rules can only be used with --optimize")
+    if (args.timings or args.profile) and args.watch:
+        arg_parser.error("--timings and --profile can't be used with --watch")
+    if args.jobs < 1:
+        arg_parser.error("--jobs has to be at least 1")
+    if args.profile and args.jobs != 1:
+        arg_parser.error("--profile can only be used with --jobs 1")
+    rules = None
+    if args.rules:
+        try:
+            rules = load_rewrite_rules(args.rules)
+        except (OSError, ValueError) as e:
+            arg_parser.error("can't read rules: {}".format(e))
+
+    source_files = find_sources(args.sources)
+    if args.watch:
+        watch(source_files, formats)
+        return 0
+
+    profiler = cProfile.Profile() if args.profile else None
+    timings = PhaseTimings()
+    start = time.perf_counter()
+    assembled = failed = 0
+    results = assemble_batch(
+        source_files, args.jobs, formats=formats, stream=args.stream,
+        optimize=args.optimize, rules=rules, listing=args.listing,
+        cycles=args.cycles, timings=args.timings)
+    with profiler or contextlib.nullcontext():
+        for result in results:
+            print_result(result)
+            if result.timings is not None:
+                timings.merge(result.timings)
+            if result.error is not None:
+                failed += 1
+            else:
+                assembled += 1
+
+    print("{} assembled, {} failed in {:.2f} s".format(
+        assembled, failed, time.perf_counter() - start))
+    if args.timings:
+        print(timings)
+    if profiler is not None:
+        profiler.dump_stats(args.profile)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
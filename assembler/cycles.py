@@ -0,0 +1,273 @@
+"""Static analysis of how many cycles a program takes, for `--cycles`."""
+from dataclasses import dataclass
+
+from assembler import DESTINATIONS, JUMP_MASK, JUMPS, evaluate
+
+
+# A taken jump costs an extra cycle: `pc_load` in architecture/cpu/cpu.v is
+# registered, so the PC only takes the new address on the cycle after the
+# jump. The instruction after the jump still runs during that cycle.
+TAKEN_JUMP_PENALTY = 1
+
+
+def jump_taken(instruction, output):
+    """Whether the C-instruction `instruction` jumps when the ALU outputs
+    `output`."""
+    if output & 0x8000:
+        return bool(instruction & JUMPS['jlt'])
+    if output == 0:
+        return bool(instruction & JUMPS['jeq'])
+    return bool(instruction & JUMPS['jgt'])
+
+
+@dataclass
+class BasicBlock:
+    start: int
+    # Address after the last instruction in the block.
+    end: int
+    # Where the jump at the end of the block goes to, if it has one and its
+    # target is known.
+    target: int = None
+    # Whether it can run on into the next block, or take the jump.
+    falls_through: bool = True
+    jumps: bool = False
+    # Whether the jump at the end goes somewhere that isn't known, such as
+    # an address loaded from memory.
+    indirect: bool = False
+
+    def cycles(self, taken):
+        return self.end - self.start + (TAKEN_JUMP_PENALTY if taken else 0)
+
+    def successors(self):
+        """(block start, whether the jump was taken) of the blocks that can
+        run after this one."""
+        if self.jumps and self.target is not None:
+            yield self.target, True
+        if self.falls_through:
+            yield self.end, False
+
+
+@dataclass
+class Loop:
+    # Start of the block the loop jumps back to.
+    header: int
+    # Starts of every block in the loop.
+    blocks: list
+    # Fewest and most cycles an iteration can take, counting any loops
+    # inside it as one iteration.
+    min_cycles: int
+    max_cycles: int
+
+
+class CycleAnalysis:
+    """Works out how many cycles a Program takes to run.
+
+    The program is split into basic blocks, with jumps going to the address
+    an A-instruction (normally `A := @label`) loads just before them. Every
+    instruction takes one cycle and a taken jump one more. Blocks are ordered
+    depth-first from the start of the program, jumps back to an earlier block
+    close a loop. Paths through the program are costed without going round
+    loops, loops are costed per iteration.
+    """
+    def __init__(self, program):
+        self.program = program
+        self.blocks = self.find_blocks()
+        self.order = self.depth_first_order()
+        position = {start: i for i, start in enumerate(self.order)}
+        # Jumps back to earlier blocks, which close loops.
+        self.back_edges = [
+            (start, successor) for start in self.order
+            for successor, _ in self.blocks[start].successors()
+            if successor in position and position[successor] <= position[start]]
+        self.min_entry, self.max_entry = self.path_cycles(self.order, self.program_entry())
+        self.loops = self.find_loops()
+
+    def program_entry(self):
+        return {0: 0} if self.program.code else {}
+
+    def find_blocks(self):
+        code = self.program.code
+        starts = {0} | {address for address in self.program.labels.values()
+                        if address < len(code)}
+        for address, instruction in enumerate(code):
+            if instruction & 0x8000 and instruction & JUMP_MASK:
+                starts.add(address + 1)
+                if address > 0 and not code[address - 1] & 0x8000:
+                    starts.add(code[address - 1])
+        starts = sorted(start for start in starts if start < len(code))
+
+        blocks = {}
+        for start, end in zip(starts, starts[1:] + [len(code)]):
+            block = BasicBlock(start, end)
+            last = code[end - 1]
+            if last & 0x8000 and last & JUMP_MASK:
+                output = evaluate(last, None, None)
+                if output is None:
+                    block.jumps = True
+                    block.falls_through = last & JUMP_MASK != JUMPS['jmp']
+                else:
+                    block.jumps = jump_taken(last, output)
+                    block.falls_through = not block.jumps
+                loaded = code[end - 2] if end - 2 >= start else None
+                # A jump goes to A as it was before the jump instruction.
+                if loaded is not None and not loaded & 0x8000 and loaded < len(code):
+                    block.target = loaded
+                else:
+                    block.indirect = block.jumps
+            block.falls_through = block.falls_through and end < len(code)
+            blocks[start] = block
+        return blocks
+
+    def depth_first_order(self):
+        """Starts of the blocks reachable from the start of the program, in
+        reverse postorder."""
+        if not self.blocks:
+            return []
+        postorder = []
+        visited = {0}
+        stack = [(0, iter(self.blocks[0].successors()))]
+        while stack:
+            (start, successors) = stack[-1]
+            for successor, _ in successors:
+                if successor not in visited:
+                    visited.add(successor)
+                    stack.append((successor, iter(self.blocks[successor].successors())))
+                    break
+            else:
+                stack.pop()
+                postorder.append(start)
+        return postorder[::-1]
+
+    def path_cycles(self, blocks, entry):
+        """Fewest and most cycles to get to the start of each of `blocks`,
+        given in depth-first order, from the cycles of the `entry` blocks.
+        Jumps back to earlier blocks are left out, so loops aren't gone
+        round."""
+        back_edges = set(self.back_edges)
+        fewest = dict(entry)
+        most = dict(entry)
+        members = set(blocks)
+        for start in blocks:
+            if start not in fewest:
+                continue
+            block = self.blocks[start]
+            for successor, taken in block.successors():
+                if (start, successor) in back_edges or successor not in members:
+                    continue
+                cycles = block.cycles(taken)
+                fewest[successor] = min(fewest.get(successor, fewest[start] + cycles),
+                                        fewest[start] + cycles)
+                most[successor] = max(most.get(successor, 0), most[start] + cycles)
+        return fewest, most
+
+    def find_loops(self):
+        bodies = {}
+        predecessors = {}
+        for start in self.order:
+            for successor, _ in self.blocks[start].successors():
+                predecessors.setdefault(successor, []).append(start)
+        for source, header in self.back_edges:
+            body = bodies.setdefault(header, {header})
+            pending = [source]
+            while pending:
+                start = pending.pop()
+                if start not in body:
+                    body.add(start)
+                    pending.extend(predecessors.get(start, []))
+
+        loops = []
+        for header, body in sorted(bodies.items()):
+            blocks = [start for start in self.order if start in body]
+            fewest, most = self.path_cycles(blocks, {header: 0})
+            iterations = [
+                (fewest[source] + self.blocks[source].cycles(taken),
+                 most[source] + self.blocks[source].cycles(taken))
+                for source in blocks if source in fewest
+                for successor, taken in self.blocks[source].successors()
+                if successor == header and (source, header) in self.back_edges]
+            loops.append(Loop(header, blocks, min(i for i, _ in iterations),
+                              max(i for _, i in iterations)))
+        return loops
+
+    def instruction_cycles(self):
+        """For every instruction, the fewest cycles it takes to get to the end
+        of it from the start of the program without going round loops. None
+        for instructions that can't be reached."""
+        cycles = [None] * len(self.program.code)
+        for start, entry in self.min_entry.items():
+            for address in range(start, self.blocks[start].end):
+                cycles[address] = entry + address - start + 1
+        return cycles
+
+    def exits(self):
+        """Where the program stops being followed, as (how, block start)
+        where how is 'halts' for blocks that jump to themselves forever,
+        'jumps' for ones that jump somewhere unknown and 'ends' for the one
+        that runs off the end of the program."""
+        exits = []
+        for start in self.order:
+            block = self.blocks[start]
+            if list(block.successors()) == [(start, True)]:
+                exits.append(('halts', start))
+            elif block.indirect:
+                exits.append(('jumps', start))
+            elif block.end == len(self.program.code) and not block.jumps:
+                exits.append(('ends', start))
+        return exits
+
+    def delay_slot_hazards(self):
+        """Addresses of instructions that run in the cycle after a taken jump
+        and change D or memory, or jump themselves."""
+        hazards = []
+        for start in self.order:
+            block = self.blocks[start]
+            if not block.jumps or block.end >= len(self.program.code):
+                continue
+            instruction = self.program.code[block.end]
+            if instruction & 0x8000 and instruction & (
+                    DESTINATIONS['D'] | DESTINATIONS['*A'] | JUMP_MASK):
+                hazards.append(block.end)
+        return hazards
+
+    def describe(self, address):
+        names = [label for label, label_address in self.program.labels.items()
+                 if label_address == address]
+        return '{:04X}'.format(address) + (' ({})'.format(', '.join(names)) if names else '')
+
+    def summary(self):
+        lines = []
+        for loop in self.loops:
+            lines.append('Loop at {}: {} block{}, {} cycles per iteration'.format(
+                self.describe(loop.header), len(loop.blocks),
+                '' if len(loop.blocks) == 1 else 's',
+                cycle_range(loop.min_cycles, loop.max_cycles)))
+        for how, start in self.exits():
+            block = self.blocks[start]
+            if how == 'halts':
+                (fewest, most) = (self.min_entry[start], self.max_entry[start])
+                where = 'Halts at {}'.format(self.describe(start))
+            else:
+                cycles = block.cycles(how == 'jumps')
+                (fewest, most) = (self.min_entry[start] + cycles,
+                                  self.max_entry[start] + cycles)
+                if how == 'jumps':
+                    where = 'Jumps from {} to an unknown address'.format(
+                        self.describe(block.end - 1))
+                else:
+                    where = 'Runs off the end'
+            lines.append('{} after {} cycles, not counting loops'.format(
+                where, cycle_range(fewest, most)))
+        for address in self.delay_slot_hazards():
+            lines.append('Instruction at {} still runs when the jump before it '
+                         'is taken'.format(self.describe(address)))
+        return lines
+
+    def listing(self, source):
+        """The program's listing with the cycles from `instruction_cycles`,
+        followed by a summary of its loops and paths."""
+        return self.program.listing(source, self.instruction_cycles()) + ''.join(
+            '// {}\n'.format(line) for line in self.summary())
+
+
+def cycle_range(fewest, most):
+    return str(fewest) if fewest == most else '{} to {}'.format(fewest, most)
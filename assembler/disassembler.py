@@ -0,0 +1,134 @@
+"""Turns Hack machine code back into assembly.
+
+Every 16-bit word is disassembled ahead of time into a table built from the
+assembler's computation, destination and jump tables, so disassembling a
+ROM image is one lookup per word. The output assembles back to the same
+words. Usage:
+
+    python3 disassembler.py [--addresses] rom.hack
+"""
+import argparse
+import re
+import sys
+from pathlib import Path
+
+from assembler import COMPUTATIONS, DESTINATIONS, JUMPS, validate_register_operation
+from output_formats import read_rom
+
+
+BINARY_OPERATION = re.compile(r'(\*?[AD])([-+&|])(\*?[AD]|1)')
+
+
+def _computation_preference(text):
+    """Sort key for picking which of the computations encoded the same way
+    to write out. Ones that only come out the same by quirk of the encoding,
+    like D + D which is encoded as D + A, go last. D goes first as in the
+    book."""
+    operation = BINARY_OPERATION.fullmatch(text)
+    if operation is None:
+        return (0, 0)
+    (x, _, y) = operation.groups()
+    return (x == y, x != 'D')
+
+
+def computation_text(text):
+    """Writes out a computation from the table with spaces around operators,
+    such as 'D + *A'."""
+    operation = BINARY_OPERATION.fullmatch(text)
+    if operation is None:
+        return text
+    return ' '.join(operation.groups())
+
+
+def _build_computation_texts():
+    """The text to write out for each encoded computation, leaving out the
+    ones the assembler rejects."""
+    candidates = {}
+    for text, encoded in COMPUTATIONS.items():
+        operation = BINARY_OPERATION.fullmatch(text)
+        if operation is not None:
+            try:
+                validate_register_operation(operation.group(1), operation.group(3))
+            except ValueError:
+                continue
+        candidates.setdefault(encoded, []).append(text)
+    return {encoded: computation_text(min(texts, key=_computation_preference))
+            for encoded, texts in candidates.items()}
+
+
+def _build_disassembly_table():
+    """Assembly for all 65536 words, None for the C-instructions that can't
+    be written in assembly: those with bits 14 and 13 cleared, or with ALU
+    control bits no computation is encoded to."""
+    table = ['A := {}'.format(constant) for constant in range(1 << 15)]
+    table += [None] * (1 << 15)
+    destination_names = list(DESTINATIONS.items())
+    for encoded, computation in _build_computation_texts().items():
+        for destination in range(1 << 3):
+            bits = destination << 3
+            names = [name for name, bit in destination_names if bits & bit]
+            assignment = '{} = '.format(', '.join(names)) if names else ''
+            table[encoded | bits] = assignment + computation
+            for jump, jump_bits in JUMPS.items():
+                table[encoded | bits | jump_bits] = '{}{}; {}'.format(
+                    assignment, computation, jump)
+    return tuple(table)
+
+
+DISASSEMBLY = _build_disassembly_table()
+
+
+def disassemble_word(instruction):
+    """Assembly for a single word, or None if it can't be written."""
+    return DISASSEMBLY[instruction]
+
+
+def words(code):
+    """A view of `code`, any object supporting the buffer protocol, as 16-bit
+    words. Raw bytes are read as words in the machine's byte order."""
+    view = memoryview(code)
+    if view.format != 'H':
+        view = view.cast('B').cast('H')
+    return view
+
+
+def disassemble(code):
+    """Assembly for every word in `code`, such as a `Program.code` array, a
+    numpy uint16 array or the bytes of a ROM image."""
+    return list(map(DISASSEMBLY.__getitem__, words(code)))
+
+
+def disassembly(code, addresses=False):
+    """A source file for `code` that assembles back to it. Words that can't
+    be written in assembly are left as comments, which throws the addresses
+    after them off."""
+    lines = []
+    for address, word in enumerate(words(code)):
+        text = DISASSEMBLY[word]
+        if text is None:
+            text = '// {:04X} has no assembly'.format(word)
+        elif addresses:
+            text = '{:<24}// {:04X}'.format(text, address)
+        lines.append(text + '\n')
+    return ''.join(lines)
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(prog='disassembler')
+    arg_parser.add_argument(
+        'rom', type=Path,
+        help="ROM image to disassemble, as .hack, .bin, .be.bin or .mem")
+    arg_parser.add_argument(
+        '--addresses', action='store_true',
+        help="note each instruction's address in a comment")
+    args = arg_parser.parse_args(argv)
+    try:
+        code = read_rom(args.rom)
+    except (OSError, ValueError) as e:
+        arg_parser.error(str(e))
+    sys.stdout.write(disassembly(code, args.addresses))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
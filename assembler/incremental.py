@@ -0,0 +1,63 @@
+"""Reassembles a source as it's edited, for `--watch`."""
+import lark
+from lark.exceptions import VisitError
+
+from assembler import assemble_with_parser, decode_line, layout_decoded_lines
+
+
+class IncrementalAssembler:
+    """Reassembles a source every time it changes, only parsing the lines
+    that are different from the last version.
+
+    Every line is decoded on its own with `decode_line` and the decoded lines
+    of the last version are kept. After an edit only the lines between the
+    unchanged start and end of the source get decoded again. Laying out the
+    program, where labels and symbols get their addresses, is redone each
+    time since a single edit can move every label after it.
+    """
+    def __init__(self):
+        self.lines = []
+        self.decoded_lines = []
+        # The last successfully assembled program.
+        self.program = None
+
+    def update(self, assembly):
+        """Assembles the new version of the source, returning its Program.
+        Invalid sources raise ValidationError just like `assemble`."""
+        lines = assembly.split('\n')
+
+        common_length = min(len(lines), len(self.lines))
+        prefix = 0
+        while prefix < common_length and lines[prefix] == self.lines[prefix]:
+            prefix += 1
+        suffix = 0
+        while (suffix < common_length - prefix and
+               lines[-suffix - 1] == self.lines[-suffix - 1]):
+            suffix += 1
+
+        try:
+            changed = [decode_line(line)
+                       for line in lines[prefix:len(lines) - suffix]]
+        except (VisitError, lark.exceptions.UnexpectedInput):
+            return self.assemble_from_scratch(assembly)
+        decoded_lines = (self.decoded_lines[:prefix] + changed +
+                         self.decoded_lines[len(self.decoded_lines) - suffix:])
+
+        program = layout_decoded_lines(decoded_lines)
+        if program is None:
+            return self.assemble_from_scratch(assembly)
+        self.lines = lines
+        self.decoded_lines = decoded_lines
+        self.program = program
+        return program
+
+    def assemble_from_scratch(self, assembly):
+        # Errors are reported by the whole source parser like `assemble` does.
+        # It also accepts instructions split over several lines, which can't
+        # be decoded line by line. Those sources are simply parsed in full
+        # every time.
+        program = assemble_with_parser(assembly)
+        self.lines = []
+        self.decoded_lines = []
+        self.program = program
+        return program
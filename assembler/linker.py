@@ -0,0 +1,300 @@
+"""Assembles programs split over several files with `#include`, compiling
+each module on its own and linking them into one Program."""
+import array
+import concurrent.futures
+import hashlib
+import re
+from dataclasses import dataclass
+
+import lark
+from lark.exceptions import VisitError
+
+from assembler import (DEFAULT_SYMBOLS, GRAMMAR, LABEL_LINE, Program, ValidationError,
+                       decode_line, get_parser, make_validation_error, validate_address)
+from timings import phase
+
+
+# `#include "path"` makes another module, with the path relative to the
+# including file, part of the program.
+INCLUDE_LINE = re.compile(r'[ \t\f\r]*#include[ \t\f\r]+"([^"]*)"[ \t\f\r]*(//.*)?\n?')
+
+
+# Mixed into the hash that compiled modules are cached under, bump it when
+# the way modules are compiled changes.
+OBJECT_VERSION = '1'
+
+
+@dataclass
+class ObjectModule:
+    """A module assembled on its own by `compile_module`.
+
+    A-instructions whose value depends on where the module ends up in the
+    program are left as zero in `code`, the linker fills them in from the
+    references.
+    """
+    code: array.array
+    source_map: array.array
+    # Include paths exactly as written.
+    includes: list
+    # Module relative address of each label defined in the module.
+    labels: dict
+    # `A := @label` where the label is in this module, as (instruction index,
+    # label, module relative address).
+    local_references: list
+    # `A := @label` where the label is in some other module, as (instruction
+    # index, label).
+    external_references: list
+    # Every `A := $symbol` in order, as (instruction index, symbol).
+    symbol_references: list
+
+
+class ModuleError(Exception):
+    """An error in one of the modules of a linked program."""
+    def __init__(self, path, error):
+        super().__init__(path, error)
+        self.path = path
+        self.error = error
+
+    def __str__(self):
+        return 'In {}:\n{}'.format(self.path, self.error)
+
+
+def line_error(message, line, lineno):
+    """ValidationError for a problem with a whole line, found without parsing
+    it."""
+    code = line.split('//', 1)[0].rstrip()
+    col_start = len(code) - len(code.lstrip()) + 1
+    return ValidationError(message, line, lineno, col_start, len(code) + 1)
+
+
+def compile_module(assembly):
+    """Validates and assembles `assembly` into an ObjectModule. Like
+    `assemble_lines`, every instruction must be on a single line."""
+    decoded_lines = []
+    includes = []
+    for lineno, line in enumerate(assembly.split('\n'), start=1):
+        include = INCLUDE_LINE.fullmatch(line)
+        if include:
+            includes.append(include.group(1))
+            decoded_lines.append(None)
+            continue
+        try:
+            decoded_lines.append(decode_line(line))
+        except lark.exceptions.UnexpectedInput as e:
+            e.line = lineno
+            raise
+        except VisitError as e:
+            raise make_validation_error(e, line, first_lineno=lineno) from None
+
+    labels = {}
+    instruction_index = 0
+    for decoded in decoded_lines:
+        if type(decoded) is tuple and decoded[0] == 'label':
+            labels[decoded[1]] = instruction_index
+        elif type(decoded) is list:
+            instruction_index += len(decoded)
+        elif decoded is not None:
+            instruction_index += 1
+
+    module = ObjectModule(array.array('H'), array.array('I'), includes, labels,
+                          [], [], [])
+    # References pick the label's definitions the same way `Assembler` does.
+    defined_labels = {}
+    for lineno, decoded in enumerate(decoded_lines, start=1):
+        if decoded is None:
+            continue
+        if type(decoded) is list:
+            module.code.extend(decoded)
+            module.source_map.extend([lineno] * len(decoded))
+            continue
+        if type(decoded) is tuple:
+            (kind, name) = decoded
+            index = len(module.code)
+            if kind == 'label':
+                defined_labels[name] = index
+                continue
+            if kind == '@' and name in defined_labels:
+                module.local_references.append((index, name, defined_labels[name]))
+            elif kind == '@' and name in labels:
+                module.local_references.append((index, name, labels[name]))
+            elif kind == '@':
+                module.external_references.append((index, name))
+            else:
+                module.symbol_references.append((index, name))
+            decoded = 0
+        module.code.append(decoded)
+        module.source_map.append(lineno)
+    return module
+
+
+def _compile_module_job(assembly):
+    try:
+        return compile_module(assembly)
+    except (ValidationError, lark.exceptions.LarkError):
+        # Not every error can be sent back from a worker process, so these
+        # are left for the linker to reproduce itself.
+        return None
+
+
+class Linker:
+    """Assembles programs split over several modules, one .asm file each.
+
+    The main file and every module it includes, directly or through other
+    modules, are compiled into ObjectModules, in parallel over `jobs`
+    processes. They're then laid out one after another, the main file first
+    and the rest in the order they're first included. The result is the same
+    as assembling all of the modules pasted together in that order, except
+    that a label can only be defined in one module.
+
+    Compiled modules are cached by a hash of their source, so modules that
+    are shared between programs or haven't changed since the last link are
+    only compiled once.
+    """
+    def __init__(self, jobs=1):
+        self.jobs = jobs
+        self.object_cache = {}
+
+    def find_modules(self, main_file, main_source=None):
+        """Returns the (path, source) of every module of the program, in the
+        order they're laid out."""
+        if main_source is None:
+            main_source = main_file.read_text()
+        modules = [(main_file, main_source)]
+        seen = {main_file.resolve()}
+        # Modules are visited depth first, each one's includes come right
+        # after it unless they've already been included.
+        for path, source in modules_depth_first(modules[0], seen):
+            modules.append((path, source))
+        return modules
+
+    def compile_modules(self, modules):
+        """Returns an ObjectModule for each (path, source) in `modules`."""
+        digests = [module_digest(source) for (_, source) in modules]
+        missing = {}
+        for (path, source), digest in zip(modules, digests):
+            if digest not in self.object_cache:
+                missing[digest] = (path, source)
+
+        if self.jobs > 1 and len(missing) > 1:
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.jobs, initializer=get_parser) as executor:
+                sources = [source for (_, source) in missing.values()]
+                objects = list(executor.map(_compile_module_job, sources))
+        else:
+            objects = [None] * len(missing)
+
+        for (digest, (path, source)), module in zip(missing.items(), objects):
+            if module is None:
+                try:
+                    module = compile_module(source)
+                except (ValidationError, lark.exceptions.LarkError) as e:
+                    raise ModuleError(path, e) from None
+            self.object_cache[digest] = module
+        return [self.object_cache[digest] for digest in digests]
+
+    def link(self, main_file, main_source=None):
+        """Compiles and links the program starting at `main_file`, whose
+        source can be passed in if it's already been read. Returns a
+        Program."""
+        with phase('find modules'):
+            modules = self.find_modules(main_file, main_source)
+        with phase('compile modules'):
+            objects = self.compile_modules(modules)
+        with phase('link'):
+            return link_modules(
+                [(path, source, module) for ((path, source), module) in zip(modules, objects)])
+
+
+def module_digest(source):
+    return hashlib.sha256((OBJECT_VERSION + GRAMMAR + source).encode()).hexdigest()
+
+
+def has_includes(source):
+    """Whether any line of `source` is an `#include`, as opposed to
+    mentioning one in a comment."""
+    return any(INCLUDE_LINE.fullmatch(line) for line in source.split('\n'))
+
+
+def modules_depth_first(module, seen):
+    """Yields the (path, source) of the modules included by `module`, and
+    the ones they include, skipping the ones in `seen`."""
+    (path, source) = module
+    for lineno, line in enumerate(source.split('\n'), start=1):
+        include = INCLUDE_LINE.fullmatch(line)
+        if not include:
+            continue
+        included_path = path.parent / include.group(1)
+        if included_path.resolve() in seen:
+            continue
+        seen.add(included_path.resolve())
+        try:
+            included = (included_path, included_path.read_text())
+        except OSError as e:
+            error = line_error("Can't read included module ({})".format(e.strerror),
+                               line, lineno)
+            raise ModuleError(path, error) from None
+        yield included
+        yield from modules_depth_first(included, seen)
+
+
+def link_modules(modules):
+    """Lays out the (path, source, ObjectModule) `modules` one after another
+    and fills in their label and symbol addresses, returning the Program."""
+    labels = {}
+    label_modules = {}
+    starts = []
+    start = 0
+    for path, source, module in modules:
+        starts.append(start)
+        for label, address in module.labels.items():
+            if label in labels:
+                lineno = find_label_definition(source, label)
+                error = line_error("Label {} already defined in {}".format(
+                    label, label_modules[label]), source.split('\n')[lineno - 1], lineno)
+                raise ModuleError(path, error)
+            labels[label] = start + address
+            label_modules[label] = path
+        start += len(module.code)
+
+    code = array.array('H')
+    source_map = array.array('I')
+    symbol_map = DEFAULT_SYMBOLS.copy()
+    next_symbol_address = 16
+    for (path, source, module), start in zip(modules, starts):
+        addresses = []
+        for index, label, address in module.local_references:
+            addresses.append((index, 'Label', label, start + address))
+        for index, label in module.external_references:
+            addresses.append((index, 'Label', label, labels.get(label)))
+        # Symbols are allocated in the order they're first used.
+        for index, symbol in module.symbol_references:
+            if symbol not in symbol_map:
+                symbol_map[symbol] = next_symbol_address
+                next_symbol_address += 1
+            addresses.append((index, 'Symbol', symbol, symbol_map[symbol]))
+
+        module_code = array.array('H', module.code)
+        for index, kind, name, address in addresses:
+            try:
+                if address is None:
+                    raise ValueError("Label {} used but never defined".format(name))
+                validate_address(kind, name, address)
+            except ValueError as e:
+                lineno = module.source_map[index]
+                error = line_error(str(e), source.split('\n')[lineno - 1], lineno)
+                raise ModuleError(path, error) from None
+            module_code[index] = address
+        code.extend(module_code)
+        source_map.extend(module.source_map)
+
+    return Program(code, labels, symbol_map, source_map,
+                   [(path, start) for ((path, _, _), start) in zip(modules, starts)])
+
+
+def find_label_definition(source, label):
+    """Line number of the first definition of `label` in `source`."""
+    for lineno, line in enumerate(source.split('\n'), start=1):
+        match = LABEL_LINE.fullmatch(line)
+        if match and match.group(1) == label:
+            return lineno
+    return 1
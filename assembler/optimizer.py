@@ -0,0 +1,441 @@
+"""Optimizes programs for `--optimize`: the PeepholeOptimizer removes
+instructions that make no difference, and rewrite rules from
+superoptimizer.py replace runs of instructions with shorter ones."""
+import collections
+import itertools
+import json
+from dataclasses import dataclass
+
+import lark
+from lark.exceptions import VisitError
+
+from assembler import (DESTINATION_MASK, DESTINATIONS, JUMP_MASK, JUMPS, assemble_with_parser,
+                       decode_line, evaluate, layout_decoded_lines, reads_d)
+from timings import phase
+
+
+def is_a_instruction(decoded):
+    """Whether a line from `decode_line` is an A-instruction."""
+    if type(decoded) is tuple:
+        return decoded[0] != 'label'
+    return decoded is not None and not decoded & 0x8000
+
+
+def reads_a(instruction):
+    """Whether a C-instruction depends on the value of A, as an operand, as
+    the address it reads or writes or as where it jumps to."""
+    if instruction & DESTINATIONS['*A'] or instruction & JUMP_MASK:
+        return True
+    return not instruction & (1 << 9)
+
+
+def reads_latched_memory(instruction):
+    """Whether a C-instruction uses *A on the rising edge of the clock, to
+    write to memory or decide whether to jump. That's the word memory
+    latched on the rising edge before, at the address the instruction before
+    put out, so it's the old word right after a write or after A changes."""
+    if not instruction & (DESTINATIONS['*A'] | JUMP_MASK):
+        return False
+    return bool(instruction & (1 << 12)) and not instruction & (1 << 9)
+
+
+def is_jump(decoded):
+    return not is_a_instruction(decoded) and bool(decoded & JUMP_MASK)
+
+
+@dataclass
+class OptimizationReport:
+    # (line number, reason) of every instruction that was removed.
+    removed: list
+    # How many `A := @label` now go straight to where a chain of jumps ended.
+    threaded_jumps: int = 0
+
+    @property
+    def saved(self):
+        return len(self.removed)
+
+    def __str__(self):
+        reasons = {}
+        for _, reason in self.removed:
+            reasons[reason] = reasons.get(reason, 0) + 1
+        details = ''.join(', {} {}'.format(count, reason)
+                          for reason, count in sorted(reasons.items()))
+        return 'Saved {} instructions{}, threaded {} jumps'.format(
+            self.saved, details, self.threaded_jumps)
+
+
+class PeepholeOptimizer:
+    """Removes instructions that make no difference to what a program does.
+
+    Works on the lines from `decode_line` before labels get their addresses,
+    so removing instructions keeps every label pointing at the right one.
+    Removed instructions are replaced by None, like a blank line, so the
+    position of everything else stays the same. Each pass can expose
+    more for the others, so they're repeated until nothing changes.
+
+    Labels are expected to only be used as places to jump to. Programs that
+    jump to addresses computed from constants, or that use label addresses
+    as data, can't be optimized since removing instructions moves labels.
+
+    The instruction after a jump runs whether it's taken or not, and an
+    instruction reading *A on the rising edge depends on the one before it,
+    see `reads_latched_memory`. Those instructions are pinned: they're never
+    removed or rewritten, so nothing else moves next to the instructions
+    they depend on.
+
+    `rules` are rewrite rules from `load_rewrite_rules`, replacing runs of
+    instructions with shorter ones that do the same.
+    """
+    def __init__(self, decoded_lines, rules=None):
+        # Pseudo-instructions are split up so every instruction can be
+        # removed on its own, `linenos` remembers where each came from.
+        self.lines = []
+        self.linenos = []
+        for lineno, decoded in enumerate(decoded_lines, start=1):
+            for item in (decoded if type(decoded) is list else [decoded]):
+                self.lines.append(item)
+                self.linenos.append(lineno)
+        self.rules = rules or {}
+        self.longest_rule = max(map(len, self.rules), default=0)
+        self.report = OptimizationReport([])
+
+    def optimize(self):
+        changed = True
+        while changed:
+            changed = False
+            for optimization in (self.thread_jumps, self.remove_unreachable_code,
+                                 self.remove_redundant_instructions,
+                                 self.remove_dead_stores, self.apply_rewrite_rules):
+                changed |= optimization()
+        self.report.removed.sort()
+        return self.lines
+
+    def remove(self, index, reason):
+        self.lines[index] = None
+        self.report.removed.append((self.linenos[index], reason))
+
+    def following_instructions(self, index):
+        """Yields the index of every instruction after `index`, in order."""
+        for i in range(index + 1, len(self.lines)):
+            decoded = self.lines[i]
+            if decoded is not None and not (type(decoded) is tuple and decoded[0] == 'label'):
+                yield i
+
+    def next_instruction(self, index):
+        return next(self.following_instructions(index), None)
+
+    def previous_instruction(self, index):
+        for i in range(index - 1, -1, -1):
+            decoded = self.lines[i]
+            if decoded is not None and not (type(decoded) is tuple and decoded[0] == 'label'):
+                return i
+        return None
+
+    def in_delay_slot(self, index):
+        """Whether the instruction at `index` comes right after a jump, so it
+        runs whether the jump is taken or not."""
+        previous = self.previous_instruction(index)
+        return previous is not None and is_jump(self.lines[previous])
+
+    def latched_by_next(self, index):
+        """Whether the instruction after `index` uses the word memory latched
+        while the one at `index` runs."""
+        following = self.next_instruction(index)
+        return (following is not None and not is_a_instruction(self.lines[following]) and
+                reads_latched_memory(self.lines[following]))
+
+    def is_pinned(self, index):
+        return self.in_delay_slot(index) or self.latched_by_next(index)
+
+    def is_no_op(self, index):
+        decoded = self.lines[index]
+        return not is_a_instruction(decoded) and not decoded & (DESTINATION_MASK | JUMP_MASK)
+
+    def jump_trampolines(self):
+        """Finds labels whose code is just `A := @other_label; 0; jmp` with
+        nothing done after the jump, returning the label they end up at for
+        each."""
+        trampolines = {}
+        for i, decoded in enumerate(self.lines):
+            if type(decoded) is not tuple or decoded[0] != 'label':
+                continue
+            load = self.next_instruction(i)
+            if load is None or type(self.lines[load]) is not tuple:
+                continue
+            jump = self.next_instruction(load)
+            if (self.lines[load][0] != '@' or jump is None or
+                    is_a_instruction(self.lines[jump]) or
+                    self.lines[jump] & (DESTINATION_MASK | JUMP_MASK) != JUMPS['jmp']):
+                continue
+            slot = self.next_instruction(jump)
+            if slot is not None and self.is_no_op(slot):
+                trampolines[decoded[1]] = self.lines[load][1]
+
+        for label in trampolines:
+            # Follow chains of trampolines, stopping at loops.
+            seen = {label}
+            target = trampolines[label]
+            while target in trampolines and target not in seen:
+                seen.add(target)
+                target = trampolines[target]
+            trampolines[label] = target
+        return trampolines
+
+    def thread_jumps(self):
+        """Jumps to a label that immediately jumps somewhere else go there
+        directly instead."""
+        trampolines = self.jump_trampolines()
+        changed = False
+        for i, decoded in enumerate(self.lines):
+            if type(decoded) is not tuple or decoded[0] != '@':
+                continue
+            target = trampolines.get(decoded[1], decoded[1])
+            if target == decoded[1]:
+                continue
+            # A only gets a different value, so that has to go unnoticed: the
+            # jump can't use A for anything else, and neither can the
+            # instruction after it, which runs either way. If the jump might
+            # not be taken, A has to be loaded again after that. Skipping the
+            # trampoline leaves A and memory's latched word as they'd be at
+            # the target, since the instruction after its jump does nothing.
+            jump = self.next_instruction(i)
+            if jump is None or is_a_instruction(self.lines[jump]):
+                continue
+            instruction = self.lines[jump]
+            if not instruction & JUMP_MASK or instruction & DESTINATIONS['*A']:
+                continue
+            if not instruction & (1 << 9) or instruction & DESTINATIONS['A']:
+                continue
+            slot = self.next_instruction(jump)
+            if slot is None or is_a_instruction(self.lines[slot]):
+                continue
+            if reads_a(self.lines[slot]) or self.lines[slot] & DESTINATIONS['A']:
+                continue
+            if instruction & JUMP_MASK != JUMPS['jmp']:
+                after = self.next_instruction(slot)
+                if after is None or not is_a_instruction(self.lines[after]):
+                    continue
+            self.lines[i] = ('@', target)
+            self.report.threaded_jumps += 1
+            changed = True
+        return changed
+
+    def remove_unreachable_code(self):
+        """Removes instructions after an unconditional jump, and the one
+        after it that runs while the jump is taken, that aren't the target
+        of any jump."""
+        referenced = {decoded[1] for decoded in self.lines
+                      if type(decoded) is tuple and decoded[0] == '@'}
+        changed = False
+        reachable = True
+        delay_slot = False
+        for i, decoded in enumerate(self.lines):
+            if decoded is None:
+                continue
+            if type(decoded) is tuple and decoded[0] == 'label':
+                if decoded[1] in referenced:
+                    reachable = True
+                    delay_slot = False
+            elif not reachable:
+                self.remove(i, 'unreachable')
+                changed = True
+            elif delay_slot:
+                reachable = delay_slot = False
+            elif (not is_a_instruction(decoded) and
+                    decoded & JUMP_MASK == JUMPS['jmp']):
+                delay_slot = True
+        return changed
+
+    def remove_redundant_instructions(self):
+        """Tracks the values of A and D to remove loads and computations of
+        values that are already there."""
+        changed = False
+        a = d = None
+        for i, decoded in enumerate(self.lines):
+            if decoded is None:
+                continue
+            if type(decoded) is tuple and decoded[0] == 'label':
+                # Jumps here could come from anywhere.
+                a = d = None
+            elif is_a_instruction(decoded):
+                if decoded == a and not self.is_pinned(i):
+                    self.remove(i, 'redundant load')
+                    changed = True
+                a = decoded
+            else:
+                value = evaluate(decoded, a, d)
+                writes_a = decoded & DESTINATIONS['A']
+                writes_d = decoded & DESTINATIONS['D']
+                if (not decoded & (JUMP_MASK | DESTINATIONS['*A']) and
+                        (not writes_a or (value is not None and value == a)) and
+                        (not writes_d or (value is not None and value == d)) and
+                        not self.is_pinned(i)):
+                    self.remove(i, 'redundant computation')
+                    changed = True
+                    continue
+                if writes_a:
+                    a = value
+                if writes_d:
+                    d = value
+        return changed
+
+    def is_dead_store(self, index):
+        """Whether the instruction at `index` only sets A or D, to a value
+        that's overwritten before it's used."""
+        decoded = self.lines[index]
+        if is_a_instruction(decoded):
+            register = 'A'
+        elif decoded & (DESTINATION_MASK | JUMP_MASK) == DESTINATIONS['D']:
+            register = 'D'
+        elif decoded & (DESTINATION_MASK | JUMP_MASK) == DESTINATIONS['A']:
+            register = 'A'
+        else:
+            return False
+
+        for i in self.following_instructions(index):
+            instruction = self.lines[i]
+            if is_a_instruction(instruction):
+                if register == 'A':
+                    return True
+                continue
+            if reads_a(instruction) if register == 'A' else reads_d(instruction):
+                return False
+            # A is also the address memory latches for the instruction after.
+            if register == 'A' and self.latched_by_next(i):
+                return False
+            if instruction & DESTINATIONS[register]:
+                return True
+            if instruction & JUMP_MASK:
+                return False
+        # The value might be looked at once the program's done.
+        return False
+
+    def remove_dead_stores(self):
+        changed = False
+        for i, decoded in enumerate(self.lines):
+            if decoded is None or (type(decoded) is tuple and decoded[0] == 'label'):
+                continue
+            if self.is_dead_store(i) and not self.is_pinned(i):
+                self.remove(i, 'dead store')
+                changed = True
+        return changed
+
+    def apply_rewrite_rules(self):
+        if not self.rules:
+            return False
+        changed = False
+        # Positions of the instructions since the last label, reference or
+        # delay slot, only those can be rewritten together.
+        window = []
+        for i, decoded in enumerate(self.lines):
+            if decoded is None:
+                continue
+            if type(decoded) is not int or self.in_delay_slot(i):
+                window = []
+                continue
+            window = (window + [i])[-self.longest_rule:]
+            # What comes after a window is only the same for the window's
+            # replacement if it doesn't look at memory latched during it.
+            if self.latched_by_next(i):
+                continue
+            # Longest windows first, they save the most.
+            for start in range(len(window) - 1):
+                replacement = self.rules.get(tuple(self.lines[j] for j in window[start:]))
+                if replacement is None:
+                    continue
+                for j, instruction in itertools.zip_longest(window[start:], replacement):
+                    if instruction is None:
+                        self.remove(j, 'rewritten')
+                    else:
+                        self.lines[j] = instruction
+                window = []
+                changed = True
+                break
+        return changed
+
+
+def rename_redefined_labels(decoded_lines):
+    """Gives every definition of a label defined more than once a name of its
+    own, except for the last, and points each `A := @label` at the one it
+    refers to, see `layout_decoded_lines`. The PeepholeOptimizer goes by
+    label names, so it couldn't tell the definitions apart otherwise. Labels
+    can't contain '#', so the new names don't clash with any."""
+    definitions = collections.Counter(
+        decoded[1] for decoded in decoded_lines
+        if type(decoded) is tuple and decoded[0] == 'label')
+    seen = collections.Counter()
+    renamed = []
+    for decoded in decoded_lines:
+        if type(decoded) is tuple and definitions[decoded[1]] > 1:
+            (kind, name) = decoded
+            if kind == 'label':
+                seen[name] += 1
+            if 0 < seen[name] < definitions[name]:
+                decoded = (kind, '{}#{}'.format(name, seen[name]))
+        renamed.append(decoded)
+    return renamed
+
+
+def assemble_optimized(assembly, rules=None):
+    """Validates and assembles `assembly` like `assemble`, then removes what
+    instructions it can with the PeepholeOptimizer and rewrite `rules`.
+    Returns the Program and an OptimizationReport."""
+    try:
+        decoded_lines = [decode_line(line) for line in assembly.split('\n')]
+    except (VisitError, lark.exceptions.UnexpectedInput):
+        decoded_lines = None
+    # Check the program is valid before optimizing it, the optimizer could
+    # remove the instructions with errors.
+    unoptimized = None
+    if decoded_lines is not None:
+        unoptimized = layout_decoded_lines(decoded_lines)
+    if unoptimized is None:
+        assemble_with_parser(assembly)
+        raise ValueError("Can't optimize instructions split over several lines")
+
+    # Removing instructions could change the order symbols are first used
+    # in, so they keep the addresses they get in the unoptimized program.
+    symbol_map = unoptimized.symbols
+    decoded_lines = [
+        symbol_map[decoded[1]] if type(decoded) is tuple and decoded[0] == '$' else decoded
+        for decoded in decoded_lines]
+
+    optimizer = PeepholeOptimizer(rename_redefined_labels(decoded_lines), rules)
+    with phase('optimize'):
+        optimized_lines = optimizer.optimize()
+    program = layout_decoded_lines(optimized_lines, optimizer.linenos)
+    program.symbols = symbol_map
+    # Like in `assemble`, a label defined more than once is listed at its
+    # last definition.
+    program.labels = {label: address for label, address in program.labels.items()
+                      if '#' not in label}
+    return program, optimizer.report
+
+
+# Bump when the format of rewrite rule files changes, or the rules in them
+# might not hold anymore. Version 1 didn't model the latched memory word,
+# and version 2 rules were only checked on a sample of states.
+REWRITE_RULES_VERSION = 3
+
+
+def format_window(instructions):
+    """Writes a run of instructions the way rewrite rule files key them,
+    such as 'EC10 E090'."""
+    return ' '.join('{:04X}'.format(instruction) for instruction in instructions)
+
+
+def parse_window(text):
+    return tuple(int(word, 16) for word in text.split())
+
+
+def load_rewrite_rules(path):
+    """Reads the rewrite rules `superoptimizer.py` saved to `path`, as a dict
+    from each run of instructions to the shorter run replacing it."""
+    with open(path) as f:
+        database = json.load(f)
+    if database.get('version') != REWRITE_RULES_VERSION:
+        raise ValueError("{} has rules in an unsupported format".format(path))
+    # Runs with nothing shorter are kept so they're not searched again.
+    return {parse_window(window): parse_window(replacement)
+            for window, replacement in database['rules'].items()
+            if replacement is not None}
@@ -0,0 +1,286 @@
+"""The file formats the assembler writes programs in, and reads back ROM
+images from. Each format is an `OutputFormat` listed in `OUTPUT_FORMATS`
+under the name `--format` takes."""
+import abc
+import array
+import contextlib
+import io
+import os
+import sys
+
+from timings import phase
+
+
+def to_bitstring(instruction):
+    """Formats an encoded instruction the way it's written out to .hack files,
+    such as '1110110000010000'."""
+    return format(instruction, '016b')
+
+
+@contextlib.contextmanager
+def open_atomically(path, binary=False):
+    """Opens a temporary file next to `path` for writing which replaces `path`
+    once it's been written, so nothing ever sees a partially written file."""
+    temporary_path = path.with_name('.{}.{}.tmp'.format(path.name, os.getpid()))
+    try:
+        with temporary_path.open('wb' if binary else 'w') as f:
+            yield f
+        os.replace(temporary_path, path)
+    finally:
+        if temporary_path.exists():
+            temporary_path.unlink()
+
+
+class OutputFormat(abc.ABC):
+    """Writes encoded instructions to a file one at a time, so the same
+    machine code can be fed to several formats at once even while streaming.
+    Formats implement `write`, and `finish` if they need to end the file.
+    """
+    suffix = None
+    binary = False
+    # Whether every instruction is written as the same number of bytes with
+    # nothing else in the file, so single instructions can be rewritten.
+    fixed_width = False
+
+    def __init__(self, f):
+        self.f = f
+
+    @abc.abstractmethod
+    def write(self, instruction):
+        pass
+
+    def finish(self):
+        pass
+
+
+class HackFormat(OutputFormat):
+    """The book's format, one instruction per line as a bitstring. This is
+    what `$readmemb` loads in xilinx/computer.v."""
+    suffix = '.hack'
+    fixed_width = True
+
+    def write(self, instruction):
+        self.f.write(to_bitstring(instruction))
+        self.f.write("\n")
+
+
+class LittleEndianBinaryFormat(OutputFormat):
+    """Raw packed 16-bit words."""
+    suffix = '.bin'
+    binary = True
+    fixed_width = True
+    byteorder = 'little'
+
+    def write(self, instruction):
+        self.f.write(instruction.to_bytes(2, self.byteorder))
+
+
+class BigEndianBinaryFormat(LittleEndianBinaryFormat):
+    suffix = '.be.bin'
+    byteorder = 'big'
+
+
+class ReadmemhFormat(OutputFormat):
+    """One instruction per line in hex, as loaded by Verilog's `$readmemh`."""
+    suffix = '.mem'
+    fixed_width = True
+
+    def write(self, instruction):
+        self.f.write(format(instruction, '04X'))
+        self.f.write("\n")
+
+
+class CoeFormat(OutputFormat):
+    """Xilinx coefficient file for initializing block RAMs in the IP tools."""
+    suffix = '.coe'
+
+    def __init__(self, f):
+        super().__init__(f)
+        self.f.write("memory_initialization_radix=16;\n")
+        self.f.write("memory_initialization_vector=\n")
+        self.separator = ''
+
+    def write(self, instruction):
+        self.f.write(self.separator)
+        self.f.write(format(instruction, '04X'))
+        self.separator = ",\n"
+
+    def finish(self):
+        # The vector can't be empty.
+        if not self.separator:
+            self.f.write('0000')
+        self.f.write(";\n")
+
+
+class IntelHexFormat(OutputFormat):
+    """Intel HEX as used for memory initialization by Intel's FPGA tools, the
+    addresses count 16-bit words and each word is stored big-endian."""
+    suffix = '.hex'
+    WORDS_PER_RECORD = 8
+
+    DATA_RECORD = 0x00
+    END_OF_FILE_RECORD = 0x01
+    EXTENDED_LINEAR_ADDRESS_RECORD = 0x04
+
+    def __init__(self, f):
+        super().__init__(f)
+        self.address = 0
+        self.upper_address = 0
+        self.words = []
+
+    def write_record(self, record_type, address, data):
+        record = bytes([len(data), address >> 8, address & 0xFF, record_type]) + data
+        checksum = -sum(record) & 0xFF
+        self.f.write(':{}{:02X}\n'.format(record.hex().upper(), checksum))
+
+    def write_data_record(self):
+        # Records only hold 16-bit addresses, anything past that needs the
+        # upper bits set in an extended linear address record first.
+        if self.address >> 16 != self.upper_address:
+            self.upper_address = self.address >> 16
+            self.write_record(self.EXTENDED_LINEAR_ADDRESS_RECORD, 0,
+                              self.upper_address.to_bytes(2, 'big'))
+        data = b''.join(word.to_bytes(2, 'big') for word in self.words)
+        self.write_record(self.DATA_RECORD, self.address & 0xFFFF, data)
+        self.address += len(self.words)
+        self.words = []
+
+    def write(self, instruction):
+        self.words.append(instruction)
+        if len(self.words) == self.WORDS_PER_RECORD:
+            self.write_data_record()
+
+    def finish(self):
+        if self.words:
+            self.write_data_record()
+        self.write_record(self.END_OF_FILE_RECORD, 0, b'')
+
+
+OUTPUT_FORMATS = {
+    'hack': HackFormat,
+    'bin': LittleEndianBinaryFormat,
+    'bin-be': BigEndianBinaryFormat,
+    'mem': ReadmemhFormat,
+    'coe': CoeFormat,
+    'ihex': IntelHexFormat,
+}
+
+
+def write_output_files(output_path, machine_code, formats=('hack', )):
+    """Writes the instructions out in every one of `formats`, each to
+    `output_path` with the format's suffix. The machine code is only iterated
+    over once. Returns how many instructions there were."""
+    with phase('write'), contextlib.ExitStack() as stack:
+        writers = []
+        for name in formats:
+            output_format = OUTPUT_FORMATS[name]
+            f = stack.enter_context(open_atomically(
+                output_path.with_suffix(output_format.suffix), output_format.binary))
+            writers.append(output_format(f))
+
+        instruction_count = 0
+        for instruction in machine_code:
+            for writer in writers:
+                writer.write(instruction)
+            instruction_count += 1
+        for writer in writers:
+            writer.finish()
+    return instruction_count
+
+
+def read_rom(path):
+    """Reads a ROM image written in one of the assembler's output formats
+    that hold one word per instruction, going by its suffix."""
+    # The longest suffix that matches, so .be.bin isn't read as .bin.
+    output_format = max(
+        (output_format for output_format in OUTPUT_FORMATS.values()
+         if output_format.fixed_width and path.name.endswith(output_format.suffix)),
+        key=lambda output_format: len(output_format.suffix), default=None)
+    if output_format is None:
+        raise ValueError("Don't know how to read {}".format(path.name))
+    code = array.array('H')
+    if not output_format.binary:
+        radix = 2 if output_format is HackFormat else 16
+        code.extend(int(line, radix) for line in path.read_text().split())
+        return code
+    data = path.read_bytes()
+    if len(data) % 2:
+        raise ValueError("{} has an odd number of bytes".format(path.name))
+    code.frombytes(data)
+    if output_format.byteorder != sys.byteorder:
+        code.byteswap()
+    return code
+
+
+def encode_instructions(output_format, instructions):
+    """Returns the bytes `output_format` writes for `instructions`."""
+    buffer = io.BytesIO() if output_format.binary else io.StringIO()
+    writer = output_format(buffer)
+    for instruction in instructions:
+        writer.write(instruction)
+    writer.finish()
+    if output_format.binary:
+        return buffer.getvalue()
+    return buffer.getvalue().encode()
+
+
+def changed_ranges(old_code, new_code):
+    """Yields the (start, end) ranges of instructions in `new_code` that are
+    different from, or weren't in, `old_code`."""
+    common_length = min(len(old_code), len(new_code))
+    start = None
+    # Compare in chunks first, most of the program is usually unchanged.
+    for chunk_start in range(0, common_length, 256):
+        chunk_end = min(chunk_start + 256, common_length)
+        if old_code[chunk_start:chunk_end] == new_code[chunk_start:chunk_end]:
+            if start is not None:
+                yield (start, chunk_start)
+                start = None
+            continue
+        for i in range(chunk_start, chunk_end):
+            if old_code[i] != new_code[i]:
+                if start is None:
+                    start = i
+            elif start is not None:
+                yield (start, i)
+                start = None
+
+    if len(new_code) > common_length:
+        yield (common_length if start is None else start, len(new_code))
+    elif start is not None:
+        yield (start, common_length)
+
+
+def update_output_files(output_path, old_code, new_code, formats=('hack', )):
+    """Brings the files `write_output_files` wrote for `old_code` up to date
+    with `new_code`. Fixed width formats only get the instructions that
+    changed rewritten in place, other formats are written again from scratch
+    if anything changed. Returns the number of instructions that changed."""
+    ranges = list(changed_ranges(old_code, new_code))
+
+    rewrite = []
+    for name in formats:
+        output_format = OUTPUT_FORMATS[name]
+        path = output_path.with_suffix(output_format.suffix)
+        if not path.exists():
+            rewrite.append(name)
+            continue
+        if not ranges and len(old_code) == len(new_code):
+            continue
+        record_size = len(encode_instructions(output_format, [0]))
+        # Anything that doesn't look like what we wrote last time, say because
+        # it was changed behind our back, is written again too.
+        if (not output_format.fixed_width or
+                path.stat().st_size != len(old_code) * record_size):
+            rewrite.append(name)
+            continue
+
+        with path.open('r+b') as f:
+            for start, end in ranges:
+                f.seek(start * record_size)
+                f.write(encode_instructions(output_format, new_code[start:end]))
+            f.truncate(len(new_code) * record_size)
+
+    if rewrite:
+        write_output_files(output_path, new_code, rewrite)
+    return sum(end - start for (start, end) in ranges)
@@ -0,0 +1,326 @@
+"""Searches for shorter equivalents of short runs of Hack instructions.
+
+Finds the runs of two to four instructions that a program spends the most
+time in and tries every sequence of fewer instructions, built from the
+computation and destination tables, until one leaves A, D and memory the
+same. Replacements are saved to a rule database that the assembler applies
+with `--optimize --rules`. Runs that have nothing shorter are saved too, so
+they aren't searched again.
+
+Replacements are checked to be equivalent in every state, see
+`equivalent`. Usage:
+
+    python3 superoptimizer.py [--rules rules.json] files or directories...
+"""
+import argparse
+import itertools
+import json
+import random
+import sys
+from collections import Counter
+from pathlib import Path
+
+import lark
+
+import assembler
+import cli
+import optimizer
+from assembler import COMPUTATIONS, DESTINATIONS, JUMP_MASK, alu
+from disassembler import disassemble_word
+from linker import ModuleError
+from output_formats import open_atomically
+
+
+# Every C-instruction that stores its result and doesn't jump. Computations
+# written differently but encoded the same are only tried once.
+C_INSTRUCTIONS = sorted(
+    computation | destination
+    for computation in set(COMPUTATIONS.values())
+    for destination in range(1 << 3, 1 << 6, 1 << 3))
+
+MEMORY_DESTINATION = DESTINATIONS['*A']
+READS_MEMORY = 1 << 12
+
+# How often instructions inside a loop are assumed to run compared to the
+# loop around them.
+LOOP_WEIGHT = 10
+
+
+def is_c_instruction(instruction):
+    return instruction & (1 << 15)
+
+
+def accesses_memory(instruction):
+    return is_c_instruction(instruction) and instruction & (READS_MEMORY | MEMORY_DESTINATION)
+
+
+def writes_a(instruction):
+    return not is_c_instruction(instruction) or instruction & DESTINATIONS['A']
+
+
+def is_searchable(instructions):
+    """Whether `instructions` can be searched for and used as a replacement.
+
+    Memory is modelled as the one word that A points to at the start, so
+    it can't be accessed once A changes. Jumps are left alone.
+    """
+    a_written = False
+    for instruction in instructions:
+        if is_c_instruction(instruction) and instruction & JUMP_MASK:
+            return False
+        if a_written and accesses_memory(instruction):
+            return False
+        a_written = a_written or writes_a(instruction)
+    return True
+
+
+def execute(instructions, a, d, m, latched):
+    """Runs straight-line `instructions` from the given A, D, *A and word
+    memory latched during the instruction before them, returning their
+    values afterwards.
+
+    As in the CPU, what's written to *A is computed from the latched word,
+    which is the word at A before the previous instruction wrote to it. What
+    A and D load is computed from the word latched as the instruction runs,
+    which has every write before it. Only A, D and *A have to come out the
+    same for runs to be equivalent: the assembler doesn't rewrite runs the
+    instruction after looks at the latched word of."""
+    for instruction in instructions:
+        if not is_c_instruction(instruction):
+            a = instruction
+            continue
+        memory = m
+        if instruction & MEMORY_DESTINATION:
+            m = alu(instruction, d, latched if instruction & READS_MEMORY else a)
+        output = alu(instruction, d, memory if instruction & READS_MEMORY else a)
+        if instruction & DESTINATIONS['D']:
+            d = output
+        if instruction & DESTINATIONS['A']:
+            a = output
+        latched = memory
+    return a, d, m, latched
+
+
+def serial_alu(instruction, x, y, carry):
+    """One bit of `alu`, given the carry into it if the ALU adds. Returns the
+    output bit and the carry out of it."""
+    if instruction & (1 << 11):
+        x = 0
+    if instruction & (1 << 10):
+        x ^= 1
+    if instruction & (1 << 9):
+        y = 0
+    if instruction & (1 << 8):
+        y ^= 1
+    if instruction & (1 << 7):
+        output = x ^ y ^ carry
+        carry = (x & y) | (carry & (x ^ y))
+    else:
+        output = x & y
+        carry = 0
+    if instruction & (1 << 6):
+        output ^= 1
+    return output, carry
+
+
+def additions(instructions):
+    """How many times `execute` uses the ALU for `instructions`."""
+    return sum(1 + bool(instruction & MEMORY_DESTINATION)
+               for instruction in instructions if is_c_instruction(instruction))
+
+
+def serial_execute(instructions, bit, a, d, m, latched, carries):
+    """`execute` on bit `bit` of the registers, given the carry into it of
+    each use of the ALU in order. Returns the bits afterwards and the carries
+    out of bit `bit`."""
+    carries = iter(carries)
+    carries_out = []
+    for instruction in instructions:
+        if not is_c_instruction(instruction):
+            a = instruction >> bit & 1
+            continue
+        memory = m
+        if instruction & MEMORY_DESTINATION:
+            (m, carry) = serial_alu(
+                instruction, d, latched if instruction & READS_MEMORY else a, next(carries))
+            carries_out.append(carry)
+        (output, carry) = serial_alu(
+            instruction, d, memory if instruction & READS_MEMORY else a, next(carries))
+        carries_out.append(carry)
+        if instruction & DESTINATIONS['D']:
+            d = output
+        if instruction & DESTINATIONS['A']:
+            a = output
+        latched = memory
+    return (a, d, m, latched), tuple(carries_out)
+
+
+def equivalent(instructions, replacement):
+    """Whether `replacement` leaves A, D and *A the same as `instructions` in
+    every one of the 2**64 states.
+
+    The ALU only adds and works bitwise otherwise, and carries only go up,
+    so bit k of the registers afterwards depends on nothing but bit k of
+    them before and the carries into bit k. Going from the lowest bit up,
+    both runs are checked on every value of the bits with every carry that
+    the bits below can lead to.
+    """
+    carries = {((0, ) * additions(instructions), (0, ) * additions(replacement))}
+    for bit in range(16):
+        carries_out = set()
+        for original_carries, replacement_carries in carries:
+            for state in itertools.product((0, 1), repeat=4):
+                (original, original_out) = serial_execute(
+                    instructions, bit, *state, original_carries)
+                (replaced, replacement_out) = serial_execute(
+                    replacement, bit, *state, replacement_carries)
+                if original[:3] != replaced[:3]:
+                    return False
+                carries_out.add((original_out, replacement_out))
+        carries = carries_out
+    return True
+
+
+# States to quickly rule out most candidates on before checking them
+# properly with `equivalent`.
+_rng = random.Random(1)
+TEST_STATES = [(0, 0, 0, 0), (0xFFFF, 0xFFFF, 0xFFFF, 0xFFFF), (1, 0x8000, 0x7FFF, 2)] + [
+    (_rng.getrandbits(16), _rng.getrandbits(16), _rng.getrandbits(16), _rng.getrandbits(16))
+    for _ in range(13)]
+
+
+def search(instructions, max_length=2):
+    """The shortest run of instructions, up to `max_length` and shorter than
+    `instructions`, that is equivalent to it, or None if there isn't one."""
+    if not is_searchable(instructions):
+        return None
+    target = [execute(instructions, *state)[:3] for state in TEST_STATES]
+    # Only the constants the original loads are tried in A-instructions,
+    # which keeps the search bounded.
+    alphabet = sorted({i for i in instructions if not is_c_instruction(i)}) + C_INSTRUCTIONS
+    # The registers each instruction writes, so a candidate can be skipped
+    # when its last instruction doesn't write a register that's still wrong.
+    written = {i: (writes_a(i), i & DESTINATIONS['D'], i & MEMORY_DESTINATION)
+               for i in alphabet}
+
+    def extend(prefix, states, length):
+        if len(prefix) == length:
+            if ([state[:3] for state in states] == target and is_searchable(prefix)
+                    and equivalent(instructions, prefix)):
+                return tuple(prefix)
+            return None
+        wrong = []
+        if len(prefix) == length - 1:
+            wrong = [r for r in range(3)
+                     if any(state[r] != expected[r] for state, expected in zip(states, target))]
+        for instruction in alphabet:
+            if not all(written[instruction][r] for r in wrong):
+                continue
+            found = extend(prefix + [instruction],
+                           [execute((instruction, ), *state) for state in states], length)
+            if found is not None:
+                return found
+        return None
+
+    for length in range(min(max_length, len(instructions) - 1) + 1):
+        found = extend([], TEST_STATES, length)
+        if found is not None:
+            return found
+    return None
+
+
+def loop_depths(program):
+    """How many loops each instruction is in, going by jumps back to a label
+    loaded just before them."""
+    depths = [0] * len(program)
+    targets = set(program.labels.values())
+    for address in range(1, len(program)):
+        instruction = program.code[address]
+        target = program.code[address - 1]
+        if (is_c_instruction(instruction) and instruction & JUMP_MASK
+                and not is_c_instruction(target) and target in targets and target <= address):
+            for inside in range(target, address + 1):
+                depths[inside] += 1
+    return depths
+
+
+def hot_windows(program, sizes=range(2, 5)):
+    """Counts how often each searchable run of instructions in `program` is
+    expected to run, going by how deep in loops it is."""
+    heat = Counter()
+    labels = set(program.labels.values())
+    depths = loop_depths(program)
+    for size in sizes:
+        for start in range(len(program) - size + 1):
+            if any(address in labels for address in range(start + 1, start + size)):
+                continue
+            window = tuple(program.code[start:start + size])
+            if is_searchable(window):
+                heat[window] += LOOP_WEIGHT ** depths[start]
+    return heat
+
+
+def load_rule_database(path):
+    """Every rule saved to `path`, including the runs with nothing shorter
+    which are None, keyed like `optimizer.format_window`."""
+    if not path.exists():
+        return {}
+    with path.open() as f:
+        database = json.load(f)
+    if database.get('version') != optimizer.REWRITE_RULES_VERSION:
+        raise ValueError("{} has rules in an unsupported format".format(path))
+    return database['rules']
+
+
+def save_rule_database(path, rules):
+    with open_atomically(path) as f:
+        json.dump({'version': optimizer.REWRITE_RULES_VERSION, 'rules': rules},
+                  f, indent=1, sort_keys=True)
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(prog='superoptimizer')
+    arg_parser.add_argument(
+        'sources', type=Path, nargs='+',
+        help=".asm files, or directories of them, to find runs of instructions in")
+    arg_parser.add_argument(
+        '--rules', type=Path, default=Path('rules.json'),
+        help="rule database to add to (default: rules.json)")
+    arg_parser.add_argument(
+        '--top', type=int, default=20,
+        help="number of the hottest runs not in the database to search")
+    arg_parser.add_argument(
+        '--max-length', type=int, default=2,
+        help="longest replacement to try, the search takes about 300 times "
+             "longer for each extra instruction")
+    args = arg_parser.parse_args(argv)
+
+    rules = load_rule_database(args.rules)
+    heat = Counter()
+    for source_file in cli.find_sources(args.sources):
+        try:
+            program = cli.assemble_program(source_file)
+        except (assembler.ValidationError, ModuleError,
+                lark.exceptions.LarkError, OSError) as e:
+            print("Skipping {}: {}".format(source_file, e), file=sys.stderr)
+            continue
+        heat.update(hot_windows(program))
+
+    windows = [window for window, _ in heat.most_common()
+               if optimizer.format_window(window) not in rules][:args.top]
+    for window in windows:
+        replacement = search(window, args.max_length)
+        rules[optimizer.format_window(window)] = (
+            None if replacement is None else optimizer.format_window(replacement))
+        if replacement is not None:
+            print('{}  =>  {}'.format('; '.join(map(disassemble_word, window)),
+                                      '; '.join(map(disassemble_word, replacement)) or 'nothing'))
+        # Saved as we go, searches can take a while to get through.
+        save_rule_database(args.rules, rules)
+    print("Searched {} runs, {} rules in {}".format(
+        len(windows), sum(r is not None for r in rules.values()), args.rules))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,3 +1,5 @@
+import pytest
+
 import assembler
 
 
@@ -166,3 +168,90 @@ def test_can_define_your_own_symbols():
         '0000000000000000',
         '0000000000010001'
     ]    
+
+def test_labels_can_start_with_register_names():
+    ast = assembler.parse_and_validate_ast("""\
+    A := @Done
+Addr:
+    D = A
+Done:
+D:
+    A := @D
+""")
+    assert assembler.assemble_ast(ast) == [
+        '0000000000000010',
+        '1110110000010000',
+        '0000000000000010',
+    ]
+
+def test_plus_and_minus_one_with_whitespace():
+    ast = assembler.parse_and_validate_ast("D = D+ 1\nD = D -1\nD = D - A")
+    assert assembler.assemble_ast(ast) == [
+        '1110011111010000',
+        '1110001110010000',
+        '1110010011010000',
+    ]
+
+def test_blank_lines_comments_and_trailing_whitespace_are_ignored():
+    ast = assembler.parse_and_validate_ast(
+        "// comment\n\n   A := 3   \n\n  // another\n\nD = A ; jmp \t\n")
+    assert assembler.assemble_ast(ast) == [
+        '0000000000000011',
+        '1110110000010111',
+    ]
+
+def test_fast_path_matches_parser_on_unusual_spacing():
+    source = """\
+A:=@end
+	D  =	D+A ; jgt
+D ,A=- *A
+*A , D=D -1;jmp
+A := $  var
+A := 0x1f // comment
+  A:
+end :
+*A+1
+"""
+    assert (assembler.assemble(source).code ==
+            assembler.assemble_with_parser(source).code)
+
+def test_parser_is_built_once_and_still_available_as_attribute():
+    assert assembler.get_parser() is assembler.get_parser()
+    assert assembler.parser is assembler.get_parser()
+
+@pytest.mark.parametrize("assemble", [
+    assembler.assemble,
+    assembler.assemble_with_parser,
+])
+def test_program_has_labels_symbols_and_source_map(assemble):
+    source = """\
+// Count down from 5.
+    A := 5
+    D = A
+loop:
+    A := $counter
+    *A = D
+
+    D = D - 1; jgt
+    A := @loop
+    0; jmp
+"""
+    program = assemble(source)
+
+    assert program.code.typecode == 'H'
+    assert len(program) == 7
+    assert program.labels == {'loop': 2}
+    assert program.symbols['counter'] == 16
+    assert program.symbols['SCREEN'] == 0x200
+    assert list(program.source_map) == [2, 3, 5, 6, 8, 9, 10]
+    assert program.to_bitstrings() == assembler.assemble_ast(
+        assembler.parse_and_validate_ast(source))
+
+def test_program_code_is_a_zero_copy_buffer():
+    program = assembler.assemble("    A := 0x1234\n    D = A\n")
+    view = program.memoryview()
+
+    assert view.format == 'H'
+    assert view.tolist() == [0x1234, 0b1110110000010000]
+    program.code[0] = 0x4321
+    assert view[0] == 0x4321
@@ -0,0 +1,60 @@
+import cli
+import pytest
+
+from pathlib import Path
+
+
+TEST_DIR = Path(__file__).resolve().parent
+
+
+@pytest.fixture
+def sources(tmp_path):
+    (tmp_path / 'nested').mkdir()
+    for name, directory in (('Add', tmp_path), ('Max', tmp_path / 'nested')):
+        source = (TEST_DIR / 'test_files' / (name + '.asm')).read_text()
+        (directory / (name + '.asm')).write_text(source)
+    (tmp_path / 'Broken.asm').write_text("A := 1\nD, D = A\n")
+    return tmp_path
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_batch_assembles_every_file_in_directories(sources, jobs, capsys):
+    assert cli.main(['--jobs', str(jobs), str(sources)]) == 1
+
+    for name, directory in (('Add', sources), ('Max', sources / 'nested')):
+        expected = (TEST_DIR / 'test_files' / (name + '.hack')).read_text()
+        assert (directory / (name + '.hack')).read_text().split() == expected.split()
+    assert not (sources / 'Broken.hack').exists()
+    # No temporary files should be left behind.
+    assert not list(sources.rglob('*.tmp'))
+
+    output = capsys.readouterr().out
+    assert "ok     {} (6 instructions".format(sources / 'Add.asm') in output
+    assert "FAILED {}".format(sources / 'Broken.asm') in output
+    assert "Duplicate assignment target, D already used" in output
+    assert "2 assembled, 1 failed" in output
+
+
+def test_batch_results_are_in_order(sources):
+    source_files = cli.find_sources([sources])
+    results = list(cli.assemble_batch(source_files, jobs=2))
+
+    assert [result.source_file for result in results] == source_files
+    assert [result.instruction_count for result in results] == [6, 0, 16]
+
+
+def test_failed_assembly_keeps_previous_output(sources):
+    assembled_file = sources / 'Broken.hack'
+    assembled_file.write_text("previous\n")
+
+    (result, ) = cli.assemble_batch([sources / 'Broken.asm'])
+
+    assert result.error is not None
+    assert assembled_file.read_text() == "previous\n"
+
+
+@pytest.mark.parametrize("jobs", ['0', '-2'])
+def test_jobs_below_one_are_rejected(sources, jobs, capsys):
+    with pytest.raises(SystemExit):
+        cli.main(['--jobs', jobs, str(sources)])
+    assert "--jobs has to be at least 1" in capsys.readouterr().err
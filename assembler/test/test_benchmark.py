@@ -0,0 +1,40 @@
+import assembler
+import benchmark
+import pytest
+
+
+@pytest.mark.parametrize("mix", [
+    benchmark.Mix(),
+    benchmark.Mix.parse('a_label=0.5,label=0.01,forward_references=0.9'),
+    benchmark.Mix.parse('c_instruction=0,a_symbol=1,symbols=5'),
+])
+def test_generated_programs_are_valid(mix):
+    source = benchmark.generate_program(5_000, seed=1, mix=mix)
+    assert assembler.assemble(source).code == assembler.assemble_with_parser(source).code
+
+def test_generated_programs_keep_labels_in_range():
+    # Past 32K instructions labels can't be loaded, so they're only defined
+    # before that.
+    program = assembler.assemble(benchmark.generate_program(40_000, mix=benchmark.Mix(
+        a_label=0.3, label=0.05)))
+    assert len(program) > 0x8000
+    assert max(program.labels.values()) <= 0x7FFF
+
+def test_unknown_kinds_of_lines_are_rejected():
+    with pytest.raises(ValueError):
+        benchmark.Mix.parse('b_instruction=1')
+
+def test_regressions_are_flagged_past_the_tolerance():
+    baseline = {'results': [
+        {'case': 'api', 'lines': 1000, 'seconds': 1.0, 'peak_rss_kb': 1000},
+        {'case': 'cli', 'lines': 1000, 'seconds': 1.0, 'peak_rss_kb': 1000},
+    ]}
+    results = [
+        benchmark.Result('api', 1000, 1.1, 1300),
+        benchmark.Result('cli', 1000, 1.5, 1000),
+        benchmark.Result('startup', 0, 9.0, 9000),
+    ]
+    assert benchmark.find_regressions(results, baseline, tolerance=0.2) == [
+        "api 1000: 1300 KB peak RSS, was 1000 KB",
+        "cli 1000: 1.500 s, was 1.000 s",
+    ]
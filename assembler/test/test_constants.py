@@ -0,0 +1,134 @@
+import assembler
+import cli
+import incremental
+import linker
+import optimizer
+import pytest
+
+
+def run(instructions):
+    """Runs straight-line `instructions` that don't touch memory, returning
+    the final values of A and D."""
+    a = d = 0
+    for instruction in instructions:
+        if not instruction & (1 << 15):
+            a = instruction
+            continue
+        output = assembler.alu(instruction, d, a)
+        if instruction & assembler.DESTINATIONS['A']:
+            a = output
+        if instruction & assembler.DESTINATIONS['D']:
+            d = output
+    return a, d
+
+
+@pytest.mark.parametrize("register", ['A', 'D'])
+def test_every_constant_is_loaded_by_the_shortest_sequence(register):
+    for value in range(0x10000):
+        instructions = assembler.synthesize_constant(register, value)
+        (a, d) = run(instructions)
+        assert (a if register == 'A' else d) == value
+        # One instruction can only load a 15-bit constant into A or have the
+        # ALU compute 0, 1 or -1.
+        if value in (0, 1, 0xFFFF) or (register == 'A' and value <= 0x7FFF):
+            assert len(instructions) == 1
+        else:
+            assert len(instructions) == 2
+
+@pytest.mark.parametrize("pseudo_instruction, expanded", [
+    ("A := -5", "A := 5\nA = -A"),
+    ("A := 0xFFFF", "A = -1"),
+    ("A := 65535", "A = -1"),
+    ("A := 0x8000", "A := 32767\nA = ~A"),
+    ("A := -0x8000", "A := 32767\nA = ~A"),
+    ("D := 0", "D = 0"),
+    ("D := 7", "A := 7\nD = A"),
+    ("D := -2", "A := 2\nD = -A"),
+    ("D:=0x7FFF // comment", "A := 32767\nD = A"),
+])
+def test_pseudo_instructions_expand(pseudo_instruction, expanded):
+    code = assembler.assemble(expanded).code
+    assert assembler.assemble(pseudo_instruction).code == code
+    assert assembler.assemble_with_parser(pseudo_instruction).code == code
+
+
+SOURCE = """\
+start:
+    D := -100
+    A := @loop
+loop:
+    D = D + 1
+    A := @loop
+    D; jlt
+    A := 0xC000
+    A := $done
+    *A = -1
+    A := @start
+    0; jmp
+"""
+
+def test_labels_account_for_expanded_instructions():
+    program = assembler.assemble(SOURCE)
+    assert program.labels == {'start': 0, 'loop': 3}
+    assert program.source_map.tolist() == [2, 2, 3, 5, 6, 7, 8, 8, 9, 10, 11, 12]
+
+    assert assembler.assemble_with_parser(SOURCE) == program
+    lines = SOURCE.splitlines(keepends=True)
+    streamed = assembler.assemble_lines(lines, assembler.collect_labels(lines))
+    assert list(streamed) == program.code.tolist()
+    incremental_assembler = incremental.IncrementalAssembler()
+    incremental_assembler.update(SOURCE.replace("D := -100", "D := 1"))
+    assert incremental_assembler.update(SOURCE) == program
+    module = linker.compile_module(SOURCE)
+    assert module.labels == program.labels
+    assert module.source_map == program.source_map
+
+def test_optimizer_removes_instructions_from_expansions():
+    program, report = optimizer.assemble_optimized("""\
+    D := 0x8000
+    A := 32767
+    *A = D
+""")
+    assert program.code == assembler.assemble("""\
+    A := 32767
+    D = ~A
+    *A = D
+""").code
+    assert program.source_map.tolist() == [1, 1, 3]
+    assert report.removed == [(2, 'redundant load')]
+
+@pytest.mark.parametrize("assembly", [
+    "    A := 0x10000\n",
+    "    D := -0x8001\n",
+    "    D := 70000\n",
+])
+def test_constants_past_16_bits_are_rejected(assembly):
+    with pytest.raises(assembler.ValidationError) as excinfo:
+        assembler.assemble(assembly)
+    assert "cannot fit in 16 bits" in str(excinfo.value)
+
+def test_listing_shows_expansions():
+    source = """\
+// Fills the screen
+    A := 0xFFFF
+    D := 100
+loop:
+    A := $i
+"""
+    assert assembler.assemble(source).listing(source) == """\
+                1  // Fills the screen
+                2      A := 0xFFFF
+0000  EEA0                 A = -1
+                3      D := 100
+0001  0064                 A := 100
+0002  EC10                 D = A
+                4  loop:
+0003  0010      5      A := $i
+"""
+
+def test_listing_is_written_next_to_the_source(tmp_path):
+    source_file = tmp_path / 'Constants.asm'
+    source_file.write_text(SOURCE)
+    assert cli.main([str(source_file), '--listing']) == 0
+    assert (tmp_path / 'Constants.lst').read_text() == \
+        assembler.assemble(SOURCE).listing(SOURCE)
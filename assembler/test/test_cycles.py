@@ -0,0 +1,103 @@
+import assembler
+import cli
+import cycles
+import pytest
+
+from pathlib import Path
+
+
+TEST_DIR = Path(__file__).resolve().parent
+
+COUNTER = """\
+start:
+   A := 9
+   D = A
+loop:
+   D = D - 1
+   A := @loop
+   D; jne
+   A := @start
+   0; jmp
+"""
+
+
+def analyze(source):
+    return cycles.CycleAnalysis(assembler.assemble(source))
+
+
+def test_loops_are_costed_per_iteration():
+    analysis = analyze(COUNTER)
+    assert [(loop.header, loop.blocks) for loop in analysis.loops] == [(0, [0, 2, 5]), (2, [2])]
+    # The inner loop takes a cycle more than its three instructions for the
+    # jump back, the outer loop goes through the inner one once.
+    assert [(loop.min_cycles, loop.max_cycles) for loop in analysis.loops] == [(8, 8), (4, 4)]
+
+def test_cycles_count_the_extra_cycle_for_taken_jumps():
+    analysis = analyze((TEST_DIR / 'test_files' / 'Max.asm').read_text())
+    cycles = analysis.instruction_cycles()
+    # Falling through the `D; jgt` at 5 costs a cycle, taking it two.
+    assert cycles[5:8] == [6, 7, 8]
+    assert cycles[10] == 8
+    assert analysis.exits() == [('halts', 14)]
+    assert analysis.min_entry[14] == 11
+    assert analysis.max_entry[14] == 13
+
+def test_jumps_on_constants_are_followed_one_way():
+    analysis = analyze("""\
+    A := @skip
+    0; jeq
+    D = 1
+skip:
+    A := @skip
+    0; jgt
+""")
+    assert analysis.instruction_cycles() == [1, 2, None, 4, 5]
+    assert analysis.loops == []
+    assert analysis.exits() == [('ends', 3)]
+
+def test_nested_loops_count_inner_iterations_once():
+    analysis = analyze("""\
+outer:
+    D = 1
+inner:
+    D = D - 1
+    A := @inner
+    D; jgt
+    A := @outer
+    D; jeq
+    *A = D
+""")
+    (outer, inner) = analysis.loops
+    assert (inner.min_cycles, inner.max_cycles) == (4, 4)
+    assert (outer.min_cycles, outer.max_cycles) == (7, 7)
+    assert analysis.exits() == [('ends', 6)]
+
+def test_summary_reports_unknown_jumps_and_delay_slots():
+    analysis = analyze("""\
+    A := $return
+    A = *A
+    0; jmp
+    D = 1
+""")
+    assert analysis.summary() == [
+        "Jumps from 0002 to an unknown address after 4 cycles, not counting loops",
+        "Instruction at 0003 still runs when the jump before it is taken",
+    ]
+
+def test_listing_includes_cycles_and_summary(tmp_path):
+    source_file = tmp_path / 'Counter.asm'
+    source_file.write_text(COUNTER)
+    assert cli.main([str(source_file), '--cycles']) == 0
+    assert (tmp_path / 'Counter.lst').read_text() == """\
+                         1  start:
+0000  0009        1      2     A := 9
+0001  EC10        2      3     D = A
+                         4  loop:
+0002  E390        3      5     D = D - 1
+0003  0002        4      6     A := @loop
+0004  E305        5      7     D; jne
+0005  0000        6      8     A := @start
+0006  EA87        7      9     0; jmp
+// Loop at 0000 (start): 3 blocks, 8 cycles per iteration
+// Loop at 0002 (loop): 1 block, 4 cycles per iteration
+"""
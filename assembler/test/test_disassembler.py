@@ -0,0 +1,54 @@
+import array
+import assembler
+import disassembler
+import pytest
+
+from pathlib import Path
+
+
+TEST_DIR = Path(__file__).resolve().parent
+
+
+def test_every_word_with_assembly_assembles_back_to_itself():
+    words = [word for word, text in enumerate(disassembler.DISASSEMBLY) if text is not None]
+    source = '\n'.join(disassembler.disassemble(array.array('H', words))) + '\n'
+    ast = assembler.parse_and_validate_ast(source)
+    assert [int(bits, 2) for bits in assembler.assemble_ast(ast)] == words
+    # Every computation the assembler can encode can be disassembled.
+    for encoded in assembler.COMPUTATIONS.values():
+        assert disassembler.disassemble_word(encoded) is not None
+
+@pytest.mark.parametrize("word, text", [
+    (0x0000, "A := 0"),
+    (0x7FFF, "A := 32767"),
+    (0xEC10, "D = A"),
+    (0xE088, "*A = D + A"),
+    (0xF1D0, "D = *A - D"),
+    (0xEA87, "0; jmp"),
+    (0xE300, "D"),
+    (0xFC38, "A, D, *A = *A"),
+    (0xE305, "D; jne"),
+])
+def test_words_are_written_in_the_usual_way(word, text):
+    assert disassembler.disassemble_word(word) == text
+
+@pytest.mark.parametrize("word", [
+    # Bits 14 and 13 aren't set.
+    0x8000,
+    # No computation is encoded with these ALU control bits.
+    0xE040,
+])
+def test_words_without_assembly_are_left_as_comments(word):
+    assert disassembler.disassemble_word(word) is None
+    assert disassembler.disassembly(array.array('H', [word, 5])) == \
+        "// {:04X} has no assembly\nA := 5\n".format(word)
+
+def test_programs_disassemble_from_any_buffer():
+    program = assembler.assemble((TEST_DIR / 'test_files' / 'Max.asm').read_text())
+    source = disassembler.disassembly(program.code)
+    assert assembler.assemble(source).code == program.code
+    assert disassembler.disassemble(program.code.tobytes()) == \
+        disassembler.disassemble(program.code)
+
+    listing = disassembler.disassembly(program.code[:2], addresses=True)
+    assert listing == "A := 0                  // 0000\nD = *A                  // 0001\n"
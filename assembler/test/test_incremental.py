@@ -0,0 +1,109 @@
+import assembler
+import cli
+import incremental
+import output_formats
+import pytest
+
+from pathlib import Path
+
+
+TEST_DIR = Path(__file__).resolve().parent
+
+SOURCE = """\
+    A := $counter
+    *A = D
+loop:
+    A := @end
+    D; jeq
+    D = D - 1
+    A := @loop
+    0; jmp
+end:
+    A := $result
+    *A = D
+"""
+
+
+def edit(source, lineno, replacement):
+    lines = source.split('\n')
+    lines[lineno - 1:lineno] = replacement
+    return '\n'.join(lines)
+
+
+@pytest.mark.parametrize("lineno, replacement", [
+    # Unchanged.
+    (1, ["    A := $counter"]),
+    # Moves every label after it.
+    (2, ["    *A = D", "    D = A"]),
+    (6, []),
+    # Changes the symbol allocation order.
+    (1, ["    A := $result", "    A := $counter"]),
+    (10, ["    A := $other"]),
+    (4, ["    A := @loop"]),
+    (9, ["end:", "new_label:", "    A := @new_label"]),
+])
+def test_incremental_update_matches_assembling_from_scratch(lineno, replacement):
+    incremental_assembler = incremental.IncrementalAssembler()
+    incremental_assembler.update(SOURCE)
+
+    source = edit(SOURCE, lineno, replacement)
+    program = incremental_assembler.update(source)
+    expected = assembler.assemble(source)
+    assert program.code == expected.code
+    assert program.labels == expected.labels
+    assert program.symbols == expected.symbols
+    assert program.source_map == expected.source_map
+
+def test_incremental_update_reports_errors_and_recovers():
+    incremental_assembler = incremental.IncrementalAssembler()
+    incremental_assembler.update(SOURCE)
+
+    for broken in ([" D, D = A"], ["    A := @nowhere"], ["    A := 0x10000"]):
+        source = edit(SOURCE, 5, broken)
+        with pytest.raises(assembler.ValidationError) as excinfo:
+            incremental_assembler.update(source)
+        with pytest.raises(assembler.ValidationError) as expected:
+            assembler.assemble(source)
+        assert str(excinfo.value) == str(expected.value)
+
+    assert incremental_assembler.update(SOURCE).code == assembler.assemble(SOURCE).code
+
+@pytest.mark.parametrize("old_code, new_code, ranges", [
+    ([1, 2, 3], [1, 2, 3], []),
+    ([1, 2, 3], [1, 5, 3], [(1, 2)]),
+    ([1, 2, 3], [1, 2, 3, 4, 5], [(3, 5)]),
+    ([1, 2, 3], [1, 5], [(1, 2)]),
+    (list(range(1000)), [5] + list(range(1, 600)) + [7] + list(range(601, 1000)),
+     [(0, 1), (600, 601)]),
+])
+def test_changed_ranges(old_code, new_code, ranges):
+    assert list(output_formats.changed_ranges(old_code, new_code)) == ranges
+
+def test_watcher_updates_only_changed_files(tmp_path):
+    for name in ('Add', 'Max'):
+        source = (TEST_DIR / 'test_files' / (name + '.asm')).read_text()
+        (tmp_path / (name + '.asm')).write_text(source)
+    formats = list(output_formats.OUTPUT_FORMATS)
+    watcher = cli.Watcher(cli.find_sources([tmp_path]), formats)
+
+    results = list(watcher.poll())
+    assert [result.source_file.name for result in results] == ['Add.asm', 'Max.asm']
+    assert all(result.error is None for result in results)
+    assert list(watcher.poll()) == []
+
+    max_source = tmp_path / 'Max.asm'
+    max_source.write_text(edit(max_source.read_text(), 3, ["    D = *A // edit", "    D = D + 1"]))
+    (result, ) = watcher.poll()
+    assert result.source_file == max_source
+    assert result.instruction_count == 18
+    assert result.changed_instructions > 0
+
+    # The updated files are the same as ones written from scratch.
+    assembler.assemble(max_source.read_text()).write(tmp_path / 'Expected', formats)
+    for output_format in output_formats.OUTPUT_FORMATS.values():
+        assert ((tmp_path / ('Max' + output_format.suffix)).read_bytes() ==
+                (tmp_path / ('Expected' + output_format.suffix)).read_bytes())
+
+    max_source.write_text("    A := 1\n    D, D = A\n")
+    (result, ) = watcher.poll()
+    assert "Duplicate assignment target" in result.error
@@ -22,3 +22,4 @@ def test_against_known_file(test_file):
 
     ast = assembler.parse_and_validate_ast(source)
     assert assembler.assemble_ast(ast) == expected
+    assert assembler.assemble_source(source) == [int(line, 2) for line in expected]
@@ -0,0 +1,112 @@
+import assembler
+import cli
+import linker
+import pytest
+
+
+MODULES = {
+    'main.asm': """\
+#include "lib/math.asm"
+    A := $x
+    D = *A
+    A := @double
+    0; jmp
+return:
+    A := $y
+    *A = D
+#include "lib/util.asm"
+""",
+    'lib/math.asm': """\
+#include "util.asm"
+double:
+    D = D + *A
+    A := $tmp
+    A := @return
+    0; jmp
+""",
+    'lib/util.asm': """\
+// Includes back into math.asm, which is only included once.
+#include "math.asm"
+spin:
+    A := @spin
+    0; jmp
+""",
+}
+
+
+def write_modules(directory, modules):
+    for name, source in modules.items():
+        path = directory / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(source)
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_linking_matches_assembling_modules_pasted_together(tmp_path, jobs):
+    write_modules(tmp_path, MODULES)
+    program = linker.Linker(jobs).link(tmp_path / 'main.asm')
+
+    order = ['main.asm', 'lib/math.asm', 'lib/util.asm']
+    assert program.modules == [
+        (tmp_path / 'main.asm', 0), (tmp_path / 'lib/math.asm', 6),
+        (tmp_path / 'lib/util.asm', 10)]
+    pasted = assembler.assemble('\n'.join(
+        MODULES[name].replace('#include', '//') for name in order))
+    assert program.code == pasted.code
+    assert program.labels == pasted.labels == {'return': 4, 'double': 6, 'spin': 10}
+    assert program.symbols == pasted.symbols
+
+def test_unchanged_modules_are_reused(tmp_path, monkeypatch):
+    write_modules(tmp_path, MODULES)
+    module_linker = linker.Linker()
+    module_linker.link(tmp_path / 'main.asm')
+
+    compiled = []
+    compile_module = linker.compile_module
+    def counting_compile_module(source):
+        compiled.append(source)
+        return compile_module(source)
+    monkeypatch.setattr(linker, 'compile_module', counting_compile_module)
+
+    (tmp_path / 'main.asm').write_text(MODULES['main.asm'].replace('$y', '$z'))
+    program = module_linker.link(tmp_path / 'main.asm')
+    assert len(compiled) == 1
+    assert program.symbols['z'] == 17
+
+@pytest.mark.parametrize("modules, error_path, message, lineno", [
+    ({'main.asm': '#include "nope.asm"\n'},
+     'main.asm', "Can't read included module", 1),
+    ({'main.asm': '#include "b.asm"\nx:\n', 'b.asm': 'x:\n    D = A\n'},
+     'b.asm', "Label x already defined in", 1),
+    ({'main.asm': '#include "b.asm"\n', 'b.asm': '    D = A\n    A := @where\n'},
+     'b.asm', "Label where used but never defined", 2),
+    ({'main.asm': '#include "b.asm"\n', 'b.asm': '    D = A\n    D, D = A\n'},
+     'b.asm', "Duplicate assignment target, D already used", 2),
+])
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_link_errors_point_at_module(tmp_path, modules, error_path, message,
+                                     lineno, jobs):
+    write_modules(tmp_path, modules)
+    with pytest.raises(linker.ModuleError) as excinfo:
+        linker.Linker(jobs).link(tmp_path / 'main.asm')
+
+    assert excinfo.value.path == tmp_path / error_path
+    assert message in excinfo.value.error.message
+    assert excinfo.value.error.lineno == lineno
+
+def test_cli_links_files_with_includes(tmp_path):
+    write_modules(tmp_path, MODULES)
+    assert cli.main([str(tmp_path / 'main.asm')]) == 0
+
+    linked = linker.Linker().link(tmp_path / 'main.asm')
+    assert (tmp_path / 'main.hack').read_text().split() == linked.to_bitstrings()
+
+def test_includes_in_comments_are_not_linked(tmp_path):
+    source = "// No #include \"lib.asm\" here.\nA := 2\nD = A\n"
+    (tmp_path / 'main.asm').write_text(source)
+    assert not linker.has_includes(source)
+    # Programs with includes can't be optimized, so this would fail if the
+    # comment was taken for one.
+    assert cli.main(['--optimize', str(tmp_path / 'main.asm')]) == 0
+    assert (tmp_path / 'main.hack').read_text().split() == \
+        assembler.assemble(source).to_bitstrings()
@@ -0,0 +1,286 @@
+import assembler
+import cli
+import optimizer
+import pytest
+
+from pathlib import Path
+
+
+TEST_DIR = Path(__file__).resolve().parent
+
+
+def optimize(source):
+    program, report = optimizer.assemble_optimized(source)
+    return program, report
+
+def assert_optimizes_to(source, expected):
+    program, _ = optimize(source)
+    assert program.code == assembler.assemble(expected).code
+
+
+def test_redundant_loads_are_removed():
+    assert_optimizes_to("""\
+    A := $address
+    D = *A
+    A := $address
+    *A = D + 1
+    A := 5
+    D = A
+    A := 5
+""", """\
+    A := $address
+    D = *A
+    *A = D + 1
+    A := 5
+    D = A
+""")
+
+def test_values_are_tracked_through_computations():
+    # A is 0 after `A = A - 1`, and D already holds A after `D = A`.
+    assert_optimizes_to("""\
+    A := 1
+    A = A - 1
+    *A = D
+    A := 0
+    D = A
+    D = A
+    A = D
+    *A = 1
+""", """\
+    A := 1
+    A = A - 1
+    *A = D
+    D = A
+    *A = 1
+""")
+
+def test_labels_forget_tracked_values():
+    source = """\
+    A := $x
+    *A = 0
+loop:
+    A := $x
+    *A = *A + 1
+    A := @loop
+    0; jmp
+"""
+    program, report = optimize(source)
+    assert program.code == assembler.assemble(source).code
+    assert report.saved == 0
+
+def test_overwritten_values_are_removed():
+    program, report = optimize("""\
+    D = A
+    A := 3
+    D = A
+    A := $x
+    A := $y
+    *A = D
+""")
+    assert report.removed == [(1, 'dead store'), (4, 'dead store')]
+    assert list(program.code) == assembler.assemble("""\
+    A := 3
+    D = A
+    A := 17
+    *A = D
+""").code.tolist()
+
+def test_values_used_by_a_jump_are_kept():
+    source = """\
+    D = A
+    A := @end
+    D; jeq
+    D = 0
+end:
+    A := @end
+    0; jmp
+"""
+    program, report = optimize(source)
+    assert program.code == assembler.assemble(source).code
+    assert report.saved == 0
+
+def test_jumps_are_threaded_and_unreachable_code_removed():
+    program, report = optimize("""\
+    A := @first
+    D; jgt
+    D = D - 1
+    A := @first
+    0; jmp
+    D = D + 1
+    A := $x
+    *A = D
+first:
+    A := @second
+    0; jmp
+    0
+second:
+    A := @second
+    0; jmp
+    0
+""")
+    # The instructions right after the jumps run whether they're taken or
+    # not, so they stay.
+    assert program.code == assembler.assemble("""\
+    A := @second
+    D; jgt
+    D = D - 1
+    0; jmp
+    D = D + 1
+second:
+    A := @second
+    0; jmp
+    0
+""").code
+    # Labels still point at the right instructions.
+    assert program.labels == {'first': 5, 'second': 5}
+    assert report.threaded_jumps == 2
+    assert str(report) == (
+        "Saved 6 instructions, 1 redundant load, 5 unreachable, threaded 2 jumps")
+
+@pytest.mark.parametrize("source", [
+    # A isn't loaded again after the jump, in case it's not taken.
+    """\
+    A := @trampoline
+    D; jgt
+    D = D - 1
+    *A = D
+""",
+    # The instruction after the jump uses A.
+    """\
+    A := @trampoline
+    0; jmp
+    D = A
+""",
+    # The instruction after the trampoline's jump does something, and the
+    # jump would skip it.
+    """\
+    A := @trampoline
+    0; jmp
+    0
+trampoline:
+    A := @end
+    0; jmp
+    D = D + 1
+end:
+    A := @end
+    0; jmp
+    0
+""",
+])
+def test_jumps_are_only_threaded_when_nothing_notices(source):
+    if 'trampoline:' not in source:
+        source += """\
+trampoline:
+    A := @end
+    0; jmp
+    0
+end:
+    A := @end
+    0; jmp
+    0
+"""
+    program, report = optimize(source)
+    assert program.code == assembler.assemble(source).code
+    assert report.threaded_jumps == 0
+
+@pytest.mark.parametrize("source", [
+    # The instruction after an unconditional jump still runs.
+    """\
+    A := @done
+    0; jmp
+    D = D + 1
+done:
+    A := 100
+    *A = D
+""",
+    # A is already @skip, but taking the load out would move the next
+    # instruction after the jump.
+    """\
+    A := @skip
+    D; jeq
+    A := @skip
+    D = D + 1
+skip:
+    A := 100
+    *A = D
+""",
+    # The increment reads the word latched while A is loaded again, which
+    # comes after the write.
+    """\
+    A := 5
+    *A = D
+    A := 5
+    *A = *A + 1
+""",
+])
+def test_instructions_others_depend_on_the_position_of_are_kept(source):
+    program, report = optimize(source)
+    assert program.code == assembler.assemble(source).code
+    assert report.saved == 0
+
+def test_symbols_keep_their_unoptimized_addresses():
+    program, report = optimize("""\
+    A := $removed
+    A := $kept
+    *A = 0
+""")
+    assert [line for (line, _) in report.removed] == [1]
+    assert program.symbols['removed'] == 16
+    assert program.symbols['kept'] == 17
+    assert list(program.code) == [17, assembler.assemble("*A = 0").code[0]]
+    assert list(program.source_map) == [2, 3]
+
+def test_labels_defined_twice_keep_what_they_refer_to():
+    program, report = optimize("""\
+    A := @twice
+    0; jmp
+    0
+twice:
+    A := @end
+    0; jmp
+    0
+twice:
+    A := 100
+    *A = -1
+end:
+    A := @end
+    0; jmp
+    0
+""")
+    # The jump comes before either definition so it goes to the last one,
+    # not to the first one that just jumps on, which is never jumped to.
+    assert program.code == assembler.assemble("""\
+    A := @twice
+    0; jmp
+    0
+twice:
+    A := 100
+    *A = -1
+end:
+    A := @end
+    0; jmp
+    0
+""").code
+    assert program.labels == {'twice': 3, 'end': 5}
+    assert report.threaded_jumps == 0
+    assert report.saved == 3
+
+def test_known_files_are_unchanged():
+    source = (TEST_DIR / 'test_files' / 'Max.asm').read_text()
+    program, report = optimize(source)
+    assert program.code == assembler.assemble(source).code
+    assert report.saved == 0
+
+def test_optimizing_reports_validation_errors():
+    with pytest.raises(assembler.ValidationError) as excinfo:
+        optimize("    A := 1\n    D, D = A\n")
+    assert excinfo.value.lineno == 2
+
+def test_cli_reports_saved_instructions(tmp_path, capsys):
+    source_file = tmp_path / 'Program.asm'
+    source_file.write_text("    A := 1\n    A := 1\n    D = A\n")
+    assert cli.main(['-O', str(source_file)]) == 0
+
+    assert "(2 instructions, 1 saved" in capsys.readouterr().out
+    assert (tmp_path / 'Program.hack').read_text().split() == \
+        assembler.assemble("    A := 1\n    D = A\n").to_bitstrings()
@@ -0,0 +1,94 @@
+import assembler
+import cli
+import output_formats
+import pytest
+
+
+SOURCE = """\
+    A := 0x1234
+    D = A
+    A := 7
+    D; jgt
+"""
+MACHINE_CODE = [0x1234, 0xEC10, 0x0007, 0xE301]
+
+
+@pytest.fixture
+def source_file(tmp_path):
+    source_file = tmp_path / 'program.asm'
+    source_file.write_text(SOURCE)
+    return source_file
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_writes_several_formats_in_one_run(source_file, stream):
+    formats = list(output_formats.OUTPUT_FORMATS)
+    assert cli.assemble_file(source_file, formats=formats, stream=stream) == 4
+
+    directory = source_file.parent
+    assert (directory / 'program.hack').read_text() == ''.join(
+        output_formats.to_bitstring(word) + '\n' for word in MACHINE_CODE)
+    assert (directory / 'program.bin').read_bytes() == bytes.fromhex('3412 10EC 0700 01E3')
+    assert (directory / 'program.be.bin').read_bytes() == bytes.fromhex('1234 EC10 0007 E301')
+    assert (directory / 'program.mem').read_text() == "1234\nEC10\n0007\nE301\n"
+    assert (directory / 'program.coe').read_text() == (
+        "memory_initialization_radix=16;\n"
+        "memory_initialization_vector=\n"
+        "1234,\nEC10,\n0007,\nE301;\n")
+    assert (directory / 'program.hex').read_text() == (
+        ":080000001234EC100007E301CB\n"
+        ":00000001FF\n")
+
+
+def intel_hex_records(text):
+    for line in text.splitlines():
+        assert line.startswith(':')
+        record = bytes.fromhex(line[1:])
+        # All the bytes of a record, including its checksum, sum to zero.
+        assert sum(record) & 0xFF == 0
+        assert record[0] == len(record) - 5
+        yield record[3], int.from_bytes(record[1:3], 'big'), record[4:-1]
+
+
+def test_intel_hex_uses_extended_addresses_past_64k_words(tmp_path):
+    machine_code = [i & 0xFFFF for i in range(0x10010)]
+    output_formats.write_output_files(tmp_path / 'large', machine_code, ['ihex'])
+
+    words = {}
+    upper_address = 0
+    records = list(intel_hex_records((tmp_path / 'large.hex').read_text()))
+    for record_type, address, data in records:
+        if record_type == 0x04:
+            upper_address = int.from_bytes(data, 'big') << 16
+        elif record_type == 0x00:
+            for i in range(0, len(data), 2):
+                words[upper_address + address + i // 2] = int.from_bytes(data[i:i + 2], 'big')
+    assert records[-1] == (0x01, 0, b'')
+    assert [words[i] for i in range(len(machine_code))] == machine_code
+
+
+def test_formats_have_to_write_instructions(tmp_path):
+    class UnfinishedFormat(output_formats.OutputFormat):
+        suffix = '.txt'
+
+    with open(tmp_path / 'program.txt', 'w') as f:
+        with pytest.raises(TypeError):
+            UnfinishedFormat(f)
+
+
+def test_cli_accepts_multiple_formats(source_file):
+    assert cli.main(['-f', 'bin', '-f', 'coe', str(source_file)]) == 0
+    assert (source_file.parent / 'program.bin').exists()
+    assert (source_file.parent / 'program.coe').exists()
+    assert not (source_file.parent / 'program.hack').exists()
+
+@pytest.mark.parametrize("output_format", ['hack', 'bin', 'bin-be', 'mem'])
+def test_rom_images_are_read_in_each_format(tmp_path, output_format):
+    program = assembler.assemble(SOURCE)
+    output_formats.write_output_files(tmp_path / 'program', program.code, [output_format])
+    rom = tmp_path / ('program' + output_formats.OUTPUT_FORMATS[output_format].suffix)
+    assert output_formats.read_rom(rom) == program.code
+
+def test_unknown_rom_images_are_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        output_formats.read_rom(tmp_path / 'program.coe')
@@ -0,0 +1,89 @@
+import assembler
+import cli
+import pytest
+import lark
+
+import io
+
+
+def assemble_streaming(source):
+    lines = list(io.StringIO(source))
+    labels = assembler.collect_labels(lines)
+    return list(assembler.assemble_lines(lines, labels))
+
+
+def test_streaming_matches_whole_source_assembly():
+    source = """\
+// Labels before and after their use.
+start:
+    A := @end
+    D = A   // comment
+A:
+
+    A := $var
+    *A = D; jmp
+    A := @A
+end:
+    A := $other
+    A := @start
+    0; jmp
+"""
+    assert assemble_streaming(source) == assembler.assemble_source(source)
+
+
+@pytest.mark.parametrize("source", [
+    "loop:\n    A := @loop\nloop:\n    0\n",
+    "    A := @L\nL:\n    A := @L\n    0\nL:\n    A := @L\n",
+    "L:\n    A := 0xFFFF\nL:\n    A := @L\n    D := -2\nL:\n    A := @L\n",
+])
+def test_streaming_resolves_labels_defined_twice_like_whole_source_assembly(source):
+    assert assemble_streaming(source) == assembler.assemble_source(source)
+
+
+def test_streaming_handles_missing_trailing_newline():
+    assert assemble_streaming("A := 3\nD = A") == [3, 0b1110110000010000]
+
+
+def test_streaming_reports_errors_on_the_right_line():
+    source = """\
+    A := 1
+loop:
+    D, D = A
+"""
+    with pytest.raises(assembler.ValidationError) as excinfo:
+        assemble_streaming(source)
+
+    assert excinfo.value.lineno == 3
+    assert "Duplicate assignment target, D already used" in str(excinfo.value)
+    assert "    D, D = A\n    ^^^^^^" in str(excinfo.value)
+
+
+def test_streaming_reports_missing_labels():
+    source = "A := 1\nA := @missing\n"
+    with pytest.raises(assembler.ValidationError) as excinfo:
+        assemble_streaming(source)
+
+    assert excinfo.value.lineno == 2
+    assert "Label missing used but never defined" in str(excinfo.value)
+
+
+def test_streaming_reports_syntax_errors_on_the_right_line():
+    source = "A := 1\n\nD = 5\n"
+    with pytest.raises(lark.exceptions.UnexpectedInput) as excinfo:
+        assemble_streaming(source)
+
+    assert excinfo.value.line == 3
+
+
+def test_streaming_file_assembly(tmp_path):
+    source_file = tmp_path / 'Max.asm'
+    assembled_file = tmp_path / 'Max.hack'
+    source_file.write_text("""\
+    A := @end
+    D = A
+end:
+    0; jmp
+""")
+    cli.assemble_file_streaming(source_file, assembled_file)
+    assert assembled_file.read_text() == (
+        "0000000000000010\n1110110000010000\n1110101010000111\n")
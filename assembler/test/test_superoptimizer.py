@@ -0,0 +1,126 @@
+import assembler
+import cli
+import optimizer
+import pytest
+import random
+import superoptimizer
+
+
+def code(source):
+    return tuple(assembler.assemble(source).code)
+
+
+@pytest.mark.parametrize("window, expected", [
+    ("D = A\nD = D + 1", "D = A + 1"),
+    ("D = 0\nD = D + 1", "D = 1"),
+    ("*A = D\nD = *A", "*A = D"),
+    ("D = D\nA = A", ""),
+    ("A := 2\nD = A\nA := 3", "A := 3\nD = A - 1"),
+    ("D = *A\nA = D\nD = D + A", "A, D = *A\nD = D + A"),
+])
+def test_search_finds_shorter_equivalents(window, expected):
+    assert superoptimizer.search(code(window)) == code(expected)
+
+@pytest.mark.parametrize("window", [
+    "A = A + 1\nA = A + 1",
+    "D = D + A\nA = D - A",
+    # *A refers to a different word once A changes.
+    "A = A + 1\n*A = D\nD = *A",
+    # The increment reads the word latched before the first write.
+    "*A = D\n*A = *A + 1",
+])
+def test_search_gives_up_when_there_is_nothing_shorter(window):
+    assert superoptimizer.search(code(window)) is None
+
+def test_serial_execution_matches_plain_execution():
+    rng = random.Random(0)
+    instructions = [rng.choice(superoptimizer.C_INSTRUCTIONS) for _ in range(6)]
+    for _ in range(20):
+        state = [rng.getrandbits(16) for _ in range(4)]
+        values = [0] * 4
+        carries = (0, ) * superoptimizer.additions(instructions)
+        for bit in range(16):
+            (bits, carries) = superoptimizer.serial_execute(
+                instructions, bit, *(value >> bit & 1 for value in state), carries)
+            values = [value | register << bit for value, register in zip(values, bits)]
+        assert tuple(values) == superoptimizer.execute(instructions, *state)
+
+def test_equivalence_checks_every_value():
+    # Only differ when A is 0x4321.
+    assert not superoptimizer.equivalent(code("A := 17185\nD = D + 1"),
+                                         code("A := 17185\nD = D - 1"))
+    assert superoptimizer.equivalent(code("D = -D"), code("D = ~D\nD = D + 1"))
+    assert superoptimizer.equivalent(code("D = D - 1"), code("D = -D\nD = ~D"))
+    assert not superoptimizer.equivalent(code("D = D & A"), code("D = D | A"))
+    # Only differ when the latched word isn't the one at A.
+    assert not superoptimizer.equivalent(code("*A = *A + 1"), code("D, *A = *A + 1\nD = D - 1"))
+
+def test_memory_writes_use_the_latched_word():
+    instructions = code("*A = *A + 1\n*A = *A + 1\nD = *A")
+    # The first increment reads the word latched before the run, and the
+    # second the word from before the first one wrote. Loading D sees both.
+    assert superoptimizer.execute(instructions, 0, 0, 10, 20) == (0, 11, 11, 11)
+
+def test_instructions_in_loops_are_hotter():
+    program = assembler.assemble("""\
+    D = A
+    D = D + 1
+loop:
+    D = A
+    D = D + 1
+    A := @loop
+    D; jgt
+""")
+    heat = superoptimizer.hot_windows(program)
+    # Once outside the loop, and ten times inside it.
+    assert heat[code("D = A\nD = D + 1")] == 11
+
+def test_rules_are_found_saved_and_applied(tmp_path):
+    source = """\
+loop:
+    D = A
+    D = D + 1
+    A := @loop
+    D; jgt
+"""
+    source_file = tmp_path / 'Loop.asm'
+    source_file.write_text(source)
+    rules_file = tmp_path / 'rules.json'
+    assert superoptimizer.main([str(source_file), '--rules', str(rules_file)]) == 0
+
+    rules = optimizer.load_rewrite_rules(rules_file)
+    assert rules[code("D = A\nD = D + 1")] == code("D = A + 1")
+    program, report = optimizer.assemble_optimized(source, rules)
+    assert program.code == assembler.assemble("""\
+loop:
+    D = A + 1
+    A := @loop
+    D; jgt
+""").code
+    assert report.removed == [(3, 'rewritten')]
+
+    assert cli.main([str(source_file), '-O', '--rules', str(rules_file)]) == 0
+    assert (tmp_path / 'Loop.hack').read_text().split() == program.to_bitstrings()
+
+def test_rules_do_not_start_after_a_jump():
+    rules = {code("D = A\nD = D + 1"): code("D = A + 1")}
+    source = """\
+    A := 5
+    D; jgt
+    D = A
+    D = D + 1
+"""
+    program, _ = optimizer.assemble_optimized(source, rules)
+    assert program.code == assembler.assemble(source).code
+
+def test_rules_do_not_span_labels():
+    rules = {code("D = A\nD = D + 1"): code("D = A + 1")}
+    source = """\
+    D = A
+loop:
+    D = D + 1
+    A := @loop
+    D; jgt
+"""
+    program, _ = optimizer.assemble_optimized(source, rules)
+    assert program.code == assembler.assemble(source).code
@@ -0,0 +1,61 @@
+import assembler
+import cli
+import pstats
+import pytest
+import time
+import timings
+
+from pathlib import Path
+
+
+TEST_DIR = Path(__file__).resolve().parent
+
+
+def test_phases_are_reported_to_hooks():
+    calls = []
+    with timings.record_timings(lambda *args: calls.append(args)):
+        assembler.assemble_with_parser("A := 1\nD = A\n")
+    assert [name for (name, _, _) in calls if name != 'grammar'] == [
+        'parse', 'transform', 'resolve labels']
+    assert all(seconds >= 0 for (_, seconds, _) in calls)
+
+    # Nothing is reported outside the with block.
+    reported = len(calls)
+    assembler.assemble_with_parser("A := 1\n")
+    assert len(calls) == reported
+
+def test_nested_phases_only_count_towards_the_innermost():
+    with timings.record_timings() as phase_timings:
+        with timings.phase('outer'):
+            with timings.phase('inner'):
+                time.sleep(0.05)
+    assert phase_timings.phases['inner'][1] >= 0.05
+    assert phase_timings.phases['outer'][1] < 0.05
+
+def test_phases_that_free_memory_report_negative_net_blocks():
+    garbage = [object() for _ in range(10000)]
+    with timings.record_timings() as phase_timings:
+        with timings.phase('free'):
+            del garbage[:]
+    assert phase_timings.phases['free'][2] < 0
+
+def test_timings_are_collected_from_every_job(tmp_path, capsys):
+    for name in ('Add', 'Max'):
+        source = (TEST_DIR / 'test_files' / (name + '.asm')).read_text()
+        (tmp_path / (name + '.asm')).write_text(source)
+    results = list(cli.assemble_batch([tmp_path / 'Add.asm', tmp_path / 'Max.asm'],
+                                            jobs=2, timings=True))
+    for result in results:
+        assert result.timings.phases['write'][0] == 1
+
+    profile = tmp_path / 'assembler.prof'
+    assert cli.main([str(tmp_path), '--timings', '--profile', str(profile)]) == 0
+    output = capsys.readouterr().out
+    assert "phase" in output and "fast path" in output and "write" in output
+    assert "net blocks" in output
+    stats = pstats.Stats(str(profile))
+    assert any(function == 'assemble' for (_, _, function) in stats.stats)
+
+def test_profiling_needs_a_single_job(tmp_path):
+    with pytest.raises(SystemExit):
+        cli.main([str(tmp_path), '--profile', str(tmp_path / 'out'), '-j', '2'])
@@ -41,15 +41,15 @@ def test_validation_fails_with_using_a_and_memory():
 
 def test_validation_fails_with_loading_a_that_does_not_fit():
     assembly = """\
-    A := 0xFFFF
+    A := 0x10000
     """
 
     with pytest.raises(assembler.ValidationError) as excinfo:
         assembler.parse_and_validate_ast(assembly)
 
-    assert "cannot fit in 15-bit immediate" in str(excinfo.value)
-    assert "A := 0xFFFF" in str(excinfo.value)
-    assert "     ^^^^^^" in str(excinfo.value)
+    assert "cannot fit in 16 bits" in str(excinfo.value)
+    assert "A := 0x10000" in str(excinfo.value)
+    assert "     ^^^^^^^" in str(excinfo.value)
 
 
 def test_validation_fails_when_instruction_label_is_not_defined():
@@ -64,3 +64,48 @@ def test_validation_fails_when_instruction_label_is_not_defined():
     assert "Label missing_label used but never defined" in str(excinfo.value)
     assert "A := @missing_label" in str(excinfo.value)
     assert "      ^^^^^^^^^^^^^" in str(excinfo.value)
+
+
+def test_validation_error_reports_exact_position():
+    assembly = """\
+    A := 0
+    D, A, D = A
+    """
+
+    with pytest.raises(assembler.ValidationError) as excinfo:
+        assembler.parse_and_validate_ast(assembly)
+
+    assert excinfo.value.lineno == 2
+    assert excinfo.value.col_start == 5
+    assert excinfo.value.col_end == 14
+
+
+@pytest.mark.parametrize("assembly", [
+    "D, D, A = A",
+    "    D = A + *A\n",
+    "    A := 0x10000\n",
+    "    D := -40000\n",
+    "    A := 0\n    A := @missing_label\n",
+    "    A := @later\nlater:\n    A := @missing_label\n",
+])
+@pytest.mark.parametrize("assemble", [
+    assembler.assemble_source,
+    assembler.assemble_with_parser,
+])
+def test_single_pass_assembly_reports_the_same_errors(assembly, assemble):
+    with pytest.raises(assembler.ValidationError) as expected:
+        assembler.parse_and_validate_ast(assembly)
+    with pytest.raises(assembler.ValidationError) as excinfo:
+        assemble(assembly)
+
+    assert str(excinfo.value) == str(expected.value)
+
+
+def test_labels_past_15_bits_are_rejected():
+    lines = ["    A := @end\n"] + ["    D = A\n"] * 0x8000 + ["end:\n", "    0; jmp\n"]
+    # Streamed, since reporting the error from the whole source parses all of
+    # it with Lark which is slow.
+    with pytest.raises(assembler.ValidationError) as excinfo:
+        list(assembler.assemble_lines(lines, assembler.collect_labels(lines)))
+    assert "Label end is at address 32769" in str(excinfo.value)
+    assert excinfo.value.lineno == 1
@@ -0,0 +1,90 @@
+"""Times the phases of assembling, such as parsing or writing output files.
+
+Code that does a phase wraps it in `with phase('name'):`, which costs
+nothing unless timings are being recorded:
+
+    with record_timings() as timings:
+        assembler.assemble(source)
+    print(timings)
+"""
+import contextlib
+import sys
+import time
+
+
+class PhaseTimings:
+    """Adds up the wall time and the net change in allocated memory blocks
+    of each phase of assembling, see `record_timings`. The net change is
+    what `sys.getallocatedblocks()` went up by, so it's negative for phases
+    that free more than they allocate, not a count of allocations."""
+    def __init__(self):
+        # Phase name to [calls, seconds, net allocated blocks].
+        self.phases = {}
+
+    def __call__(self, name, seconds, net_blocks):
+        totals = self.phases.setdefault(name, [0, 0.0, 0])
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] += net_blocks
+
+    def merge(self, other):
+        for name, (calls, seconds, net_blocks) in other.phases.items():
+            totals = self.phases.setdefault(name, [0, 0.0, 0])
+            totals[0] += calls
+            totals[1] += seconds
+            totals[2] += net_blocks
+
+    def __str__(self):
+        rows = ['{:<16} {:>7} {:>10} {:>11}'.format('phase', 'calls', 'ms', 'net blocks')]
+        for name, (calls, seconds, net_blocks) in sorted(
+                self.phases.items(), key=lambda item: -item[1][1]):
+            rows.append('{:<16} {:>7} {:>10.2f} {:>11}'.format(
+                name, calls, seconds * 1000, net_blocks))
+        return '\n'.join(rows)
+
+
+# Called with (phase name, seconds, net change in allocated blocks) at the
+# end of every phase, while timings are being recorded.
+_timing_hooks = []
+
+
+# Time and blocks of the phases nested in each phase that's running, so they
+# only count towards the innermost one.
+_running_phases = []
+
+
+@contextlib.contextmanager
+def record_timings(hook=None):
+    """Reports every phase of assembling done inside the with block to
+    `hook`, a PhaseTimings by default which is what the block gets."""
+    if hook is None:
+        hook = PhaseTimings()
+    _timing_hooks.append(hook)
+    try:
+        yield hook
+    finally:
+        _timing_hooks.remove(hook)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Times the with block as the phase `name`, if timings are being
+    recorded."""
+    if not _timing_hooks:
+        yield
+        return
+    start = time.perf_counter()
+    start_blocks = sys.getallocatedblocks()
+    nested = [0.0, 0]
+    _running_phases.append(nested)
+    try:
+        yield
+    finally:
+        _running_phases.pop()
+        seconds = time.perf_counter() - start
+        net_blocks = sys.getallocatedblocks() - start_blocks
+        if _running_phases:
+            _running_phases[-1][0] += seconds
+            _running_phases[-1][1] += net_blocks
+        for hook in _timing_hooks:
+            hook(name, seconds - nested[0], net_blocks - nested[1])
@@ -0,0 +1,745 @@
+"""A cycle-accurate emulator of the Hack computer in architecture/computer.
+
+Each call to `Computer.step` is one clock cycle of computer.v, with the same
+timing as the hardware:
+
+* On the rising edge memory reads the word at `addressM` into its output
+  register and stores `outM` if `writeM` is set, and the CPU registers
+  whether to jump in `pc_load`. The ALU sees the memory output latched on
+  the cycle before, so it's stale right after writing to memory or changing
+  A.
+* On the falling edge A and D load the ALU output, now computed from the
+  freshly latched memory output, the program counter loads A (as it was
+  before this instruction) if `pc_load` is set and otherwise increments,
+  and the next instruction is fetched from the old program counter.
+
+Fetching on the falling edge makes a taken jump take effect one instruction
+late, so the instruction after a jump always runs. Usage:
+
+    python3 emulator.py [--cycles N] [--ram ADDRESS[:COUNT]] [--screen FILE]
+                        [--resume FILE] [--snapshot FILE] program.hack
+"""
+import argparse
+import array
+import hashlib
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+
+ROM_SIZE = 4096
+# memory.v only decodes the low 14 bits of the 15-bit address, so addresses
+# past 16K wrap around.
+RAM_SIZE = 1 << 14
+ADDRESS_MASK = RAM_SIZE - 1
+
+# The 160x120 screen bitmap in memory.v, read by xilinx/VGA.v. Each row is
+# 10 words and the leftmost pixel of a word is its lowest bit.
+SCREEN = 0x200
+SCREEN_WIDTH = 160
+SCREEN_HEIGHT = 120
+SCREEN_ROW_WORDS = SCREEN_WIDTH // 16
+
+# What's in the instruction register after a reset, before the first
+# instruction is fetched. It doesn't store anything or jump.
+NOP = 0b1110101010000000
+
+
+def alu(instruction, x, y):
+    """Output of the ALU for the computation in the C-instruction
+    `instruction`, where x is D and y is A or the memory output."""
+    if instruction & (1 << 11):
+        x = 0
+    if instruction & (1 << 10):
+        x = ~x & 0xFFFF
+    if instruction & (1 << 9):
+        y = 0
+    if instruction & (1 << 8):
+        y = ~y & 0xFFFF
+    if instruction & (1 << 7):
+        output = (x + y) & 0xFFFF
+    else:
+        output = x & y
+    if instruction & (1 << 6):
+        output = ~output & 0xFFFF
+    return output
+
+
+def jump_taken(instruction, output):
+    """Whether a C-instruction jumps given its ALU output. Bits 2 to 0 of
+    the instruction are set for jumping on positive, zero and negative
+    outputs respectively."""
+    if output & 0x8000:
+        return bool(instruction & 0b100)
+    if output == 0:
+        return bool(instruction & 0b010)
+    return bool(instruction & 0b001)
+
+
+def signed(value):
+    """A 16-bit word as a two's complement number."""
+    value = int(value)
+    return value - 0x10000 if value & 0x8000 else value
+
+
+def screen_words(ram):
+    """A view of the screen bitmap in `ram`, a numpy array of RAM or of
+    several RAMs along the last axis, as one row of words per line of
+    pixels."""
+    return ram[..., SCREEN:SCREEN + SCREEN_HEIGHT * SCREEN_ROW_WORDS].reshape(
+        ram.shape[:-1] + (SCREEN_HEIGHT, SCREEN_ROW_WORDS))
+
+
+def unpack_screen(words):
+    """The screen as a 120x160 array of whether each pixel is lit, from the
+    words of the screen bitmap."""
+    # Read as bytes with the low byte first, so unpacking bits from the
+    # lowest up gives the pixels from left to right.
+    data = np.ascontiguousarray(words, dtype='<u2').view(np.uint8)
+    return np.unpackbits(data, axis=-1, bitorder='little').view(bool)
+
+
+def write_pbm(path, image):
+    """Saves a boolean image as a binary PBM, with lit pixels in white."""
+    (height, width) = image.shape
+    with open(path, 'wb') as f:
+        f.write('P4\n{} {}\n'.format(width, height).encode())
+        f.write(np.packbits(~image, axis=-1).tobytes())
+
+
+class EmulatorError(Exception):
+    pass
+
+
+# Snapshots of a computer are stored as this fixed layout, little-endian
+# with every field aligned, so files of them can be mapped into memory with
+# `np.memmap` and read in place. The instruction register is needed to pick
+# up where the computer left off, and `rom` is the hash of the program.
+SNAPSHOT_MAGIC = b'HACKSNAP'
+SNAPSHOT_VERSION = 1
+SNAPSHOT = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u2'),
+    ('a', '<u2'),
+    ('d', '<u2'),
+    ('pc', '<u2'),
+    ('memory_out', '<u2'),
+    ('instruction', '<u2'),
+    ('pc_load', '?'),
+    ('padding', 'V3'),
+    ('cycles', '<u8'),
+    ('rom', 'u1', (32, )),
+    ('ram', '<u2', (RAM_SIZE, )),
+])
+
+
+# What `Computer.trace` records after each cycle: the registers, and the
+# writeM, addressM and outM outputs of the CPU going into the next rising
+# edge.
+TRACE = np.dtype([
+    ('pc', '<u2'),
+    ('a', '<u2'),
+    ('d', '<u2'),
+    ('instruction', '<u2'),
+    ('write', '?'),
+    ('address', '<u2'),
+    ('out', '<u2'),
+])
+
+
+def save_snapshots(path, snapshots):
+    """Writes snapshots one after the other to `path`."""
+    with open(path, 'wb') as f:
+        for snapshot in snapshots:
+            f.write(snapshot.tobytes())
+
+
+def load_snapshots(path):
+    """Maps the snapshots in `path` into memory, without reading them."""
+    return np.memmap(path, dtype=SNAPSHOT, mode='r')
+
+
+class Checkpoints:
+    """Runs a computer, taking a snapshot every `interval` cycles so that
+    going back to any cycle since the first snapshot takes fewer than
+    `interval` cycles of running.
+
+    Snapshots are kept in memory, or appended to the file at `path`, which
+    can be read with `load_snapshots`.
+    """
+
+    def __init__(self, computer, interval, path=None):
+        self.computer = computer
+        self.interval = interval
+        self.path = path
+        self.start = computer.cycles
+        self.snapshots = []
+        if path is not None:
+            open(path, 'wb').close()
+        self.count = 0
+        self.record()
+
+    def record(self):
+        snapshot = self.computer.snapshot()
+        if self.path is None:
+            self.snapshots.append(snapshot)
+        else:
+            with open(self.path, 'ab') as f:
+                f.write(snapshot.tobytes())
+        self.count += 1
+
+    def __getitem__(self, index):
+        if self.path is None:
+            return self.snapshots[index]
+        return load_snapshots(self.path)[index]
+
+    def run(self, cycles):
+        """Runs the computer for `cycles` cycles, taking snapshots when it
+        gets to cycles that haven't had one yet."""
+        computer = self.computer
+        end = computer.cycles + cycles
+        while computer.cycles < end:
+            next_snapshot = self.start + self.count * self.interval
+            # Snapshots have to be `interval` cycles apart for `seek` to find
+            # them, so one that was run past can't be made up for.
+            if computer.cycles > next_snapshot:
+                raise EmulatorError(
+                    "The computer was run past cycle {} without taking a snapshot".format(
+                        next_snapshot))
+            computer.run(min(end, next_snapshot) - computer.cycles)
+            if computer.cycles == next_snapshot:
+                self.record()
+
+    def seek(self, cycle):
+        """Gets the computer to the state it was or will be in at `cycle`,
+        from the closest snapshot before it unless it's already closer."""
+        if cycle < self.start:
+            raise EmulatorError("No snapshots before cycle {}".format(self.start))
+        index = min((cycle - self.start) // self.interval, self.count - 1)
+        snapshot_cycle = self.start + index * self.interval
+        if not snapshot_cycle <= self.computer.cycles <= cycle:
+            self.computer.restore(self[index])
+        self.run(cycle - self.computer.cycles)
+
+
+class Computer:
+    """The state of computer.v: the CPU's registers, the instruction
+    register, the memory unit's output register and RAM.
+
+    `rom` can be anything holding 16-bit words, such as an assembled
+    program's `code`, and is copied in. `ram` is a numpy array of uint16.
+    """
+
+    def __init__(self, rom):
+        rom = list(map(int, rom))
+        if len(rom) > ROM_SIZE:
+            raise EmulatorError("Program has {} instructions, ROM only holds {}".format(
+                len(rom), ROM_SIZE))
+        # ROM can't be written, so instructions are only decoded once.
+        self.rom = tuple(rom + [0] * (ROM_SIZE - len(rom)))
+        self.digest = rom_digest(self.rom)
+        self.handlers = _handlers
+        for instruction in set(self.rom) | {NOP}:
+            if instruction not in _handlers:
+                _handlers[instruction] = compile_handler(instruction)
+        self.blocks = _block_cache.setdefault(self.digest, {})
+        self.ram = np.zeros(RAM_SIZE, dtype=np.uint16)
+        self.a = 0
+        self.d = 0
+        self.memory_out = 0
+        self.cycles = 0
+        self.reset()
+
+    @classmethod
+    def from_file(cls, path):
+        return cls(load_rom(path))
+
+    def reset(self):
+        """Holds reset for a cycle. The program counter goes back to 0 and
+        the first instruction is fetched on the cycle after, A, D and RAM
+        are left alone."""
+        self.pc = 0
+        self.pc_load = False
+        self.instruction = NOP
+        self.fetched_from = None
+
+    @property
+    def screen(self):
+        """The words of the screen bitmap, a view of RAM."""
+        return screen_words(self.ram)
+
+    def frame(self):
+        """What's on the screen, as a 120x160 array of whether each pixel is
+        lit."""
+        return unpack_screen(self.screen)
+
+    def snapshot(self):
+        """The whole state of the computer as a `SNAPSHOT` record."""
+        snapshot = np.zeros((), dtype=SNAPSHOT)
+        snapshot['magic'] = SNAPSHOT_MAGIC
+        snapshot['version'] = SNAPSHOT_VERSION
+        snapshot['a'] = self.a
+        snapshot['d'] = self.d
+        snapshot['pc'] = self.pc
+        snapshot['memory_out'] = self.memory_out
+        snapshot['instruction'] = self.instruction
+        snapshot['pc_load'] = self.pc_load
+        snapshot['cycles'] = self.cycles
+        snapshot['rom'] = np.frombuffer(self.digest, dtype=np.uint8)
+        snapshot['ram'] = self.ram
+        return snapshot
+
+    def restore(self, snapshot):
+        """Puts the computer back in the state of a snapshot taken of a
+        computer running the same program."""
+        if snapshot['magic'] != SNAPSHOT_MAGIC or snapshot['version'] != SNAPSHOT_VERSION:
+            raise EmulatorError("Not a snapshot, or from an unsupported version")
+        if snapshot['rom'].tobytes() != self.digest:
+            raise EmulatorError("Snapshot is of a different program")
+        self.a = int(snapshot['a'])
+        self.d = int(snapshot['d'])
+        self.pc = int(snapshot['pc'])
+        self.memory_out = int(snapshot['memory_out'])
+        self.instruction = int(snapshot['instruction'])
+        self.pc_load = bool(snapshot['pc_load'])
+        self.cycles = int(snapshot['cycles'])
+        self.ram[:] = snapshot['ram']
+        self.fetched_from = None
+
+    def outputs(self):
+        """The writeM, addressM and outM outputs of the CPU going into the
+        next rising edge. The ALU computes outM from the instruction's
+        control bits even for A-instructions, and addressM is the value
+        going into A for them."""
+        instruction = self.instruction
+        output = alu(instruction, self.d, self.memory_out if instruction & 0x1000 else self.a)
+        if instruction & 0x8000:
+            return bool(instruction & 0b1000), self.a & 0x7FFF, output
+        return False, instruction & 0x7FFF, output
+
+    def trace(self, cycles):
+        """Runs `cycles` cycles one at a time, returning a `TRACE` array of
+        the state after each one."""
+        trace = np.zeros(cycles, dtype=TRACE)
+        for cycle in range(cycles):
+            self.run(1)
+            trace[cycle] = (self.pc, self.a, self.d, self.instruction) + self.outputs()
+        return trace
+
+    def step(self):
+        """Runs one clock cycle."""
+        self.run(1)
+
+    def run(self, cycles):
+        """Runs `cycles` clock cycles.
+
+        Whenever the instruction register holds the instruction before the
+        program counter, as it does unless a jump was just taken or after a
+        reset, the basic block starting there is run in one go. Otherwise,
+        or when there are fewer cycles left than the block takes, single
+        instructions are run.
+        """
+        if cycles < 0:
+            raise ValueError("Can't run for {} cycles".format(cycles))
+        rom = self.rom
+        # Indexing a memoryview gives Python ints, which are much faster to
+        # work with than numpy scalars.
+        ram = memoryview(self.ram)
+        blocks = self.blocks
+        handlers = self.handlers
+        a = self.a
+        d = self.d
+        pc = self.pc
+        pc_load = self.pc_load
+        memory_out = self.memory_out
+        instruction = self.instruction
+        # Where the instruction in the instruction register was fetched
+        # from, None if it wasn't.
+        fetched_from = self.fetched_from
+        remaining = cycles
+        try:
+            while remaining > 0:
+                if fetched_from == pc - 1:
+                    block = blocks.get(fetched_from)
+                    if block is None:
+                        block = find_block(rom, fetched_from)
+                        # Only compiled once it's run, the cycles left often
+                        # run out partway through blocks that are never
+                        # entered at the same place again.
+                        if 0 < block.length <= remaining:
+                            blocks[fetched_from] = compile_block(rom, block)
+                    if 0 < block.length <= remaining:
+                        (a, d, memory_out, pc, pc_load) = block.function(a, d, memory_out, ram)
+                        fetched_from = block.end + 1
+                        instruction = rom[fetched_from]
+                        remaining -= block.length
+                        continue
+
+                # Fetched first, so nothing has changed if it's out of ROM.
+                if pc >= ROM_SIZE:
+                    raise EmulatorError("Jumped past the end of ROM to {:04X}".format(pc))
+                handler = handlers.get(instruction)
+                if handler is None:
+                    handler = handlers[instruction] = compile_handler(instruction)
+                fetched_from = pc
+                (a, d, memory_out, pc, pc_load) = handler(a, d, memory_out, pc, ram)
+                instruction = rom[fetched_from]
+                remaining -= 1
+        finally:
+            self.a = a
+            self.d = d
+            self.pc = pc
+            self.pc_load = pc_load
+            self.memory_out = memory_out
+            self.instruction = instruction
+            self.fetched_from = fetched_from
+            self.cycles += cycles - remaining
+
+
+# Instructions are turned into Python source specialized to what they do,
+# working on the locals a, d, memory_out and ram. A single instruction is
+# compiled into a handler, and a basic block into one function running each
+# of its instructions in turn.
+
+def alu_source(instruction, y):
+    """An expression for the ALU output of a C-instruction, where x is d and
+    y is the expression `y`."""
+    x = 'd'
+    if instruction & (1 << 11):
+        x = '0'
+    if instruction & (1 << 10):
+        x = '(~{} & 0xFFFF)'.format(x)
+    if instruction & (1 << 9):
+        y = '0'
+    if instruction & (1 << 8):
+        y = '(~{} & 0xFFFF)'.format(y)
+    if instruction & (1 << 7):
+        output = '(({} + {}) & 0xFFFF)'.format(x, y)
+    else:
+        output = '({} & {})'.format(x, y)
+    if instruction & (1 << 6):
+        output = '(~{} & 0xFFFF)'.format(output)
+    return output
+
+
+# Conditions on `output` for each jump.
+JUMP_CONDITIONS = {
+    0b001: '0 < output < 0x8000',
+    0b010: 'output == 0',
+    0b011: 'output < 0x8000',
+    0b100: 'output >= 0x8000',
+    0b101: 'output != 0',
+    0b110: 'output == 0 or output >= 0x8000',
+    0b111: 'True',
+}
+
+
+def instruction_source(instruction):
+    """Lines of Python that run `instruction`. A jumping instruction sets
+    `taken`, and `target` to jump to."""
+    if not instruction & 0x8000:
+        # addressM is the value going into A for A-instructions, so the word
+        # it points to can be used on the next cycle.
+        return ['memory_out = ram[{}]'.format(instruction & ADDRESS_MASK),
+                'a = {}'.format(instruction)]
+
+    reads_memory = instruction & 0x1000
+    writes_memory = instruction & 0b1000
+    jumps = instruction & 0b111
+    stores = instruction & 0b110000
+    lines = []
+    if jumps:
+        lines.append('target = a')
+    # Rising edge, the ALU sees the memory output from the cycle before.
+    if writes_memory or jumps:
+        lines.append('output = {}'.format(alu_source(instruction, 'memory_out' if reads_memory else 'a')))
+    if writes_memory:
+        lines += ['address = a & {}'.format(ADDRESS_MASK),
+                  'memory_out = ram[address]',
+                  'ram[address] = output']
+    else:
+        lines.append('memory_out = ram[a & {}]'.format(ADDRESS_MASK))
+    if jumps:
+        lines.append('taken = {}'.format(JUMP_CONDITIONS[jumps]))
+    # Falling edge, now with the new memory output.
+    if stores and (reads_memory or not (writes_memory or jumps)):
+        lines.append('output = {}'.format(alu_source(instruction, 'memory_out' if reads_memory else 'a')))
+    if instruction & 0b100000:
+        lines.append('a = output')
+    if instruction & 0b010000:
+        lines.append('d = output')
+    return lines
+
+
+def jumps(instruction):
+    return instruction & 0x8000 and instruction & 0b111
+
+
+def compile_function(name, parameters, lines, returned, filename):
+    source = 'def {}({}):\n{}    return {}\n'.format(
+        name, parameters, ''.join('    {}\n'.format(line) for line in lines), returned)
+    namespace = {}
+    exec(compile(source, filename, 'exec'), namespace)
+    function = namespace[name]
+    function.source = source
+    return function
+
+
+def compile_handler(instruction):
+    """A function running one cycle of `instruction` given the program
+    counter, returning the new registers, program counter and whether it
+    jumped."""
+    if jumps(instruction):
+        returned = 'a, d, memory_out, target if taken else pc + 1, taken'
+    else:
+        returned = 'a, d, memory_out, pc + 1, False'
+    return compile_function('handler', 'a, d, memory_out, pc, ram',
+                            instruction_source(instruction), returned,
+                            '<handler {:04X}>'.format(instruction))
+
+
+# Handlers for every instruction seen, they only depend on the instruction.
+_handlers = {}
+
+
+# Longest basic block to compile, to bound the time spent compiling runs of
+# instructions that are never jumped out of, such as empty ROM.
+MAX_BLOCK_LENGTH = 256
+
+
+@dataclass
+class Block:
+    """Instructions from `start` to `end` that are always run one after the
+    other, compiled into `function` which runs them and returns the new
+    registers, program counter and whether the last one jumped."""
+    start: int
+    end: int
+    function: object = None
+
+    @property
+    def length(self):
+        return self.end - self.start + 1
+
+
+def find_block(rom, start):
+    """The basic block starting at `start`, up to the first jumping
+    instruction. Every instruction fetched while it runs has to be in ROM,
+    so it may be empty at the very end."""
+    end = start - 1
+    while end + 2 < len(rom) and end - start + 1 < MAX_BLOCK_LENGTH:
+        end += 1
+        if jumps(rom[end]):
+            break
+    return Block(start, end)
+
+
+def compile_block(rom, block):
+    lines = []
+    for address in range(block.start, block.end + 1):
+        lines.append('# {:04X}: {:04X}'.format(address, rom[address]))
+        lines += instruction_source(rom[address])
+    # The program counter is one past the instruction after the last one
+    # unless it jumped.
+    if jumps(rom[block.end]):
+        returned = 'a, d, memory_out, target if taken else {}, taken'.format(block.end + 2)
+    else:
+        returned = 'a, d, memory_out, {}, False'.format(block.end + 2)
+    block.function = compile_function('block', 'a, d, memory_out, ram', lines, returned,
+                                      '<block {:04X}>'.format(block.start))
+    return block
+
+
+# Compiled blocks for every ROM seen, keyed by its hash, so computers
+# running the same program share them.
+_block_cache = {}
+
+
+def rom_digest(rom):
+    return hashlib.sha256(array.array('H', rom).tobytes()).digest()
+
+
+def batch_alu(instruction, x, y):
+    """`alu` on arrays, with each element's own instruction."""
+    x = np.where(instruction & (1 << 11), 0, x)
+    x = np.where(instruction & (1 << 10), ~x, x)
+    y = np.where(instruction & (1 << 9), 0, y)
+    y = np.where(instruction & (1 << 8), ~y, y)
+    output = np.where(instruction & (1 << 7), x + y, x & y)
+    return np.where(instruction & (1 << 6), ~output, output)
+
+
+class Batch:
+    """Many computers running the same program in lockstep, each with its
+    own registers and RAM, so a routine can be run on thousands of inputs
+    at once.
+
+    Registers are arrays with an element per computer and `ram` has a row
+    per computer, all uint16. Every cycle runs whatever instruction each
+    computer is on, so they can take different branches.
+
+    RAM is 32K bytes per computer, so for large batches `ram_size` can keep
+    just the words from 0 up to it. Writing past it raises EmulatorError,
+    which keeps reading past it exact: nothing but 0 can be there.
+    """
+
+    def __init__(self, rom, size, ram_size=RAM_SIZE):
+        rom = list(rom)
+        if len(rom) > ROM_SIZE:
+            raise EmulatorError("Program has {} instructions, ROM only holds {}".format(
+                len(rom), ROM_SIZE))
+        if not 0 < ram_size <= RAM_SIZE:
+            raise EmulatorError("RAM size has to be between 1 and {}".format(RAM_SIZE))
+        self.rom = np.zeros(ROM_SIZE, dtype=np.uint16)
+        self.rom[:len(rom)] = rom
+        self.size = size
+        self.ram = np.zeros((size, ram_size), dtype=np.uint16)
+        self.a = np.zeros(size, dtype=np.uint16)
+        self.d = np.zeros(size, dtype=np.uint16)
+        self.memory_out = np.zeros(size, dtype=np.uint16)
+        self.cycles = 0
+        self.reset()
+
+    def reset(self):
+        """Resets every computer, like `Computer.reset`."""
+        self.pc = np.zeros(self.size, dtype=np.uint16)
+        self.pc_load = np.zeros(self.size, dtype=bool)
+        self.instruction = np.full(self.size, NOP, dtype=np.uint16)
+
+    @property
+    def screens(self):
+        return screen_words(self.ram)
+
+    def frames(self):
+        """What's on each computer's screen, like `Computer.frame`."""
+        return unpack_screen(self.screens)
+
+    def computer(self, index):
+        """A `Computer` in the same state as computer `index`."""
+        computer = Computer(self.rom)
+        computer.ram[:self.ram.shape[1]] = self.ram[index]
+        computer.a = int(self.a[index])
+        computer.d = int(self.d[index])
+        computer.pc = int(self.pc[index])
+        computer.pc_load = bool(self.pc_load[index])
+        computer.memory_out = int(self.memory_out[index])
+        computer.instruction = int(self.instruction[index])
+        computer.cycles = self.cycles
+        return computer
+
+    def run(self, cycles):
+        """Runs every computer for `cycles` clock cycles."""
+        rows = np.arange(self.size)
+        ram_size = self.ram.shape[1]
+        for _ in range(cycles):
+            # Checked first, so nothing has changed if it's out of ROM.
+            if (self.pc >= ROM_SIZE).any():
+                raise EmulatorError("Jumped past the end of ROM to {:04X}".format(
+                    self.pc[self.pc >= ROM_SIZE][0]))
+            instruction = self.instruction
+            c_instruction = (instruction & 0x8000) != 0
+            reads_memory = (instruction & 0x1000) != 0
+            writes_memory = c_instruction & ((instruction & 0b1000) != 0)
+
+            # Rising edge, the ALU sees the memory output from the cycle
+            # before. addressM is the value going into A for A-instructions.
+            output = batch_alu(instruction, self.d, np.where(reads_memory, self.memory_out, self.a))
+            address = np.where(c_instruction, self.a, instruction) & ADDRESS_MASK
+            in_ram = address < ram_size
+            if (writes_memory & ~in_ram).any():
+                raise EmulatorError("Wrote past the first {} words of RAM to {:04X}".format(
+                    ram_size, address[writes_memory & ~in_ram][0]))
+            latched = np.where(in_ram, self.ram[rows, np.minimum(address, ram_size - 1)], 0)
+            self.ram[rows[writes_memory], address[writes_memory]] = output[writes_memory]
+            # Bits 2 to 0 are set for jumping on positive, zero and negative
+            # outputs.
+            condition = np.where(output & 0x8000, 0b100, np.where(output == 0, 0b010, 0b001))
+            self.pc_load = c_instruction & ((instruction & condition) != 0)
+
+            # Falling edge, now with the new memory output.
+            output = batch_alu(instruction, self.d, np.where(reads_memory, latched, self.a))
+            self.memory_out = latched.astype(np.uint16)
+            fetched = self.rom[self.pc]
+            self.pc = np.where(self.pc_load, self.a, self.pc + 1).astype(np.uint16)
+            self.a = np.where(c_instruction,
+                              np.where(instruction & 0b100000, output, self.a),
+                              instruction).astype(np.uint16)
+            self.d = np.where(c_instruction & ((instruction & 0b010000) != 0),
+                              output, self.d).astype(np.uint16)
+            self.instruction = fetched
+            self.cycles += 1
+
+
+def load_rom(path):
+    """Reads a program in one of the assembler's formats that hold one word
+    per instruction: .hack, .bin, .be.bin or .mem."""
+    # The assembler knows its formats best. Reading them doesn't need lark,
+    # and they're imported here so the assembler's directory is only put on
+    # the path when a file is loaded.
+    assembler_dir = str(Path(__file__).resolve().parents[1] / 'assembler')
+    if assembler_dir not in sys.path:
+        sys.path.insert(0, assembler_dir)
+    from output_formats import read_rom
+    try:
+        return read_rom(Path(path))
+    except ValueError as e:
+        raise EmulatorError(str(e)) from e
+
+
+def parse_range(text):
+    """Parses 'ADDRESS[:COUNT]', with numbers in any base Python accepts."""
+    address, _, count = text.partition(':')
+    return range(int(address, 0), int(address, 0) + int(count or '1', 0))
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(prog='emulator')
+    arg_parser.add_argument(
+        'program', type=Path,
+        help="program to run, as .hack, .bin, .be.bin or .mem")
+    arg_parser.add_argument(
+        '--cycles', type=int, default=1_000_000,
+        help="number of clock cycles to run for (default: 1000000)")
+    arg_parser.add_argument(
+        '--ram', type=parse_range, action='append', default=[],
+        metavar='ADDRESS[:COUNT]',
+        help="print RAM words afterwards, can be given multiple times")
+    arg_parser.add_argument(
+        '--screen', type=Path, metavar='FILE',
+        help="save what's on the screen afterwards as a PBM image")
+    arg_parser.add_argument(
+        '--resume', type=Path, metavar='FILE',
+        help="start from the last snapshot saved in FILE instead of reset")
+    arg_parser.add_argument(
+        '--snapshot', type=Path, metavar='FILE',
+        help="save a snapshot of the computer to FILE afterwards")
+    args = arg_parser.parse_args(argv)
+    if args.cycles < 0:
+        arg_parser.error("--cycles can't be negative")
+    try:
+        computer = Computer.from_file(args.program)
+        if args.resume:
+            computer.restore(load_snapshots(args.resume)[-1])
+    except (OSError, ValueError, EmulatorError) as e:
+        arg_parser.error(str(e))
+
+    try:
+        computer.run(args.cycles)
+    except EmulatorError as e:
+        print("Stopped after {} cycles: {}".format(computer.cycles, e))
+    print("cycles={} pc={:04X} A={:04X} D={:04X}".format(
+        computer.cycles, computer.pc, computer.a, computer.d))
+    for addresses in args.ram:
+        for address in addresses:
+            word = computer.ram[address & ADDRESS_MASK]
+            print("RAM[{:04X}] = {:04X} ({})".format(address, word, signed(word)))
+    if args.screen:
+        write_pbm(args.screen, computer.frame())
+    if args.snapshot:
+        save_snapshots(args.snapshot, [computer.snapshot()])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+# Test programs are written in assembly and assembled with the assembler
+# from the chapter before.
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / 'assembler'))
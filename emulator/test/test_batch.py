@@ -0,0 +1,64 @@
+import assembler
+import emulator
+import numpy as np
+import pytest
+import random
+
+from test_emulator import TEST_FILES, random_program, state
+
+
+def test_batches_sweep_inputs():
+    code = assembler.assemble((TEST_FILES / 'Max.asm').read_text()).code
+    (x, y) = np.meshgrid(np.arange(-64, 64), np.arange(-64, 64))
+    batch = emulator.Batch(code, x.size, ram_size=3)
+    batch.ram[:, 0] = x.ravel().astype(np.uint16)
+    batch.ram[:, 1] = y.ravel().astype(np.uint16)
+    batch.run(15)
+    assert (batch.ram[:, 2].astype(np.int16) == np.maximum(x, y).ravel()).all()
+
+@pytest.mark.parametrize("seed", range(10))
+def test_batches_match_single_computers(seed):
+    rng = random.Random(seed)
+    rom = random_program(rng, rng.randrange(1, 60))
+    batch = emulator.Batch(rom, 8)
+    computers = [emulator.Computer(rom) for _ in range(len(batch.a))]
+    for i, c in enumerate(computers):
+        c.ram[:64] = batch.ram[i, :64] = [rng.randrange(0x10000) for _ in range(64)]
+    for _ in range(20):
+        cycles = rng.choice([1, 5, 20])
+        try:
+            for c in computers:
+                c.run(cycles)
+        except emulator.EmulatorError:
+            with pytest.raises(emulator.EmulatorError):
+                batch.run(cycles)
+            break
+        batch.run(cycles)
+        for i, c in enumerate(computers):
+            assert state(batch.computer(i)) == state(c)
+
+def test_writing_past_a_smaller_ram_is_an_error():
+    batch = emulator.Batch(assembler.assemble("""\
+    A := 100
+    D = *A
+    A := 10
+    *A = 1
+    A := 100
+    *A = D
+""").code, 4, ram_size=16)
+    batch.run(6)
+    assert batch.ram[:, 10].tolist() == [1] * 4
+    with pytest.raises(emulator.EmulatorError):
+        batch.run(2)
+    # Stopped before the cycle writing to 100.
+    assert batch.cycles == 6
+
+def test_batches_have_a_screen_each():
+    batch = emulator.Batch(assembler.assemble("""\
+    A := $SCREEN
+    *A = D
+""").code, 3)
+    batch.d[:] = [0, 1, 3]
+    batch.run(3)
+    assert np.shares_memory(batch.screens, batch.ram)
+    assert batch.frames()[:, 0, :2].tolist() == [[False, False], [True, False], [True, True]]
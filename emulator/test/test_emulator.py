@@ -0,0 +1,406 @@
+import assembler
+import emulator
+import numpy as np
+import output_formats
+import pytest
+import random
+
+from pathlib import Path
+
+
+TEST_FILES = Path(__file__).resolve().parents[2] / 'assembler' / 'test' / 'test_files'
+
+
+def computer(source):
+    return emulator.Computer(assembler.assemble(source).code)
+
+
+# The programs from architecture/computer/computer_test.py, run for the same
+# number of cycles after reset.
+
+def test_runs_program_that_adds_two_numbers():
+    c = emulator.Computer.from_file(TEST_FILES / 'Add.hack')
+    c.run(7)
+    assert c.ram[0] == 5
+
+def test_runs_program_that_maxes_two_numbers():
+    c = emulator.Computer.from_file(TEST_FILES / 'Max.hack')
+    for _ in range(20):
+        a = random.randint(-5000, 5000)
+        b = random.randint(-5000, 5000)
+        c.ram[0] = a & 0xFFFF
+        c.ram[1] = b & 0xFFFF
+        c.reset()
+        c.run(15)
+        assert emulator.signed(c.ram[2]) == max(a, b)
+
+def test_can_deref_memory_into_register_a():
+    c = computer("""\
+    A := 42
+    D = A
+    A := 0
+    A = *A
+    *A = D
+loop:
+    A := @loop
+    0; jmp
+""")
+    c.ram[0] = 3
+    c.run(8)
+    assert c.ram[3] == 42
+
+def test_can_increment_a_memory_address():
+    c = computer("""\
+    A := 69
+    *A = *A - 1
+loop:
+    A := @loop
+    0; jmp
+""")
+    c.ram[69] = 8
+    c.run(9)
+    assert c.ram[69] == 7
+
+def test_runs_rect_program():
+    # Draws 9 rows at 2048.
+    c = computer("""\
+    A := 0
+    D = *A
+    A := @done
+    D; jle
+    A := 16
+    *A = D
+    A := 2048
+    D = A
+    A := 17
+    *A = D
+loop:
+    A := 17
+    A = *A
+    *A = -1
+    A := 17
+    D = *A
+    A := 32
+    D = D + A
+    A := 17
+    *A = D
+    A := 16
+    *A, D = *A - 1
+    A := @loop
+    D; jgt
+done:
+    A := @done
+    0; jmp
+""")
+    c.d = c.ram[0] = 9
+    c.run(2_000)
+    for i in range(9):
+        assert c.ram[2048 + 32 * i] == 0xFFFF
+
+
+def test_instruction_after_a_taken_jump_runs():
+    c = computer("""\
+    A := @target
+    0; jmp
+    D = 1
+    D = D + 1
+target:
+    D = D + 1
+""")
+    # The cycle fetching the first instruction, the two up to the jump, and
+    # D = 1 which runs while the target is fetched.
+    c.run(4)
+    assert (c.pc, c.d) == (5, 1)
+    c.run(1)
+    assert c.d == 2
+
+def test_jumps_go_to_a_from_before_the_jump():
+    c = computer("""\
+    A := 4
+    A = A + 1; jmp
+    D = 1
+    D = 1
+    D = -1
+    D = 0
+""")
+    c.run(5)
+    assert c.d == 0xFFFF
+    assert c.a == 5
+
+def test_memory_output_is_stale_right_after_a_write():
+    c = computer("""\
+    A := 5
+    *A = 1
+    *A = *A + 1
+    D = *A
+""")
+    c.run(5)
+    # The ALU output written to memory is computed from the word latched
+    # before the write, but D loads from the word latched after it.
+    assert c.ram[5] == 1
+    c.run(1)
+    assert c.d == 1
+
+def test_addresses_wrap_around_at_16k():
+    c = computer("""\
+    A := 0x4005
+    *A = -1
+    A := 0x7FFF
+    D = *A
+""")
+    c.ram[0x3FFF] = 1234
+    c.run(5)
+    assert c.ram[5] == 0xFFFF
+    c.run(1)
+    assert c.d == 1234
+
+def test_running_past_the_end_of_rom_stops():
+    c = computer("""\
+    A := 0x7000
+    0; jmp
+""")
+    with pytest.raises(emulator.EmulatorError):
+        c.run(10)
+    # Stopped before the cycle that would fetch from outside ROM.
+    assert (c.cycles, c.pc) == (3, 0x7000)
+    with pytest.raises(emulator.EmulatorError):
+        emulator.Computer([0] * 4097)
+
+@pytest.mark.parametrize("output_format", ['hack', 'bin', 'bin-be', 'mem'])
+def test_programs_are_loaded_in_each_format(tmp_path, output_format):
+    program = assembler.assemble((TEST_FILES / 'Max.asm').read_text())
+    output_formats.write_output_files(tmp_path / 'Max', program.code, [output_format])
+    rom = tmp_path / ('Max' + output_formats.OUTPUT_FORMATS[output_format].suffix)
+    assert emulator.load_rom(rom) == program.code
+
+def test_command_line_prints_registers_and_ram(capsys):
+    assert emulator.main([str(TEST_FILES / 'Add.hack'), '--cycles', '7', '--ram', '0:2']) == 0
+    assert capsys.readouterr().out == """\
+cycles=7 pc=0007 A=0000 D=0005
+RAM[0000] = 0005 (5)
+RAM[0001] = 0000 (0)
+"""
+
+def test_screen_is_a_view_of_ram():
+    c = computer("""\
+    A := $SCREEN
+    *A = 1
+    A := 0x6AF
+    *A = -1
+""")
+    c.run(5)
+    assert np.shares_memory(c.screen, c.ram)
+    frame = c.frame()
+    assert frame.shape == (120, 160)
+    # The lowest bit of the first word is the top left pixel, the last word
+    # is the right end of the bottom line.
+    assert frame[0].nonzero()[0].tolist() == [0]
+    assert frame[119].nonzero()[0].tolist() == list(range(144, 160))
+    assert frame.sum() == 17
+
+def test_screen_is_unpacked_like_the_vga_module():
+    c = emulator.Computer([])
+    c.ram[:] = np.random.default_rng(0).integers(0x10000, size=emulator.RAM_SIZE)
+    frame = c.frame()
+    # bitmap_addr and bitmap_bit_idx in xilinx/VGA.v, without the scaling.
+    for (y, x) in [(0, 0), (0, 15), (0, 16), (5, 37), (119, 159), (64, 100)]:
+        word = int(c.ram[512 + x // 16 + y * (160 // 16)])
+        assert frame[y, x] == bool(word >> (x % 16) & 1)
+
+def test_screen_is_saved_as_pbm(tmp_path):
+    (tmp_path / 'Line.hack').write_text(
+        '\n'.join(map(output_formats.to_bitstring, assembler.assemble("""\
+    A := $SCREEN
+    *A = -1
+""").code)) + '\n')
+    screen = tmp_path / 'screen.pbm'
+    assert emulator.main([str(tmp_path / 'Line.hack'), '--cycles', '3',
+                          '--screen', str(screen)]) == 0
+    data = screen.read_bytes()
+    assert data.startswith(b'P4\n160 120\n')
+    pixels = data[len(b'P4\n160 120\n'):]
+    assert len(pixels) == 120 * 20
+    # Lit pixels are white, which is 0 in PBM.
+    assert pixels[:2] == b'\x00\x00' and pixels[2:] == b'\xff' * (120 * 20 - 2)
+
+
+def reference_run(c, cycles):
+    """Runs `c` a cycle at a time with the ALU written out, the way the
+    emulator did before compiling instructions."""
+    ram = memoryview(c.ram)
+    for _ in range(cycles):
+        if c.pc >= emulator.ROM_SIZE:
+            raise emulator.EmulatorError("Jumped past the end of ROM")
+        fetched = c.rom[c.pc]
+        instruction = c.instruction
+        if not instruction & 0x8000:
+            c.memory_out = ram[instruction & emulator.ADDRESS_MASK]
+            c.pc_load = False
+            c.pc += 1
+            c.a = instruction
+        else:
+            output = emulator.alu(instruction, c.d, c.memory_out if instruction & 0x1000 else c.a)
+            address = c.a & emulator.ADDRESS_MASK
+            latched = ram[address]
+            if instruction & 0b1000:
+                ram[address] = output
+            c.pc_load = bool(instruction & 0b111) and emulator.jump_taken(instruction, output)
+            output = emulator.alu(instruction, c.d, latched if instruction & 0x1000 else c.a)
+            c.memory_out = latched
+            c.pc = c.a if c.pc_load else c.pc + 1
+            if instruction & 0b100000:
+                c.a = output
+            if instruction & 0b010000:
+                c.d = output
+        c.instruction = fetched
+        c.cycles += 1
+
+
+def state(c):
+    return (c.a, c.d, c.pc, c.pc_load, c.memory_out, c.instruction, c.cycles, c.ram.tobytes())
+
+
+def random_program(rng, length):
+    """Random instructions over a small range of addresses, with jumps
+    mostly to somewhere in the program."""
+    rom = []
+    for _ in range(length):
+        if rng.random() < 0.4:
+            rom.append(rng.randrange(length + 2) if rng.random() < 0.8 else rng.randrange(0x8000))
+        else:
+            rom.append(0xE000 | rng.randrange(0x2000))
+    return rom
+
+@pytest.mark.parametrize("seed", range(20))
+def test_compiled_blocks_match_running_a_cycle_at_a_time(seed):
+    rng = random.Random(seed)
+    rom = random_program(rng, rng.randrange(1, 60))
+    compiled = emulator.Computer(rom)
+    reference = emulator.Computer(rom)
+    ram = [rng.randrange(0x10000) for _ in range(64)]
+    compiled.ram[:64] = reference.ram[:64] = ram
+    for _ in range(50):
+        cycles = rng.choice([1, 2, 7, 100])
+        try:
+            reference_run(reference, cycles)
+        except emulator.EmulatorError:
+            with pytest.raises(emulator.EmulatorError):
+                compiled.run(cycles)
+            assert state(compiled)[:-1] == state(reference)[:-1]
+            break
+        compiled.run(cycles)
+        assert state(compiled) == state(reference)
+
+def test_blocks_are_shared_between_computers_running_the_same_program():
+    code = assembler.assemble((TEST_FILES / 'Max.asm').read_text()).code
+    first = emulator.Computer(code)
+    first.run(20)
+    second = emulator.Computer(code)
+    assert second.blocks is first.blocks
+    assert first.blocks[0].end == 5
+    assert "ram[1]" in first.blocks[0].function.source
+
+
+RECT = emulator.load_rom(TEST_FILES / 'Rect.hack')
+
+def rect(cls=emulator.Computer):
+    c = cls(RECT)
+    c.ram[0] = 50
+    return c
+
+def test_snapshots_pick_up_where_they_left_off(tmp_path):
+    c = rect()
+    c.run(1_234)
+    snapshot = c.snapshot()
+    c.run(1_000)
+    expected = state(c)
+
+    c.restore(snapshot)
+    assert c.cycles == 1_234
+    c.run(1_000)
+    assert state(c) == expected
+
+    # Through a file, into another computer.
+    emulator.save_snapshots(tmp_path / 'rect.snapshot', [snapshot])
+    assert (tmp_path / 'rect.snapshot').stat().st_size == emulator.SNAPSHOT.itemsize
+    other = emulator.Computer(RECT)
+    other.restore(emulator.load_snapshots(tmp_path / 'rect.snapshot')[0])
+    other.run(1_000)
+    assert state(other) == expected
+
+def test_snapshots_only_restore_into_the_same_program():
+    snapshot = rect().snapshot()
+    with pytest.raises(emulator.EmulatorError):
+        computer("D = 1").restore(snapshot)
+
+class CountingComputer(emulator.Computer):
+    ran = 0
+
+    def run(self, cycles):
+        self.ran += cycles
+        super().run(cycles)
+
+@pytest.mark.parametrize("in_file", [False, True])
+def test_checkpoints_seek_to_any_cycle(tmp_path, in_file):
+    c = rect(CountingComputer)
+    checkpoints = emulator.Checkpoints(c, 100, tmp_path / 'rect.snapshots' if in_file else None)
+    checkpoints.run(1_050)
+    assert checkpoints.count == 11
+
+    for cycle in [1_000, 5, 999, 740, 2_000, 1_500]:
+        c.ran = 0
+        checkpoints.seek(cycle)
+        if cycle <= 1_050:
+            assert c.ran < 100
+        expected = rect()
+        expected.run(cycle)
+        assert state(c) == state(expected)
+    # Seeking past the last snapshot takes more on the way.
+    assert checkpoints.count == 21
+    if in_file:
+        assert len(emulator.load_snapshots(tmp_path / 'rect.snapshots')) == 21
+
+def test_negative_cycles_are_rejected():
+    c = rect()
+    with pytest.raises(ValueError):
+        c.run(-1)
+    assert c.cycles == 0
+
+def test_checkpoints_stop_when_a_snapshot_was_run_past():
+    c = rect()
+    checkpoints = emulator.Checkpoints(c, 100)
+    c.run(150)
+    with pytest.raises(emulator.EmulatorError):
+        checkpoints.run(100)
+    assert c.cycles == 150
+
+def test_command_line_resumes_from_snapshots(tmp_path, capsys):
+    snapshot = tmp_path / 'add.snapshot'
+    add = str(TEST_FILES / 'Add.hack')
+    assert emulator.main([add, '--cycles', '4', '--snapshot', str(snapshot)]) == 0
+    assert emulator.main([add, '--cycles', '3', '--resume', str(snapshot), '--ram', '0']) == 0
+    assert capsys.readouterr().out.splitlines()[-2:] == [
+        "cycles=7 pc=0007 A=0000 D=0005",
+        "RAM[0000] = 0005 (5)",
+    ]
+
+def test_trace_records_the_cpu_outputs():
+    c = computer("""\
+    A := 5
+    *A = D + 1
+    D = *A
+""")
+    c.d = 7
+    trace = c.trace(4)
+    assert trace['pc'].tolist() == [1, 2, 3, 4]
+    # The instruction in the instruction register after each cycle, and
+    # what the CPU puts on the memory bus for it.
+    assert trace['instruction'].tolist() == [5, 0xE7C8, 0xFC10, 0]
+    assert trace['write'].tolist() == [False, True, False, False]
+    assert trace['address'].tolist() == [5, 5, 5, 0]
+    assert trace['out'][1] == 8
+    assert trace['d'][3] == 8
+
+def test_unknown_program_files_are_rejected(tmp_path):
+    with pytest.raises(emulator.EmulatorError):
+        emulator.load_rom(tmp_path / 'Max.coe')
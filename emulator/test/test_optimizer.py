@@ -0,0 +1,128 @@
+import assembler
+import emulator
+import optimizer
+import pytest
+import random
+import superoptimizer
+
+
+COMPUTATIONS = [
+    '0', '1', '-1', 'D', 'A', '*A', '~D', '-D', 'D + 1', 'A + 1', '*A + 1', 'D - 1',
+    'A - 1', '*A - 1', 'D + A', 'D + *A', 'D - A', 'D - *A', 'A - D', '*A - D',
+    'D & A', 'D | *A',
+]
+DESTINATIONS = ['', 'D = ', 'A = ', '*A = ', 'D, *A = ', 'A, D = ']
+JUMPS = ['jgt', 'jeq', 'jge', 'jlt', 'jne', 'jle', 'jmp']
+# Instructions that leave A alone, for after jumps.
+D_INSTRUCTIONS = ['D = D + 1', 'D = D - 1', 'D = -D', 'D = ~D', 'D = 0', 'D']
+
+
+def random_source(rng, length):
+    """Random assembly over a few addresses, with plenty of repeated loads
+    and overwritten registers for the optimizer to find. Jumps only go
+    forwards, so the program always ends up in the loop at the end.
+
+    Label addresses are only used to jump to, as the optimizer expects: A is
+    loaded with a constant after every jump and label before anything else
+    uses it."""
+    labels = set(rng.sample(range(1, length + 1), rng.randrange(min(length, 4) + 1)))
+    labels.add(length)
+    lines = []
+    for position in range(length):
+        if position in labels:
+            lines += ['L{}:'.format(position), '    A := {}'.format(rng.randrange(4))]
+        choice = rng.random()
+        if choice < 0.3:
+            lines.append('    A := {}'.format(rng.randrange(4)))
+        elif choice < 0.45:
+            target = rng.choice([label for label in labels if label > position])
+            lines.append('    A := @L{}'.format(target))
+            lines.append('    {}; {}'.format(rng.choice(['0', 'D', 'D - 1']), rng.choice(JUMPS)))
+            # What runs while the jump is being taken.
+            lines.append(rng.choice(
+                ['    A := @L{}'.format(target)] + ['    ' + line for line in D_INSTRUCTIONS]))
+            if rng.random() < 0.5:
+                lines.append('    ' + rng.choice(D_INSTRUCTIONS))
+            lines.append('    A := {}'.format(rng.randrange(4)))
+        else:
+            lines.append('    {}{}'.format(rng.choice(DESTINATIONS), rng.choice(COMPUTATIONS)))
+    lines.append('L{}:'.format(length))
+    # Where A is after the loop is up to the optimizer, so D is kept in
+    # memory to compare.
+    lines += ['    A := 100', '    *A = D', 'end:', '    A := @end', '    0; jmp', '    0']
+    return '\n'.join(lines) + '\n'
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_optimized_programs_do_the_same(seed):
+    rng = random.Random(seed)
+    source = random_source(rng, rng.randrange(1, 30))
+    optimized, _ = optimizer.assemble_optimized(source)
+    computers = [emulator.Computer(assembler.assemble(source).code),
+                 emulator.Computer(optimized.code)]
+    ram = [rng.randrange(0x10000) for _ in range(8)]
+    d = rng.randrange(0x10000)
+    for computer in computers:
+        computer.ram[:8] = ram
+        computer.d = d
+        computer.run(500)
+    (original, optimized) = computers
+    assert optimized.ram.tobytes() == original.ram.tobytes(), source
+
+
+def test_optimized_programs_jump_to_labels_defined_twice_like_the_original():
+    # The jump to L comes before either definition, so it goes to the last
+    # one rather than the first, which only jumps on to M.
+    source = """\
+    A := @L
+    0; jmp
+    0
+L:
+    A := @M
+    0; jmp
+    0
+M:
+    A := 100
+    *A = 1
+    A := @end
+    0; jmp
+    0
+L:
+    A := 100
+    *A = -1
+end:
+    A := @end
+    0; jmp
+    0
+"""
+    optimized, _ = optimizer.assemble_optimized(source)
+    computers = [emulator.Computer(assembler.assemble(source).code),
+                 emulator.Computer(optimized.code)]
+    for computer in computers:
+        computer.run(100)
+    (original, optimized) = computers
+    assert original.ram[100] == 0xFFFF
+    assert optimized.ram.tobytes() == original.ram.tobytes()
+
+
+@pytest.mark.parametrize("seed", range(100))
+def test_superoptimizer_runs_instructions_like_the_computer(seed):
+    rng = random.Random(seed)
+    while True:
+        window = [rng.choice(superoptimizer.C_INSTRUCTIONS) for _ in range(rng.randrange(1, 5))]
+        if superoptimizer.is_searchable(window):
+            break
+    (a, d, m, latched) = (rng.randrange(emulator.RAM_SIZE), rng.randrange(0x10000),
+                          rng.randrange(0x10000), rng.randrange(0x10000))
+    # Start with the first instruction already fetched, and the word
+    # latched during the instruction before it.
+    computer = emulator.Computer(window + [emulator.NOP])
+    computer.a, computer.d, computer.memory_out = a, d, latched
+    computer.ram[a] = m
+    computer.instruction = window[0]
+    computer.pc = 1
+    computer.run(len(window))
+    # The word latched at the end isn't modelled once A changes, the
+    # assembler doesn't rewrite runs where it matters.
+    expected = superoptimizer.execute(window, a, d, m, latched)[:3]
+    assert (computer.a, computer.d, computer.ram[a]) == expected